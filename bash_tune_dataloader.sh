@@ -0,0 +1 @@
+python main.py --config_path "hyper_parameters/train_segmentation.yml" --mode tune_dataloader
\ No newline at end of file
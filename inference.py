@@ -44,6 +44,9 @@ class Inferencer:
         self.img_save_dir = save_dir
         self.num_batches_val = int(len(self.loader_val))
         self.metric = self._init_metric(self.args.inference_mode, self.args.num_class)
+        self.metric_prob = metrics.StreamProbabilityHistogram(self.args.num_class,
+                                                              n_bins=self.args.prob_histogram_bins if hasattr(self.args, 'prob_histogram_bins') else 1000) \
+            if hasattr(self.args, 'prob_histogram') and self.args.prob_histogram else None
 
         self.image_mean = self.loader_form.image_loader.image_mean
         self.image_std = self.loader_form.image_loader.image_std
@@ -112,6 +115,8 @@ class Inferencer:
                 output = self.model(x_in)
 
                 result_dict = self.post_process(output, target, x_in, img_id, batch_idx, draw_results=False)
+                if self.metric_prob is not None:
+                    self.metric_prob.update(target.squeeze(1), F.softmax(output, dim=1))
 
                 img_id_list.append(img_id)
 
@@ -123,12 +128,32 @@ class Inferencer:
         for i in range(self.args.num_class):
             print(f'Val Class {i} IoU: {cIoU[i]}')
 
+        if self.metric_prob is not None:
+            self._save_probability_curves()
+
         df = pd.DataFrame({'file_name': img_id_list,
                            # 'level': level_list,
                            # 'target': label_list,
                            })
         df.to_csv(self.dir_path + '/' + self.model_fn + '_score.csv', encoding='utf-8-sig', index=False)
 
+    def _save_probability_curves(self):
+        metrics_prob = self.metric_prob.get_results()
+
+        print(f'Val Mean AUC: {metrics_prob["Mean AUC"]} / Val Mean AP: {metrics_prob["Mean AP"]} / Val ECE: {metrics_prob["ECE"]}')
+        for i in range(self.args.num_class):
+            print(f'Val Class {i} AUC: {metrics_prob["Class AUC"][i]} / AP: {metrics_prob["Class AP"][i]} / '
+                  f'Best F1: {metrics_prob["Class Best F1"][i]} at threshold {metrics_prob["Class Best Threshold"][i]}')
+
+        curves = self.metric_prob.get_curves()
+        df = pd.concat([pd.DataFrame({'class': i,
+                                      'threshold': curves['thresholds'],
+                                      'fpr': curves['fpr'][i],
+                                      'tpr': curves['tpr'][i],
+                                      'precision': curves['precision'][i],
+                                      'recall': curves['recall'][i]}) for i in range(self.args.num_class)])
+        df.to_csv(self.dir_path + '/' + self.model_fn + '_curves.csv', encoding='utf-8-sig', index=False)
+
     def post_process(self, output, target, x_img, img_id, batch_idx, draw_results=False):
 
         if self.args.criterion == 'CE':
@@ -184,6 +209,10 @@ class Inferencer:
         elif model_name == 'Swin':
             model = model_implements.Swin(num_classes=self.args.num_class,
                                           in_channel=self.args.input_channel).to(self.device)
+        elif model_name == 'HRNet':
+            model = model_implements.HRNet(num_classes=self.args.num_class,
+                                           output_mode=self.args.hrnet_output_mode if hasattr(self.args, 'hrnet_output_mode') else 'concat',
+                                           fused_channels=self.args.hrnet_fused_channels if hasattr(self.args, 'hrnet_fused_channels') else 256).to(self.device)
 
         else:
             raise Exception('No model named', model_name)
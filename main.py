@@ -10,6 +10,7 @@ import ast
 from train_segmentation import Trainer_seg
 from train_classification import Trainer_cls
 from inference import Inferencer
+from tune_dataloader import DataLoaderTuner
 from torch.cuda import is_available
 from datetime import datetime
 
@@ -36,6 +37,7 @@ def conf_to_args(args, **kwargs):    # pass in variable numbers of args
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_path', type=str)
+    parser.add_argument('--mode', type=str, default=None)  # override 'mode' of the config. e.g. tune_dataloader
     arg = parser.parse_args()
 
     if arg.config_path is not None:
@@ -60,6 +62,9 @@ def main():
                     else: raise e
             conf[key] = value
 
+    if arg.mode is not None:
+        conf['mode'] = arg.mode
+
     args = argparse.Namespace()
     conf_to_args(args, **conf)  # pass in keyword args
 
@@ -67,7 +72,7 @@ def main():
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.CUDA_VISIBLE_DEVICES
 
-    if args.wandb:
+    if args.wandb and args.mode != 'tune_dataloader':
         wandb.init(project='{}'.format(args.project_name), config=args, name=now_time,
                    settings=wandb.Settings(start_method="fork"))
 
@@ -102,6 +107,11 @@ def main():
             inferencer.start_inference_classification()
         else:
             raise ValueError('Please select correct inference_mode !!!')
+
+    elif args.mode == 'tune_dataloader':
+        tuner = DataLoaderTuner(args)
+        tuner.start_tuning()
+
     else:
         print('No mode supported.')
 
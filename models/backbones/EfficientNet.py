@@ -287,6 +287,62 @@ def get_blocks_to_be_concat(model, x):
     return blocks
 
 
+def encoder_forward(encoder, x, block_indices=None):
+    """
+    Forward of the EfficientNet encoders.
+
+    :param block_indices: indices of the blocks whose outputs are returned as well, or None for the head output only
+    :returns: head output, or (list of the block outputs, head output)
+    """
+    # Stem
+    x = encoder.stem_conv(x)
+    x = encoder.stem_batch_norm(x)
+    x = encoder.stem_swish(x)
+
+    # Blocks
+    features = []
+    for idx, block in enumerate(encoder.blocks):
+        drop_connect_rate = encoder.global_params.drop_connect_rate
+        if drop_connect_rate:
+            drop_connect_rate *= idx / len(encoder.blocks)
+        x = block(x, drop_connect_rate)
+
+        if block_indices is not None and idx in block_indices:
+            features.append(x)
+
+    # Head
+    x = encoder.head_conv(x)
+    x = encoder.head_batch_norm(x)
+    x = encoder.head_swish(x)
+
+    if block_indices is None:
+        return x
+    return features, x
+
+
+def get_blocks_indices_to_be_concat(encoder, size):
+    """
+    Indices of the blocks concatenated by 'EfficientUnet' for an input of spatial 'size', without a forward pass.
+
+    Same selection as 'get_blocks_to_be_concat': the first block of every output resolution, except the last one
+    which has the resolution of the head. The resolutions follow from the strides of the 'same' padded convolutions.
+    """
+    h, w = size
+    stride_h, stride_w = encoder.stem_conv.stride
+    h, w = math.ceil(h / stride_h), math.ceil(w / stride_w)
+
+    shapes = set()
+    indices = []
+    for idx, block in enumerate(encoder.blocks):
+        stride_h, stride_w = block._depthwise_conv.stride
+        h, w = math.ceil(h / stride_h), math.ceil(w / stride_w)
+        if (h, w) not in shapes:
+            shapes.add((h, w))
+            indices.append(idx)
+
+    return tuple(indices[:-1])
+
+
 def _get_model_by_name(model_name, classes=1000, pretrained=False):
     block_args_list, global_params = get_efficientnet_params(model_name, override_params={'num_classes': classes})
     model = EfficientNet(block_args_list, global_params)
@@ -466,24 +522,8 @@ class Encoder(nn.Module):
 
         del model
 
-    def forward(self, x):
-        # Stem
-        x = self.stem_conv(x)
-        x = self.stem_batch_norm(x)
-        x = self.stem_swish(x)
-
-        # Blocks
-        for idx, block in enumerate(self.blocks):
-            drop_connect_rate = self.global_params.drop_connect_rate
-            if drop_connect_rate:
-                drop_connect_rate *= idx / len(self.blocks)
-            x = block(x, drop_connect_rate)
-
-        # Head
-        x = self.head_conv(x)
-        x = self.head_batch_norm(x)
-        x = self.head_swish(x)
-        return x
+    def forward(self, x, block_indices=None):
+        return encoder_forward(self, x, block_indices)
 
 
 class BlockDecoder(object):
@@ -683,24 +723,8 @@ class EfficientNet(nn.Module):
                 self.head_batch_norm = model._bn1
                 self.head_swish = Swish(name='head_swish')
 
-            def forward(self, x):
-                # Stem
-                x = self.stem_conv(x)
-                x = self.stem_batch_norm(x)
-                x = self.stem_swish(x)
-
-                # Blocks
-                for idx, block in enumerate(self.blocks):
-                    drop_connect_rate = self.global_params.drop_connect_rate
-                    if drop_connect_rate:
-                        drop_connect_rate *= idx / len(self.blocks)
-                    x = block(x, drop_connect_rate)
-
-                # Head
-                x = self.head_conv(x)
-                x = self.head_batch_norm(x)
-                x = self.head_swish(x)
-                return x
+            def forward(self, x, block_indices=None):
+                return encoder_forward(self, x, block_indices)
 
         return Encoder()
 
@@ -757,6 +781,8 @@ class EfficientUnet(nn.Module):
 
         self.final_conv = nn.Conv2d(self.size[5], out_channels, kernel_size=1)
 
+        self._block_indices = dict()   # input (h, w) -> indices of the concatenated blocks
+
     @property
     def n_channels(self):
         n_channels_dict = {'efficientnet-b0': 1280, 'efficientnet-b1': 1280, 'efficientnet-b2': 1408,
@@ -775,23 +801,26 @@ class EfficientUnet(nn.Module):
     def forward(self, x):
         input_ = x
 
-        blocks = get_blocks_to_be_concat(self.encoder, x)
-        _, x = blocks.popitem()
+        size = tuple(x.shape[-2:])
+        if size not in self._block_indices:
+            self._block_indices[size] = get_blocks_indices_to_be_concat(self.encoder, size)
+
+        blocks, x = self.encoder(x, self._block_indices[size])
 
         x = self.up_conv1(x)
-        x = torch.cat([x, blocks.popitem()[1]], dim=1)
+        x = torch.cat([x, blocks.pop()], dim=1)
         x = self.double_conv1(x)
 
         x = self.up_conv2(x)
-        x = torch.cat([x, blocks.popitem()[1]], dim=1)
+        x = torch.cat([x, blocks.pop()], dim=1)
         x = self.double_conv2(x)
 
         x = self.up_conv3(x)
-        x = torch.cat([x, blocks.popitem()[1]], dim=1)
+        x = torch.cat([x, blocks.pop()], dim=1)
         x = self.double_conv3(x)
 
         x = self.up_conv4(x)
-        x = torch.cat([x, blocks.popitem()[1]], dim=1)
+        x = torch.cat([x, blocks.pop()], dim=1)
         x = self.double_conv4(x)
 
         if self.concat_input:
@@ -803,3 +832,63 @@ class EfficientUnet(nn.Module):
 
         return x
 
+
+def main():
+    import time
+
+    torch.manual_seed(0)
+
+    # parity of the cached multi-output forward with the hooked forward
+    for encoder in (EfficientNet.encoder('efficientnet-b0'), Encoder(1000, 'efficientnet-b0')):
+        model = EfficientUnet(encoder, out_channels=2, concat_input=True)
+        for train in (True, False):
+            model.train(train)
+            for size in ((224, 224), (256, 320), (97, 131)):
+                x = torch.rand(2, 3, *size)
+                with torch.no_grad():
+                    torch.manual_seed(1)   # same drop connect masks in training mode
+                    blocks = get_blocks_to_be_concat(model.encoder, x)
+                    torch.manual_seed(1)
+                    features, head = model.encoder(x, get_blocks_indices_to_be_concat(model.encoder, size))
+                    expected = list(blocks.values())
+                    assert len(features) == len(expected) - 1
+                    for a, b in zip(features + [head], expected):
+                        assert a.shape == b.shape and torch.equal(a, b)
+        print('%s: hooked and cached block outputs are equal' % type(encoder).__qualname__)
+
+    # per-step time of the decoder forward with hooks vs cached indices
+    model = EfficientUnet(EfficientNet.encoder('efficientnet-b0'), out_channels=2).eval()
+    x = torch.rand(4, 3, 256, 256)
+
+    def hooked_encoder(x):
+        blocks = get_blocks_to_be_concat(model.encoder, x)
+        _, head = blocks.popitem()
+        return list(blocks.values()), head
+
+    def cached_encoder(x):
+        size = tuple(x.shape[-2:])
+        if size not in model._block_indices:
+            model._block_indices[size] = get_blocks_indices_to_be_concat(model.encoder, size)
+        return model.encoder(x, model._block_indices[size])
+
+    with torch.no_grad():
+        for name, fn in (('hooked', hooked_encoder), ('cached', cached_encoder)):
+            fn(x)
+            tic = time.time()
+            for _ in range(10):
+                fn(x)
+            print('%s encoder: %.2f ms / step' % (name, (time.time() - tic) / 10 * 1000))
+
+        tic = time.time()
+        for _ in range(1000):
+            get_blocks_to_be_concat(model.encoder, x[:1, :, :32, :32])
+        hook_overhead = (time.time() - tic)
+        tic = time.time()
+        for _ in range(1000):
+            model.encoder(x[:1, :, :32, :32])
+        plain = (time.time() - tic)
+        print('hook registration overhead: %.3f ms / step' % ((hook_overhead - plain) / 1000 * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -291,8 +291,15 @@ blocks_dict = {
 
 
 class HighResolutionNet(nn.Module):
+    """
+    HRNetV2-W48 backbone, returns (None, None, feats) at 1/4 resolution.
 
-    def __init__(self, **kwargs):
+    :param output_mode: 'concat' upsamples the four branches and concatenates them (720 channels), 'fused' projects
+    each branch to 'fused_channels' with a 1x1 conv + BN before upsampling and sums them
+    :param fused_channels: channels of the 'fused' output
+    """
+
+    def __init__(self, output_mode='concat', fused_channels=256, **kwargs):
         self.__C = AttrDict()
         self.__C.MODEL = AttrDict()
         self.__C.MODEL.OCR_EXTRA = AttrDict()
@@ -381,7 +388,19 @@ class HighResolutionNet(nn.Module):
         self.stage4, pre_stage_channels = self._make_stage(
             self.stage4_cfg, num_channels, multi_scale_output=True)
 
-        self.high_level_ch = np.int(np.sum(pre_stage_channels))
+        self.output_mode = output_mode
+        if output_mode == 'concat':
+            self.high_level_ch = int(np.sum(pre_stage_channels))
+        elif output_mode == 'fused':
+            self.output_projections = nn.ModuleList([nn.Sequential(
+                nn.Conv2d(in_channels, fused_channels, kernel_size=1, bias=False),
+                nn.BatchNorm2d(fused_channels, momentum=BN_MOMENTUM)) for in_channels in pre_stage_channels])
+            self.output_relu = nn.ReLU(inplace=relu_inplace)
+            self.high_level_ch = fused_channels
+        else:
+            raise Exception('No output mode named', output_mode)
+
+        self._upsample_buffer = None    # reused by the 'fused' output without autograd
 
     def _make_transition_layer(
             self, num_channels_pre_layer, num_channels_cur_layer):
@@ -504,6 +523,9 @@ class HighResolutionNet(nn.Module):
                 x_list.append(y_list[i])
         x = self.stage4(x_list)
 
+        if self.output_mode == 'fused':
+            return None, None, self._fused_output(x)
+
         # Upsampling
         x0_h, x0_w = x[0].size(2), x[0].size(3)
         x1 = F.interpolate(x[1], size=(x0_h, x0_w),
@@ -517,15 +539,34 @@ class HighResolutionNet(nn.Module):
 
         return None, None, feats
 
-    def init_weights(self):
-        pretrained = self.__Cself.__C.MODEL.HRNET_CHECKPOINT
+    def _fused_output(self, x):
+        feats = self.output_projections[0](x[0])
+        size = feats.shape[2:]
+
+        for i in range(1, len(x)):
+            y = self.output_projections[i](x[i])
+            if torch.is_grad_enabled():
+                feats = feats + F.interpolate(y, size=size, mode='bilinear', align_corners=align_corners)
+            else:
+                # upsample every branch into the same buffer and accumulate in place
+                buffer = self._upsample_buffer
+                if buffer is None or buffer.shape != feats.shape or buffer.dtype != feats.dtype or buffer.device != feats.device:
+                    buffer = self._upsample_buffer = torch.empty_like(feats)
+                torch.ops.aten.upsample_bilinear2d.out(y, list(size), align_corners, None, None, out=buffer)
+                feats.add_(buffer)
+
+        return self.output_relu(feats)
+
+    def init_weights(self, pretrained=None):
+        if pretrained is None:
+            pretrained = self.__C.MODEL.HRNET_CHECKPOINT
         for name, m in self.named_modules():
             if any(part in name for part in {'cls', 'aux', 'ocr'}):
                 # print('skipped', name)
                 continue
             if isinstance(m, nn.Conv2d):
                 nn.init.normal_(m.weight, std=0.001)
-            elif isinstance(m, self.__C.MODEL.BNFUNC):
+            elif isinstance(m, nn.BatchNorm2d):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
         if os.path.isfile(pretrained):
@@ -545,8 +586,57 @@ class HighResolutionNet(nn.Module):
             raise RuntimeError('No such file {}'.format(pretrained))
 
 
-def get_seg_model():
-    model = HighResolutionNet()
+def get_seg_model(**kwargs):
+    model = HighResolutionNet(**kwargs)
     model.init_weights()
 
     return model
+
+
+def _peak_memory(output_mode, size, train):
+    # increase of the peak resident memory during one step, run in a fresh process
+    import resource
+
+    torch.manual_seed(0)
+    model = HighResolutionNet(output_mode=output_mode).train(train)
+    x = torch.rand(1, 3, *size)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.set_grad_enabled(train):
+        _, _, feats = model(x)
+        if train:
+            feats.mean().backward()
+
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024, tuple(feats.shape)
+
+
+def main():
+    import multiprocessing
+
+    torch.manual_seed(0)
+
+    # the buffered upsampling of inference equals the autograd path
+    model = HighResolutionNet(output_mode='fused').eval()
+    x = torch.rand(1, 3, 128, 160)
+    with torch.no_grad():
+        buffered = model(x)[2]
+        buffered = model(x)[2]  # second call reuses the buffer
+    expected = model(x)[2]
+    print('fused output, buffered vs autograd max abs error: %.2e' % (buffered - expected).abs().max().item())
+
+    for output_mode in ('concat', 'fused'):
+        params = sum(p.numel() for p in HighResolutionNet(output_mode=output_mode).parameters())
+        print('%s: %.2fM parameters' % (output_mode, params / 1e6))
+
+    # memory of the output vs resolution, in a fresh process each
+    pool = multiprocessing.get_context('fork').Pool(1, maxtasksperchild=1)
+    for train, size in ((False, (512, 1024)), (False, (1024, 2048)), (True, (256, 512))):
+        for output_mode in ('concat', 'fused'):
+            peak, shape = pool.apply(_peak_memory, (output_mode, size, train))
+            print('%s %s %dx%d: feats %s (%.1f MB), +%.1f MB peak memory'
+                  % ('train' if train else 'inference', output_mode, size[0], size[1], shape,
+                     np.prod(shape) * 4 / 2 ** 20, peak))
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,18 @@
 
 # https://github.com/ekzhang/fastseg/blob/master/fastseg/model/mobilenetv3.py
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from torchvision import transforms
-
 from geffnet import tf_mobilenetv3_large_100, tf_mobilenetv3_small_100, tf_mobilenetv3_small_minimal_100
 from geffnet.efficientnet_builder import InvertedResidual, Conv2dSame, Conv2dSameExport
 
 
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
 MODEL_WEIGHTS_URL = {
     ('mobilev3large-lraspp', 256): 'https://github.com/ekzhang/fastseg/releases/download/v0.1-weights/mobilev3large-lraspp-f256-9b613ffd.pt',
     ('mobilev3large-lraspp', 128): 'https://github.com/ekzhang/fastseg/releases/download/v0.1-weights/mobilev3large-lraspp-f128-9cbabfde.pt',
@@ -106,10 +108,10 @@ class BaseSegmentation(nn.Module):
         """Generate and return segmentations for a batch of images.
 
         Keyword arguments:
-        images -- a list of PIL images or NumPy arrays to run segmentation on
+        images -- a list of PIL images or NumPy arrays of the same size to run segmentation on,
+            or a uint8 tensor of shape (batch, height, width, 3) or (batch, 3, height, width)
         return_prob -- whether to return the output probabilities (default False)
-        device -- the device to use when running evaluation, defaults to 'cuda' or 'cpu'
-            (this must match the device that the model is currently on)
+        device -- the device to use when running evaluation, defaults to the device of the model
 
         Returns:
         if `return_prob == False`, a NumPy array of shape (len(images), height, width)
@@ -117,19 +119,13 @@ class BaseSegmentation(nn.Module):
         if `return_prob == True`, a NumPy array of shape (len(images), num_classes, height, width)
             containing the log-probabilities of each class
         """
-        # Determine the device
         if device is None:
-            if torch.cuda.is_available():
-                device = torch.device('cuda')
-            else:
-                device = torch.device('cpu')
+            device = next(self.parameters()).device
 
-        # Preprocess images by normalizing and turning into `torch.tensor`s
-        tfms = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-        ])
-        ipt = torch.stack([tfms(im) for im in images]).to(device)
+        # Upload the images as they are and normalize on the device
+        if not torch.is_tensor(images):
+            images = torch.from_numpy(np.stack([np.asarray(im) for im in images]))
+        ipt = self._normalize(images.to(device, non_blocking=True))
 
         # Run inference
         with torch.no_grad():
@@ -140,6 +136,38 @@ class BaseSegmentation(nn.Module):
             out = out.argmax(dim=1)
         return out.cpu().numpy()
 
+    def predict_iter(self, images, batch_size=8, return_prob=False, device=None):
+        """Generate segmentations for a stream of images, run in batches of `batch_size`.
+
+        Keyword arguments:
+        images -- an iterable of PIL images, NumPy arrays or (height, width, 3) uint8 tensors
+        batch_size -- the number of images per forward. A batch is also cut when the image size changes
+
+        Yields the result of `predict_one()` for every image, in order.
+        """
+        batch = []
+        for image in images:
+            image = image if torch.is_tensor(image) else torch.from_numpy(np.asarray(image))
+            if batch and (len(batch) == batch_size or image.shape != batch[0].shape):
+                yield from self.predict(torch.stack(batch), return_prob, device)
+                batch = []
+            batch.append(image)
+
+        if batch:
+            yield from self.predict(torch.stack(batch), return_prob, device)
+
+    @staticmethod
+    def _normalize(images):
+        """(b, h, w, 3) or (b, 3, h, w) images to normalized float (b, 3, h, w), as ToTensor and Normalize"""
+        if images.shape[-1] == 3 and images.shape[1] != 3:
+            images = images.permute(0, 3, 1, 2)
+
+        scale = 1 / 255 if images.dtype == torch.uint8 else 1
+        mean = torch.tensor(IMAGENET_MEAN, device=images.device).view(1, 3, 1, 1)
+        std = torch.tensor(IMAGENET_STD, device=images.device).view(1, 3, 1, 1)
+
+        return (images.float() * scale - mean) / std
+
 
 class LRASPP(BaseSegmentation):
     """Lite R-ASPP style segmentation network."""
@@ -190,8 +218,9 @@ class LRASPP(BaseSegmentation):
                 nn.BatchNorm2d(num_filters),
                 nn.ReLU(inplace=True),
             )
+            # global context at any input resolution, broadcast over the feature map
             self.aspp_conv2 = nn.Sequential(
-                nn.AvgPool2d(kernel_size=(49, 49), stride=(16, 20)),
+                nn.AdaptiveAvgPool2d(1),
                 nn.Conv2d(high_level_ch, num_filters, 1, bias=False),
                 nn.Sigmoid(),
             )
@@ -214,12 +243,7 @@ class LRASPP(BaseSegmentation):
                 F.interpolate(self.aspp_pool(final), size=final.shape[2:]),
             ], 1)
         else:
-            aspp = self.aspp_conv1(final) * F.interpolate(
-                self.aspp_conv2(final),
-                final.shape[2:],
-                mode='bilinear',
-                align_corners=True
-            )
+            aspp = self.aspp_conv1(final) * self.aspp_conv2(final)
         y = self.conv_up1(aspp)
         y = F.interpolate(y, size=s4.shape[2:], mode='bilinear', align_corners=False)
 
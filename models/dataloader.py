@@ -1,4 +1,10 @@
 import os
+import atexit
+import tempfile
+import collections
+import json
+import math
+import multiprocessing
 import torch
 import torchvision.transforms.functional as tf
 import random
@@ -8,9 +14,11 @@ import pandas as pd
 from PIL import Image
 from torchvision import transforms
 from torchvision.transforms import InterpolationMode
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
+from torch.nn import functional as F
 from models import utils
-from multiprocessing import set_start_method
+from multiprocessing import shared_memory, resource_tracker
 
 
 # fix randomness on DataLoader
@@ -58,6 +66,224 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class SizeBucketBatchSampler(Sampler):
+    """
+    Batch sampler which only puts images of similar size into the same batch.
+
+    Images are grouped by (height, width) rounded up to 'granularity' pixels, so a batch padded by 'pad_collate' grows
+    by less than 'granularity' pixels per side. Batches are drawn within each bucket and the batch order is shuffled.
+
+    :param image_sizes: list of (height, width) per dataset index
+    """
+
+    def __init__(self, image_sizes, batch_size, shuffle=True, drop_last=False, granularity=32, generator=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+
+        self.buckets = collections.defaultdict(list)
+        for idx, (h, w) in enumerate(image_sizes):
+            self.buckets[(math.ceil(h / granularity), math.ceil(w / granularity))].append(idx)
+
+    def __iter__(self):
+        batches = []
+        for indices in self.buckets.values():
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=self.generator).tolist()]
+            for i in range(0, len(indices), self.batch_size):
+                batch = indices[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+
+        yield from batches
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum(math.ceil(len(indices) / self.batch_size) for indices in self.buckets.values())
+
+
+def pad_collate(batch, label_pad_value=-100):
+    """
+    Collates Image2ImageLoader samples of different size by padding right and bottom to the largest one in the batch.
+    Inputs are padded with 0 and labels with 'label_pad_value', which is ignored by CrossEntropy and the stream metrics.
+    """
+    max_h = max(x[0].shape[-2] for x, _ in batch)
+    max_w = max(x[0].shape[-1] for x, _ in batch)
+
+    padded = []
+    for (x_in, x_path), (target, y_path) in batch:
+        pad = [0, max_w - x_in.shape[-1], 0, max_h - x_in.shape[-2]]
+        x_in = F.pad(x_in, pad, value=0)
+        target = F.pad(target.long(), pad, value=label_pad_value)
+        padded.append(((x_in, x_path), (target, y_path)))
+
+    return default_collate(padded)
+
+
+def _open_shared_memory(name, create=False, size=0):
+    # segments stay registered with the resource tracker, which the workers share with the main process (see
+    # SharedImageCache). the tracker unlinks what is left when every process is gone, also after a crash or a kill
+    return shared_memory.SharedMemory(name=name, create=create, size=size)
+
+
+def _unlink_shared_memory(name):
+    shm = _open_shared_memory(name)
+    shm.close()
+    shm.unlink()
+
+
+class SharedImageCache:
+    """
+    LRU cache of decoded uint8 images in POSIX shared memory, shared by all DataLoader workers.
+
+    Each entry lives in its own shared memory segment named after its key, so any worker can attach to an image decoded
+    by another one. The entry table and statistics are kept in shared arrays created before the workers start and are
+    only touched under a single process-shared lock; the copies of the images are made outside of it. When
+    'budget_bytes' would be exceeded, the least recently used entries are evicted. Segments are unlinked by the process
+    that created the cache on exit, or by the resource tracker if the run is killed.
+
+    :param num_keys: number of distinct keys. keys are integers in [0, num_keys)
+    :param budget_bytes: maximum bytes of decoded images held in shared memory by this cache, i.e. per data loader
+    """
+
+    # entry table columns
+    _PRESENT, _NBYTES, _H, _W, _C, _LAST_ACCESS = range(6)
+    # values of _PRESENT. a reserved entry is being written and is neither read nor evicted
+    _RESERVED, _READY = 1, 2
+    # statistics
+    _CLOCK, _TOTAL_BYTES, _HITS, _MISSES, _BYTES_SAVED = range(5)
+
+    def __init__(self, num_keys, budget_bytes):
+        self.num_keys = num_keys
+        self.budget_bytes = int(budget_bytes)
+        self.prefix = f'i2i_{os.getpid()}_{id(self) % 1000000}'
+        self.owner_pid = os.getpid()
+
+        self._table = multiprocessing.RawArray('q', num_keys * 6)
+        self._stats = multiprocessing.RawArray('q', 5)
+        self._lock = multiprocessing.Lock()
+
+        # started before the workers, which inherit it. otherwise each worker starts its own tracker,
+        # which unlinks the segments of the worker when it exits
+        resource_tracker.ensure_running()
+        atexit.register(self.close)
+
+    @property
+    def table(self):
+        return np.frombuffer(self._table, dtype=np.int64).reshape(self.num_keys, 6)
+
+    @property
+    def stats(self):
+        return np.frombuffer(self._stats, dtype=np.int64)
+
+    def _name(self, key):
+        return f'{self.prefix}_{key}'
+
+    def get(self, key):
+        """Returns a copy of the cached array, or None on a miss"""
+        with self._lock:
+            table, stats = self.table, self.stats
+            entry = table[key]
+
+            if entry[self._PRESENT] != self._READY:
+                stats[self._MISSES] += 1
+                return None
+
+            shape = (entry[self._H], entry[self._W], entry[self._C]) if entry[self._C] else (entry[self._H], entry[self._W])
+            # attached under the lock, the mapping stays valid if the entry is evicted while copying
+            shm = _open_shared_memory(self._name(key))
+
+            stats[self._CLOCK] += 1
+            entry[self._LAST_ACCESS] = stats[self._CLOCK]
+            stats[self._HITS] += 1
+            stats[self._BYTES_SAVED] += entry[self._NBYTES]
+
+        arr = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+        shm.close()
+
+        return arr
+
+    def put(self, key, arr):
+        arr = np.ascontiguousarray(arr, dtype=np.uint8)
+        if arr.nbytes > self.budget_bytes or arr.nbytes == 0:
+            return
+
+        # reserve the entry and its bytes under the lock
+        with self._lock:
+            table, stats = self.table, self.stats
+            if table[key, self._PRESENT]:
+                return  # decoded concurrently by another worker
+
+            while stats[self._TOTAL_BYTES] + arr.nbytes > self.budget_bytes:
+                if not self._evict_lru(table, stats):
+                    return  # the budget is held by entries still being written
+
+            try:
+                shm = _open_shared_memory(self._name(key), create=True, size=arr.nbytes)
+            except FileExistsError:     # stale segment of an entry evicted without unlink
+                _unlink_shared_memory(self._name(key))
+                shm = _open_shared_memory(self._name(key), create=True, size=arr.nbytes)
+
+            table[key] = [self._RESERVED, arr.nbytes, arr.shape[0], arr.shape[1], arr.shape[2] if arr.ndim == 3 else 0, 0]
+            stats[self._TOTAL_BYTES] += arr.nbytes
+
+        np.ndarray(arr.shape, dtype=np.uint8, buffer=shm.buf)[:] = arr
+        shm.close()
+
+        with self._lock:
+            stats = self.stats
+            stats[self._CLOCK] += 1
+            self.table[key, self._LAST_ACCESS] = stats[self._CLOCK]
+            self.table[key, self._PRESENT] = self._READY
+
+    def _evict_lru(self, table, stats):
+        ready = np.flatnonzero(table[:, self._PRESENT] == self._READY)
+        if len(ready) == 0:
+            return False
+
+        key = ready[np.argmin(table[ready, self._LAST_ACCESS])]
+        self._unlink(key)
+        stats[self._TOTAL_BYTES] -= table[key, self._NBYTES]
+        table[key] = 0
+
+        return True
+
+    def _unlink(self, key):
+        try:
+            _unlink_shared_memory(self._name(key))
+        except FileNotFoundError:
+            pass
+
+    def get_results(self):
+        stats = self.stats
+        lookups = stats[self._HITS] + stats[self._MISSES]
+        return {'Cache Hit Rate': float(stats[self._HITS] / lookups) if lookups else 0.,
+                'Cache Bytes Saved': int(stats[self._BYTES_SAVED]),
+                'Cache Bytes Used': int(stats[self._TOTAL_BYTES])}
+
+    def reset(self):
+        """Resets hit/miss statistics, cached entries are kept"""
+        with self._lock:
+            stats = self.stats
+            stats[self._HITS] = 0
+            stats[self._MISSES] = 0
+            stats[self._BYTES_SAVED] = 0
+
+    def close(self):
+        if os.getpid() != self.owner_pid:
+            return
+        table = self.table
+        for key in np.flatnonzero(table[:, self._PRESENT]):
+            self._unlink(key)
+        table[:] = 0
+        self.stats[self._TOTAL_BYTES] = 0
+
+
 class Image2ImageLoader(Dataset):
 
     def __init__(self,
@@ -95,6 +321,58 @@ class Image2ImageLoader(Dataset):
         del x_img_name
         del y_img_name
 
+        # decoded images shared by workers. keys are 2 * index for input and 2 * index + 1 for label
+        self.image_cache = None
+        if hasattr(self.args, 'image_cache_mb') and self.args.image_cache_mb > 0:
+            self.image_cache = SharedImageCache(self.len * 2, self.args.image_cache_mb * 2 ** 20)
+
+        self._image_sizes = None
+
+    def image_sizes(self, cache_path=None):
+        """
+        Returns (height, width) of every input image. Only the file headers are read, and the result is kept in memory
+        and in 'cache_path' (json) when given.
+        """
+        if self._image_sizes is not None:
+            return self._image_sizes
+
+        cached = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+
+        sizes = []
+        for path in self.x_img_path:
+            if path not in cached:
+                with Image.open(path) as img:   # lazy, decodes header only
+                    w, h = img.size
+                cached[path] = [h, w]
+            sizes.append(tuple(cached[path]))
+
+        if cache_path is not None:
+            with open(cache_path, 'w') as f:
+                json.dump(cached, f)
+
+        self._image_sizes = sizes
+        return sizes
+
+    def load_image(self, index, is_label=False):
+        path = self.y_img_path[index] if is_label else self.x_img_path[index]
+        mode = 'L' if is_label else 'RGB'
+
+        if self.image_cache is None:
+            return Image.open(path).convert(mode)
+
+        key = index * 2 + int(is_label)
+        arr = self.image_cache.get(key)
+        if arr is not None:
+            return Image.fromarray(arr)
+
+        img = Image.open(path).convert(mode)
+        self.image_cache.put(key, np.asarray(img))
+
+        return img
+
     def transform(self, image, target):
         if hasattr(self.args, 'input_size'):
             image = tf.resize(image, [int(self.args.input_size[0]), int(self.args.input_size[1])])
@@ -105,15 +383,16 @@ class Image2ImageLoader(Dataset):
 
             if (random_gen.random() < 0.8) and self.args.transform_cutmix:
                 rand_n = random_gen.randint(0, self.len - 1)     # randomly generates reference image on dataset
-                image_refer = Image.open(self.x_img_path[rand_n]).convert('RGB')
-                target_refer = Image.open(self.y_img_path[rand_n]).convert('L')
+                image_refer = self.load_image(rand_n)
+                target_refer = self.load_image(rand_n, is_label=True)
                 image, target = utils.cut_mix(image, target, image_refer, target_refer)
 
             if (random_gen.random() < 0.8) and self.args.transform_rand_resize:
                 rand_h = (random_gen.random() * 1.5) + 0.5  # [0.5, 2.0]
                 rand_w = (random_gen.random() * 1.5) + 0.5
-                resize_h = int((self.args.input_size[0] * rand_h).__round__())
-                resize_w = int((self.args.input_size[1] * rand_w).__round__())
+                base_h, base_w = self.args.input_size if hasattr(self.args, 'input_size') else (image.height, image.width)
+                resize_h = int((base_h * rand_h).__round__())
+                resize_w = int((base_w * rand_w).__round__())
 
                 image = tf.resize(image, [resize_h, resize_w])
                 target = tf.resize(target, [resize_h, resize_w], interpolation=InterpolationMode.NEAREST)
@@ -165,11 +444,7 @@ class Image2ImageLoader(Dataset):
         target_tensor = target_tensor.unsqueeze(0)    # expand 'grey channel' for loss function dependency
 
         if self.args.input_space == 'HSV':
-            try:
-                set_start_method('spawn')
-                image_tensor = utils.ImageProcessing.rgb_to_hsv(image_tensor)
-            except RuntimeError:
-                pass
+            image_tensor = utils.ImageProcessing.rgb_to_hsv(image_tensor)
 
         return image_tensor, target_tensor
 
@@ -177,8 +452,8 @@ class Image2ImageLoader(Dataset):
         x_path = self.x_img_path[index]
         y_path = self.y_img_path[index]
 
-        img_x = Image.open(x_path).convert('RGB')
-        img_y = Image.open(y_path).convert('L')
+        img_x = self.load_image(index)
+        img_y = self.load_image(index, is_label=True)
 
         img_x_tr, img_y_tr = self.transform(img_x, img_y)
 
@@ -264,11 +539,7 @@ class Image2VectorLoader(Dataset):
                                         std=self.image_std)
 
         if self.args.input_space == 'HSV':
-            try:
-                set_start_method('spawn')
-                image_tensor = utils.ImageProcessing.rgb_to_hsv(image_tensor)
-            except RuntimeError:
-                pass
+            image_tensor = utils.ImageProcessing.rgb_to_hsv(image_tensor)
 
         return image_tensor
 
@@ -301,24 +572,47 @@ class Image2ImageDataLoader:
                  batch_size=4,
                  num_workers=0,
                  pin_memory=True,
+                 prefetch_factor=2,
                  **kwargs):
 
         g = torch.Generator()
         g.manual_seed(3407)
 
+        # 'prefetch_factor' is only valid with worker processes
+        loader_kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+
         self.image_loader = Image2ImageLoader(x_path,
                                               y_path,
                                               mode=mode,
                                               **kwargs)
-
-        # use your own data loader
-        self.Loader = MultiEpochsDataLoader(self.image_loader,
-                                            batch_size=batch_size,
-                                            num_workers=num_workers,
-                                            shuffle=(not mode == 'validation'),
-                                            worker_init_fn=seed_worker,
-                                            generator=g,
-                                            pin_memory=pin_memory)
+        args = kwargs['args']
+
+        # native resolution images can only be batched together with images of similar size
+        if not hasattr(args, 'input_size') and batch_size > 1 and hasattr(args, 'bucket_batch') and args.bucket_batch:
+            image_sizes = self.image_loader.image_sizes(args.bucket_size_cache if hasattr(args, 'bucket_size_cache') else None)
+            batch_sampler = SizeBucketBatchSampler(image_sizes,
+                                                   batch_size=batch_size,
+                                                   shuffle=(not mode == 'validation'),
+                                                   drop_last=(not mode == 'validation'),    # avoid 1-sample remainders of each bucket for BN
+                                                   granularity=args.bucket_granularity if hasattr(args, 'bucket_granularity') else 32,
+                                                   generator=g)
+            self.Loader = MultiEpochsDataLoader(self.image_loader,
+                                                batch_sampler=batch_sampler,
+                                                num_workers=num_workers,
+                                                collate_fn=pad_collate,
+                                                worker_init_fn=seed_worker,
+                                                pin_memory=pin_memory,
+                                                **loader_kwargs)
+        else:
+            # use your own data loader
+            self.Loader = MultiEpochsDataLoader(self.image_loader,
+                                                batch_size=batch_size,
+                                                num_workers=num_workers,
+                                                shuffle=(not mode == 'validation'),
+                                                worker_init_fn=seed_worker,
+                                                generator=g,
+                                                pin_memory=pin_memory,
+                                                **loader_kwargs)
 
     def __len__(self):
         return self.Loader.__len__()
@@ -332,11 +626,15 @@ class Image2VectorDataLoader:
                  batch_size=4,
                  num_workers=0,
                  pin_memory=True,
+                 prefetch_factor=2,
                  **kwargs):
 
         g = torch.Generator()
         g.manual_seed(3407)
 
+        # 'prefetch_factor' is only valid with worker processes
+        loader_kwargs = {'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
+
         self.image_loader = Image2VectorLoader(csv_path,
                                                mode=mode,
                                                **kwargs)
@@ -348,7 +646,108 @@ class Image2VectorDataLoader:
                                             shuffle=(not mode == 'validation'),
                                             worker_init_fn=seed_worker,
                                             generator=g,
-                                            pin_memory=pin_memory)
+                                            pin_memory=pin_memory,
+                                            **loader_kwargs)
 
     def __len__(self):
         return self.Loader.__len__()
+
+
+_MmapRecord = collections.namedtuple('_MmapRecord', ['offset', 'shape', 'dtype'])
+
+
+class CachedBatchLoader:
+    """
+    Replays the batches of a deterministic loader (mode='validation') after the first full pass.
+
+    The first pass iterates 'loader' and keeps every batch. The storage is chosen from the size of the first batch times
+    the number of batches: on 'device' within 'device_budget_bytes', in pinned RAM within 'ram_budget_bytes', and in an
+    anonymous memory-mapped temporary file otherwise. Later passes only read the stored tensors.
+    """
+
+    def __init__(self, loader, device, device_budget_bytes=0, ram_budget_bytes=0, mmap_dir=None):
+        self.loader = loader
+        self.device = device
+        self.device_budget_bytes = device_budget_bytes
+        self.ram_budget_bytes = ram_budget_bytes
+        self.mmap_dir = mmap_dir
+
+        self.storage = None     # 'device', 'ram' or 'mmap'
+        self.batches = []
+        self.ready = False
+        self._mmap_file = None
+        self._mmap = None
+        self._mmap_offset = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.ready:
+            for batch in self.batches:
+                yield self._load(batch)
+            return
+
+        self.batches = []
+        for batch_idx, batch in enumerate(self.loader):
+            if batch_idx == 0:
+                self._set_storage(self._nbytes(batch) * len(self.loader))
+            self.batches.append(self._store(batch))
+            yield batch
+
+        if self.storage == 'mmap':
+            self._mmap_file.flush()
+            self._mmap = np.memmap(self._mmap_file, dtype=np.uint8, mode='r')
+        self.ready = True
+
+        cached_bytes = self._mmap_offset if self.storage == 'mmap' else self._nbytes(self.batches)
+        print(f'Batches cached on {self.storage} ({cached_bytes / 2 ** 20:.1f} MB)')
+
+    def _set_storage(self, estimated_bytes):
+        if estimated_bytes <= self.device_budget_bytes:
+            self.storage = 'device'
+        elif estimated_bytes <= self.ram_budget_bytes:
+            self.storage = 'ram'
+        else:
+            self.storage = 'mmap'
+            self.close()    # restart of an interrupted first pass
+            self._mmap_file = tempfile.TemporaryFile(dir=self.mmap_dir)
+            self._mmap_offset = 0
+
+    def _nbytes(self, item):
+        if torch.is_tensor(item):
+            return item.element_size() * item.nelement()
+        if isinstance(item, (list, tuple)):
+            return sum(self._nbytes(x) for x in item)
+        return 0
+
+    def _store(self, item):
+        if torch.is_tensor(item):
+            if self.storage == 'device':
+                return item.to(self.device)
+            if self.storage == 'ram':
+                return item.pin_memory() if self.device.type == 'cuda' else item.clone()
+
+            array = item.numpy()
+            self._mmap_file.write(array.tobytes())
+            record = _MmapRecord(self._mmap_offset, array.shape, array.dtype)
+            self._mmap_offset += array.nbytes
+            return record
+        if isinstance(item, (list, tuple)):
+            return type(item)(self._store(x) for x in item)
+        return item
+
+    def _load(self, item):
+        if isinstance(item, _MmapRecord):
+            nbytes = int(np.prod(item.shape)) * item.dtype.itemsize
+            array = self._mmap[item.offset:item.offset + nbytes].view(item.dtype).reshape(item.shape)
+            return torch.from_numpy(array.copy())
+        if isinstance(item, (list, tuple)):
+            return type(item)(self._load(x) for x in item)
+        return item
+
+    def close(self):
+        if self._mmap_file is not None:
+            self._mmap = None
+            self._mmap_file.close()
+            self._mmap_file = None
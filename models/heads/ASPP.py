@@ -40,7 +40,7 @@ class ASPP(nn.Module):
         out_3x3_3 = F.relu(self.bn_conv_3x3_3(self.conv_3x3_3(feature_map))) # (shape: (batch_size, 256, h/16, w/16))
 
         out_img = self.avg_pool(feature_map) # (shape: (batch_size, 512, 1, 1))
-        out_img = F.relu(self.bn_conv_1x1_2(self.conv_1x1_2(out_img))) # (shape: (batch_size, 256, 1, 1))
+        out_img = F.relu(self._image_pool_bn(self.conv_1x1_2(out_img))) # (shape: (batch_size, 256, 1, 1))
         out_img = F.upsample(out_img, size=(feature_map_h, feature_map_w), mode="bilinear") # (shape: (batch_size, 256, h/16, w/16))
 
         out = torch.cat([out_1x1, out_3x3_1, out_3x3_2, out_3x3_3, out_img], 1) # (shape: (batch_size, 1280, h/16, w/16))
@@ -49,6 +49,14 @@ class ASPP(nn.Module):
 
         return out
 
+    def _image_pool_bn(self, x):
+        # a single pooled sample has one value per channel, training statistics are undefined. use the running ones
+        if self.training and x.shape[0] == 1:
+            bn = self.bn_conv_1x1_2
+            return F.batch_norm(x, bn.running_mean, bn.running_var, bn.weight, bn.bias, training=False, eps=bn.eps)
+
+        return self.bn_conv_1x1_2(x)
+
 
 class ASPPBottleneck(nn.Module):
     def __init__(self, in_channel=2048, out_channel=256):
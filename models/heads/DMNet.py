@@ -2,12 +2,94 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from mmcv.cnn import ConvModule, build_activation_layer, build_norm_layer
 from abc import ABCMeta, abstractmethod
 
 # https://github.com/SwinTransformer/Swin-Transformer-Semantic-Segmentation/blob/main/mmseg/models/decode_heads/dm_head.py
 
 
+def build_norm_layer(cfg, num_features):
+    """(name, layer) of a norm config as in mmcv, e.g. dict(type='BN'), named as mmcv for loading mmseg checkpoints"""
+    cfg = dict(cfg)
+    layer_type = cfg.pop('type')
+    cfg.pop('requires_grad', None)
+
+    if layer_type == 'BN':
+        return 'bn', nn.BatchNorm2d(num_features, **cfg)
+    elif layer_type == 'SyncBN':
+        return 'bn', nn.SyncBatchNorm(num_features, **cfg)
+    elif layer_type == 'GN':
+        return 'gn', nn.GroupNorm(num_channels=num_features, **cfg)
+    else:
+        raise Exception('No norm layer named', layer_type)
+
+
+def build_activation_layer(cfg):
+    """Activation of a config as in mmcv, e.g. dict(type='ReLU'), any activation of torch.nn"""
+    cfg = dict(cfg)
+    layer_type = cfg.pop('type')
+    if not hasattr(nn, layer_type):
+        raise Exception('No activation layer named', layer_type)
+
+    return getattr(nn, layer_type)(**cfg)
+
+
+class ConvModule(nn.Module):
+    """conv / norm / activation block with the configs and parameter names of mmcv 'ConvModule'"""
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1,
+                 conv_cfg=None, norm_cfg=None, act_cfg=dict(type='ReLU')):
+        super(ConvModule, self).__init__()
+        if conv_cfg is not None and conv_cfg.get('type', 'Conv2d') != 'Conv2d':
+            raise Exception('No conv layer named', conv_cfg['type'])
+
+        self.conv = nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, dilation, groups,
+                              bias=norm_cfg is None)
+        self.norm_name = None
+        if norm_cfg is not None:
+            self.norm_name, norm = build_norm_layer(norm_cfg, out_channels)
+            self.add_module(self.norm_name, norm)
+        self.activate = build_activation_layer(act_cfg) if act_cfg is not None else None
+
+    @property
+    def norm(self):
+        return getattr(self, self.norm_name) if self.norm_name is not None else None
+
+    def forward(self, x):
+        x = self.conv(x)
+        if self.norm is not None:
+            x = self.norm(x)
+        if self.activate is not None:
+            x = self.activate(x)
+
+        return x
+
+
+def _norm_chunks(norms, x):
+    """Applies the norm layers to consecutive equal channel chunks of 'x', of one module each"""
+    if norms[0] is None:
+        return x
+
+    return torch.cat([norm(chunk) for norm, chunk in zip(norms, x.chunk(len(norms), dim=1))], dim=1)
+
+
+def _conv_modules_batched(conv_modules, x, groups=1):
+    """
+    Same structured ConvModules in a single conv, outputs concatenated along the channels.
+
+    :param groups: 1 to apply every module to 'x', or len(conv_modules) to apply each to its own channel chunk of 'x'
+    """
+    conv = conv_modules[0].conv
+    weight = torch.cat([m.conv.weight for m in conv_modules])
+    bias = torch.cat([m.conv.bias for m in conv_modules]) if conv.bias is not None else None
+
+    x = F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups * groups)
+    x = _norm_chunks([m.norm for m in conv_modules], x)
+    if conv_modules[0].activate is not None:
+        x = conv_modules[0].activate(x)
+
+    return x
+
+
 class BaseDecodeHead(nn.Module, metaclass=ABCMeta):
     """Base class for BaseDecodeHead.
 
@@ -123,7 +205,10 @@ class BaseDecodeHead(nn.Module, metaclass=ABCMeta):
             self.in_channels = in_channels
 
     def _transform_inputs(self, inputs):
-        inputs = [inputs[i] for i in self.in_index]
+        if isinstance(self.in_index, (list, tuple)):
+            inputs = [inputs[i] for i in self.in_index]
+        else:
+            inputs = inputs[self.in_index]
         """Transform inputs for decoder.
 
         Args:
@@ -274,13 +359,17 @@ class DMHead(BaseDecodeHead):
         filter_sizes (tuple[int]): The size of generated convolutional filters
             used in Dynamic Convolutional Module. Default: (1, 3, 5, 7).
         fusion (bool): Add one conv to fuse DCM output feature.
+        batched (bool): Run every DCM in one pass, see 'forward_dcm_batched'.
+            Meant for inference: the backward of the padded kernels is
+            slower than the loop on CPU. Default: False.
     """
 
-    def __init__(self, filter_sizes=(1, 3, 5, 7), fusion=False, **kwargs):
+    def __init__(self, filter_sizes=(1, 3, 5, 7), fusion=False, batched=False, **kwargs):
         super(DMHead, self).__init__(**kwargs)
         assert isinstance(filter_sizes, (list, tuple))
         self.filter_sizes = filter_sizes
         self.fusion = fusion
+        self.batched = batched
         dcm_modules = []
         for filter_size in self.filter_sizes:
             dcm_modules.append(
@@ -301,13 +390,106 @@ class DMHead(BaseDecodeHead):
             norm_cfg=self.norm_cfg,
             act_cfg=self.act_cfg)
 
+    def forward_dcm_batched(self, x):
+        """
+        Outputs of every DCM concatenated along the channels, as the loop over 'self.dcm_modules'.
+
+        The generated filters are zero-padded to a common size with the same alignment as the padding of each DCM,
+        so the dynamic convs of all filter sizes, samples and channels are a single grouped conv.
+        The 1x1 convs of the DCMs are stacked into single convs as well.
+
+        For inference: the padded kernels do more work than the loop, e.g. 4 x 49 instead of 1 + 9 + 25 + 49 taps for
+        (1, 3, 5, 7), which only pays off without a backward. It stays differentiable and matches the loop in training.
+        """
+        dcms = self.dcm_modules
+        b, _, h, w = x.shape
+        # a DCM of filter size k pads k // 2 before and (k - 1) // 2 after
+        left = max(dcm.filter_size // 2 for dcm in dcms)
+        right = max((dcm.filter_size - 1) // 2 for dcm in dcms)
+        size = left + right + 1
+
+        filters = []
+        for dcm in dcms:
+            k = dcm.filter_size
+            offset = left - k // 2
+            generated_filter = dcm.filter_gen_conv(F.adaptive_avg_pool2d(x, k))
+            filters.append(F.pad(generated_filter, (offset, size - offset - k, offset, size - offset - k)))
+        # [b * n * c, 1, size, size]
+        filters = torch.stack(filters, dim=1).view(-1, 1, size, size)
+
+        x = _conv_modules_batched([dcm.input_redu_conv for dcm in dcms], x)
+        # [1, b * n * c, h, w]
+        x = F.pad(x.view(1, -1, h, w), (left, right, left, right))
+        output = F.conv2d(x, filters, groups=filters.shape[0]).view(b, -1, h, w)
+
+        output = _norm_chunks([dcm.norm for dcm in dcms], output)
+        output = dcms[0].activate(output)
+        if self.fusion:
+            output = _conv_modules_batched([dcm.fusion_conv for dcm in dcms], output, groups=len(dcms))
+
+        return output
+
     def forward(self, inputs):
         """Forward function."""
         x = self._transform_inputs(inputs)
         dcm_outs = [x]
-        for dcm_module in self.dcm_modules:
-            dcm_outs.append(dcm_module(x))
+        if self.batched:
+            dcm_outs.append(self.forward_dcm_batched(x))
+        else:
+            for dcm_module in self.dcm_modules:
+                dcm_outs.append(dcm_module(x))
         dcm_outs = torch.cat(dcm_outs, dim=1)
         output = self.bottleneck(dcm_outs)
         output = self.cls_seg(output)
         return output
+
+
+def main():
+    import time
+
+    torch.manual_seed(0)
+
+    # parity of the batched DCMs with the loop, train mode with BN and fusion, outputs and gradients
+    head = DMHead(in_channels=64, channels=16, num_classes=5, dropout_ratio=0, fusion=True, norm_cfg=dict(type='BN'))
+    x = torch.rand(2, 64, 23, 31, requires_grad=True)
+    results = []
+    for batched in (False, True):
+        torch.manual_seed(0)
+        head_copy = DMHead(in_channels=64, channels=16, num_classes=5, dropout_ratio=0, fusion=True,
+                           norm_cfg=dict(type='BN'), batched=batched)
+        head_copy.load_state_dict(head.state_dict())
+        output = head_copy([x])
+        grads = torch.autograd.grad(output.square().sum(), [x] + list(head_copy.parameters()))
+        results.append((output, grads, head_copy.state_dict()))
+    (output, grads, states), (output_b, grads_b, states_b) = results
+    print('batched DCM: max abs error %.2e, gradients %.2e, running stats %.2e'
+          % ((output_b - output).abs().max().item(),
+             max((a - b).abs().max().item() for a, b in zip(grads_b, grads)),
+             max((states_b[k].float() - states[k].float()).abs().max().item() for k in states)))
+
+    # DCMs of a 512 channel feature map at 1/8 of 512x512, batch 2
+    head = DMHead(in_channels=512, channels=128, num_classes=19, norm_cfg=dict(type='BN'))
+    x = torch.rand(2, 512, 64, 64)
+    for train in (True, False):
+        head.train(train)
+        for batched in (False, True):
+
+            def step():
+                with torch.set_grad_enabled(train):
+                    if batched:
+                        output = head.forward_dcm_batched(x)
+                    else:
+                        output = torch.cat([dcm_module(x) for dcm_module in head.dcm_modules], dim=1)
+                    if train:
+                        output.mean().backward()
+
+            step()
+            tt = time.time()
+            for _ in range(5):
+                step()
+            print('batched=%s: %.1f ms / %s of the DCMs'
+                  % (batched, (time.time() - tt) / 5 * 1000, 'forward-backward' if train else 'forward'))
+
+
+if __name__ == '__main__':
+    main()
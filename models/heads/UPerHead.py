@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 
 from models.blocks.Blocks import Upsample
@@ -239,11 +240,15 @@ class M_UPerHead(BaseDecodeHead):
     Args:
         pool_scales (tuple[int]): Pooling scales used in Pooling Pyramid
             Module applied on the last feature. Default: (1, 2, 3, 6).
+        memory_efficient (bool): Apply the FPN bottleneck conv to each upsampled
+            level and accumulate, instead of concatenating every level at
+            the largest size. Default: False.
     """
 
-    def __init__(self, pool_scales=(1, 2, 3, 6), **kwargs):
+    def __init__(self, pool_scales=(1, 2, 3, 6), memory_efficient=False, **kwargs):
         super(M_UPerHead, self).__init__(
             input_transform='multiple_select', **kwargs)
+        self.memory_efficient = memory_efficient
         # PSP Module
         self.psp_modules = M_PPM(
             pool_scales,
@@ -299,6 +304,38 @@ class M_UPerHead(BaseDecodeHead):
 
         return output
 
+    def _bottleneck_accumulate(self, output, level, x):
+        """Adds the 'fpn_bottleneck' conv of the channels of FPN 'level' over the upsampled 'x' to 'output'."""
+        if output is not None and x.shape[2:] != output.shape[2:]:
+            x = Upsample(x, size=output.shape[2:])
+        weight = self.fpn_bottleneck.weight[:, level * self.channels:(level + 1) * self.channels]
+        y = F.conv2d(x, weight, None, self.fpn_bottleneck.stride, self.fpn_bottleneck.padding)
+
+        return y if output is None else output.add_(y)
+
+    def forward_memory_efficient(self, laterals):
+        """
+        Top-down path, FPN convs, concat and 'fpn_bottleneck' of 'forward', one level at a time.
+
+        The conv over the concatenated levels is the sum of the convs over the channels of each level,
+        so the (b, levels * channels, h, w) concat and the workspace of the wide conv are never allocated.
+        """
+        used_backbone_levels = len(laterals)
+        for i in range(used_backbone_levels - 1, 0, -1):
+            prev_shape = laterals[i - 1].shape[2:]
+            laterals[i - 1] = laterals[i - 1] + Upsample(laterals[i], size=prev_shape)
+
+        output = self._bottleneck_accumulate(None, 0, self.fpn_convs[0](laterals[0]))
+        for i in range(1, used_backbone_levels - 1):
+            output = self._bottleneck_accumulate(output, i, self.fpn_convs[i](laterals[i]))
+        # psp feature
+        output = self._bottleneck_accumulate(output, used_backbone_levels - 1, laterals[-1])
+
+        output = output + self.fpn_bottleneck.bias.view(1, -1, 1, 1)
+        output = self.cls_seg(output)
+
+        return output
+
     def forward(self, inputs):
         """Forward function."""
         inputs = self._transform_inputs(inputs)
@@ -311,6 +348,9 @@ class M_UPerHead(BaseDecodeHead):
 
         laterals.append(self.psp_forward(inputs))
 
+        if self.memory_efficient:
+            return self.forward_memory_efficient(laterals)
+
         # build top-down path
         used_backbone_levels = len(laterals)
         for i in range(used_backbone_levels - 1, 0, -1):
@@ -444,3 +484,65 @@ class M_UPerHead_no_seg(BaseDecodeHead):
 
         return output
 
+
+def _peak_memory(memory_efficient, full_resolution, size, batch_size=2, num_classes=19):
+    # increase of the peak resident memory during one training step of the Swin UPerHead on fixed features, in a fresh process
+    import resource
+    from models import utils
+
+    torch.manual_seed(0)
+    head = M_UPerHead(in_channels=[96, 192, 384, 768], in_index=[0, 1, 2, 3], channels=512, num_classes=num_classes,
+                      memory_efficient=memory_efficient)
+    inputs = [torch.rand(batch_size, c, size[0] // 2 ** (i + 2), size[1] // 2 ** (i + 2)) for i, c in enumerate(head.in_channels)]
+    target = torch.randint(0, num_classes, (batch_size, 1, *size))     # layout of the data loaders
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    output = head(inputs)
+    if full_resolution:
+        output = Upsample(output, size=size)
+    F.cross_entropy(output, utils.resize_target(target, output.shape[2:])[:, 0]).backward()
+
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+
+
+def main():
+    import multiprocessing
+    from models import utils
+
+    torch.manual_seed(0)
+
+    # parity of the memory efficient path, outputs and gradients
+    head = M_UPerHead(in_channels=[96, 192, 384, 768], in_index=[0, 1, 2, 3], channels=128, num_classes=5).eval()
+    inputs = [torch.rand(2, c, 64 // 2 ** i, 80 // 2 ** i, requires_grad=True) for i, c in enumerate(head.in_channels)]
+    results = []
+    for memory_efficient in (False, True):
+        head.memory_efficient = memory_efficient
+        output = head(inputs)
+        grads = torch.autograd.grad(output.square().sum(), inputs)
+        with torch.no_grad():
+            output_no_grad = head(inputs)
+        results.append((output, output_no_grad, grads))
+    (output, _, grads), (output_me, output_no_grad_me, grads_me) = results
+    print('memory efficient head: max abs error %.2e (autograd), %.2e (no grad), gradients %.2e'
+          % ((output_me - output).abs().max().item(), (output_no_grad_me - output).abs().max().item(),
+             max((a - b).abs().max().item() for a, b in zip(grads_me, grads))))
+
+    # loss target and metric class map of 1/4 resolution logits, with the (b, 1, h, w) targets of the data loaders
+    target = torch.randint(0, 5, (2, 1, 256, 320))
+    target_low = utils.resize_target(target, output.shape[2:])
+    argmax = utils.upsampled_argmax(output, target.shape[-2:])
+    print('1/4 resolution logits %s: loss target %s, class map %s. full resolution: target unchanged %s, class map %s'
+          % (tuple(output.shape), tuple(target_low.shape), tuple(argmax.shape),
+             utils.resize_target(target, target.shape[-2:]) is target,
+             tuple(utils.upsampled_argmax(Upsample(output, size=(256, 320)), target.shape[-2:]).shape)))
+
+    # peak memory of a head training step, batch 2 at 512x512 and 19 classes
+    pool = multiprocessing.get_context('fork').Pool(1, maxtasksperchild=1)
+    for memory_efficient, full_resolution in ((False, True), (True, True), (True, False)):
+        peak = pool.apply(_peak_memory, (memory_efficient, full_resolution, (512, 512)))
+        print('memory_efficient=%s full_resolution=%s: +%.1f MB peak memory' % (memory_efficient, full_resolution, peak))
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,10 @@ import torch.nn as nn
 import numpy as np
 import cv2 as cv
 import torch.nn.functional as F
+import time
+import math
 
-from scipy.ndimage.morphology import distance_transform_edt as edt
-from scipy.ndimage import convolve
+from models import utils
 
 
 class CrossEntropy(nn.Module):
@@ -19,6 +20,49 @@ class CrossEntropy(nn.Module):
         return self.loss(x, y)
 
 
+class OHEMCrossEntropy(nn.Module):
+    """
+    Online hard example mining cross entropy. Averages only the hardest pixels of each image.
+
+    Without 'threshold', keeps the top 'top_k' ratio of pixel losses per image (torch.topk, no full sort).
+    With 'threshold', keeps every pixel whose target probability is below it, and at least the top 'top_k' ratio.
+    """
+
+    def __init__(self, top_k=0.25, threshold=None, class_weight=None, ignore_index=-100):
+        super(OHEMCrossEntropy, self).__init__()
+        self.top_k = top_k
+        self.threshold = threshold
+        self.ignore_index = ignore_index
+        self.register_buffer('class_weight', torch.tensor(class_weight, dtype=torch.float) if class_weight is not None else None)
+
+    def forward(self, x, y):
+        if y.dim() == x.dim():
+            y = y.squeeze(1)
+
+        # hard pixels are selected by the unweighted loss -log p_target, the class weights only apply to the mean
+        pixel_loss = F.cross_entropy(x, y, ignore_index=self.ignore_index, reduction='none').flatten(1)
+
+        # weight of each pixel in the mean, 0 for ignored pixels
+        valid = y != self.ignore_index
+        if self.class_weight is not None:
+            pixel_weight = (self.class_weight[torch.where(valid, y, torch.zeros_like(y))] * valid).flatten(1)
+        else:
+            pixel_weight = valid.flatten(1).to(pixel_loss.dtype)
+
+        k = max(int(pixel_loss.shape[1] * self.top_k), 1)
+        hard_loss, hard_idx = pixel_loss.topk(k, dim=1, sorted=False)
+
+        if self.threshold is None:
+            hard_weight = pixel_weight.gather(1, hard_idx)
+            return (hard_loss * hard_weight).sum() / hard_weight.sum().clamp(min=1e-12)
+
+        # keep the pixels above the loss threshold, or the top k if there are fewer of them
+        kth_loss = hard_loss.amin(dim=1, keepdim=True)
+        keep_weight = pixel_weight * (pixel_loss >= kth_loss.clamp(max=-math.log(self.threshold)))
+
+        return (pixel_loss * keep_weight).sum() / keep_weight.sum().clamp(min=1e-12)
+
+
 class FocalLoss(nn.Module):
     """
     Multi-class Focal loss implementation
@@ -78,16 +122,8 @@ class DTMSELoss(nn.Module):
         self.mse = nn.MSELoss()
 
     @torch.no_grad()
-    def distance_field(self, img: np.ndarray) -> np.ndarray:
-        field = np.zeros_like(img)
-
-        for batch in range(len(img)):
-            img_mask = img[batch] > self.threshold
-            img_mask_dt = edt(img_mask)
-
-            field[batch] = img_mask_dt
-
-        return field
+    def distance_field(self, img: torch.Tensor) -> torch.Tensor:
+        return utils.distance_transform_edt(img > self.threshold)
 
     def forward(self, pred: torch.Tensor, target: torch.Tensor, debug=False) -> torch.Tensor:
         """
@@ -100,8 +136,8 @@ class DTMSELoss(nn.Module):
             pred.dim() == target.dim()
         ), "Prediction and target need to be of same dimension"
 
-        pred_dt = torch.from_numpy(self.distance_field(pred.cpu().detach().numpy())).float()
-        target_dt = torch.from_numpy(self.distance_field(target.cpu().detach().numpy())).float()
+        pred_dt = self.distance_field(pred.detach())
+        target_dt = self.distance_field(target.detach())
 
         loss = self.mse(pred_dt, target_dt)
 
@@ -113,24 +149,18 @@ class HausdorffDTLoss(nn.Module):
 
     def __init__(self, alpha=2.0, **kwargs):
         super(HausdorffDTLoss, self).__init__()
-        self.alpha = torch.tensor(alpha)
+        self.alpha = alpha
 
     @torch.no_grad()
-    def distance_field(self, img: np.ndarray) -> np.ndarray:
-        field = np.zeros_like(img)
-
-        for batch in range(len(img)):
-            fg_mask = img[batch] > 0.5
-
-            if fg_mask.any():
-                bg_mask = ~fg_mask
+    def distance_field(self, img: torch.Tensor) -> torch.Tensor:
+        fg_mask = img > 0.5
+        fg_dist, bg_dist = utils.distance_transform_edt(torch.cat([fg_mask, ~fg_mask], 1)).chunk(2, 1)
+        field = fg_dist + bg_dist
 
-                fg_dist = edt(fg_mask)
-                bg_dist = edt(bg_mask)
+        # samples without foreground get no distance field
+        has_fg = fg_mask.flatten(1).any(1).view(-1, *[1] * (img.dim() - 1))
 
-                field[batch] = fg_dist + bg_dist
-
-        return field
+        return field * has_fg
 
     def forward(
         self, pred: torch.Tensor, target: torch.Tensor, debug=False
@@ -145,13 +175,13 @@ class HausdorffDTLoss(nn.Module):
             pred.dim() == target.dim()
         ), "Prediction and target need to be of same dimension"
 
-        pred_dt = torch.from_numpy(self.distance_field(pred.cpu().detach().numpy())).float()
-        target_dt = torch.from_numpy(self.distance_field(target.cpu().detach().numpy())).float()
+        pred_dt = self.distance_field(pred.detach())
+        target_dt = self.distance_field(target.detach())
 
         pred_error = (pred - target) ** 2
         distance = pred_dt ** self.alpha + target_dt ** self.alpha
 
-        dt_field = pred_error.cpu() * distance.cpu()
+        dt_field = pred_error * distance
         loss = dt_field.mean()
 
         if debug:
@@ -173,62 +203,62 @@ class HausdorffDTLoss(nn.Module):
 class HausdorffERLoss(nn.Module):
     """Binary Hausdorff loss based on morphological erosion"""
 
-    def __init__(self, alpha=2.0, erosions=10, **kwargs):
+    def __init__(self, alpha=2.0, erosions=10, differentiable=False, **kwargs):
         super(HausdorffERLoss, self).__init__()
         self.alpha = alpha
         self.erosions = erosions
+        self.differentiable = differentiable    # backpropagate through the erosions, otherwise a constant loss
         self.prepare_kernels()
 
     def prepare_kernels(self):
-        cross = np.array([cv.getStructuringElement(cv.MORPH_CROSS, (3, 3))])
-        bound = np.array([[[0, 0, 0], [0, 1, 0], [0, 0, 0]]])
+        cross = torch.from_numpy(cv.getStructuringElement(cv.MORPH_CROSS, (3, 3))).float()
+        bound = torch.zeros((3, 3))
+        bound[1, 1] = 1
 
-        self.kernel2D = cross * 0.2
-        self.kernel3D = np.array([bound, cross, bound]) * (1 / 7)
+        self.kernel2D = (cross * 0.2)[None, None]
+        self.kernel3D = (torch.stack([bound, cross, bound]) * (1 / 7))[None, None]
 
-    @torch.no_grad()
-    def perform_erosion(
-        self, pred: np.ndarray, target: np.ndarray, debug
-    ) -> np.ndarray:
+    def perform_erosion(self, pred: torch.Tensor, target: torch.Tensor, debug) -> torch.Tensor:
         bound = (pred - target) ** 2
 
-        if bound.ndim == 5:
-            kernel = self.kernel3D
-        elif bound.ndim == 4:
-            kernel = self.kernel2D
+        if bound.dim() == 5:
+            kernel, conv = self.kernel3D, F.conv3d
+        elif bound.dim() == 4:
+            kernel, conv = self.kernel2D, F.conv2d
         else:
-            raise ValueError(f"Dimension {bound.ndim} is nor supported.")
+            raise ValueError(f"Dimension {bound.dim()} is nor supported.")
 
-        eroted = np.zeros_like(bound)
-        erosions = []
+        channels = bound.shape[1]
+        kernel = kernel.to(bound).expand(channels, *kernel.shape[1:])
+        reduce_dims = tuple(range(1, bound.dim()))
 
-        for batch in range(len(bound)):
+        eroted = torch.zeros_like(bound)
+        if debug:
+            erosions = [bound[:, 0].detach().cpu().numpy()]
 
-            # debug
-            erosions.append(np.copy(bound[batch][0]))
+        for k in range(self.erosions):
 
-            for k in range(self.erosions):
+            # compute convolution with kernel, each channel on its own
+            dilation = conv(bound, kernel, padding=1, groups=channels)
 
-                # compute convolution with kernel
-                dilation = convolve(bound[batch], kernel, mode="constant", cval=0.0)
+            # apply soft thresholding at 0.5 and normalize each sample
+            erosion = (dilation - 0.5).clamp(min=0)
 
-                # apply soft thresholding at 0.5 and normalize
-                erosion = dilation - 0.5
-                erosion[erosion < 0] = 0
+            e_min = erosion.amin(dim=reduce_dims, keepdim=True)
+            e_ptp = erosion.amax(dim=reduce_dims, keepdim=True) - e_min
+            flat = e_ptp == 0   # left as is
+            erosion = (erosion - e_min.masked_fill(flat, 0)) / e_ptp.masked_fill(flat, 1)
 
-                if erosion.ptp() != 0:
-                    erosion = (erosion - erosion.min()) / erosion.ptp()
+            # save erosion and add to loss
+            bound = erosion
+            eroted = torch.add(eroted, erosion, alpha=(k + 1) ** self.alpha)
 
-                # save erosion and add to loss
-                bound[batch] = erosion
-                eroted[batch] += erosion * (k + 1) ** self.alpha
-
-                if debug:
-                    erosions.append(np.copy(erosion[0]))
+            if debug:
+                erosions.append(erosion[:, 0].detach().cpu().numpy())
 
-        # image visualization in debug mode
+        # image visualization in debug mode, ordered by sample
         if debug:
-            return eroted, erosions
+            return eroted, [erosion[batch] for batch in range(len(eroted)) for erosion in erosions]
         else:
             return eroted
 
@@ -247,20 +277,21 @@ class HausdorffERLoss(nn.Module):
 
         # pred = torch.sigmoid(pred)
 
-        if debug:
-            eroted, erosions = self.perform_erosion(
-                pred.cpu().numpy(), target.cpu().numpy(), debug
-            )
-            return eroted.mean(), erosions
+        target = target.detach().to(pred.dtype)
+        if not self.differentiable:
+            pred = pred.detach()
 
-        else:
-            eroted = torch.from_numpy(
-                self.perform_erosion(pred.cpu().numpy(), target.cpu().detach().numpy(), debug)
-            ).float()
+        with torch.set_grad_enabled(self.differentiable and torch.is_grad_enabled()):
+            if debug:
+                eroted, erosions = self.perform_erosion(pred, target, debug)
+                return eroted.mean(), erosions
 
-            loss = eroted.mean()
+            else:
+                eroted = self.perform_erosion(pred, target, debug)
 
-            return loss
+                loss = eroted.mean()
+
+                return loss
 
 
 # https://www.kaggle.com/code/bigironsphere/loss-function-library-keras-pytorch/notebook
@@ -415,6 +446,114 @@ class FocalTverskyLoss(nn.Module):
         return FocalTversky
 
 
+class CompoundLoss(nn.Module):
+    """
+    Weighted sum of CE, Focal, Dice, Jaccard, Tversky and FocalTversky losses over shared statistics.
+
+    The activation is computed once, and the per-class TP/FP/FN come from a single reduction of the probabilities at
+    the target class, without one-hot targets.
+    'softmax' takes logits (b, c, ...) and class indices (b, ...) or (b, 1, ...), pixels of 'ignore_index' excluded.
+    'sigmoid' takes logits (b, c, ...) and binary targets of the same shape, for binary or multi-label masks.
+    """
+
+    losses = ['CE', 'Focal', 'Dice', 'Jaccard', 'Tversky', 'FocalTversky']
+
+    def __init__(self, weights=None, activation='softmax', class_weight=None, smooth=1, alpha=0.5, beta=0.5,
+                 gamma=2, tversky_gamma=1, ignore_index=-100):
+        super(CompoundLoss, self).__init__()
+        self.weights = weights if weights is not None else {'CE': 1.0, 'Dice': 1.0}
+        self.activation = activation
+        self.smooth = smooth
+        self.alpha = alpha  # Tversky FP weight
+        self.beta = beta    # Tversky FN weight
+        self.gamma = gamma  # Focal
+        self.tversky_gamma = tversky_gamma
+        self.ignore_index = ignore_index
+        self.register_buffer('class_weight', torch.tensor(class_weight, dtype=torch.float) if class_weight is not None else None)
+
+        for name in self.weights.keys():
+            if name not in self.losses:
+                raise Exception('No loss named', name)
+        if activation not in ['softmax', 'sigmoid']:
+            raise Exception('No activation named', activation)
+
+    def forward(self, x, y):
+        if self.activation == 'softmax':
+            log_pt, tp, p_sum, t_sum, valid, y = self._statistics_softmax(x, y)
+        else:
+            log_pt, tp, p_sum, t_sum, valid = self._statistics_sigmoid(x, y)
+
+        fp = p_sum - tp
+        fn = t_sum - tp
+        loss = 0
+
+        if 'CE' in self.weights or 'Focal' in self.weights:
+            weight = valid
+            if self.class_weight is not None and self.activation == 'softmax':
+                weight = self.class_weight[y] * valid    # 'y' of the statistics, squeezed and ignored pixels at 0
+            norm = weight.sum().clamp(min=1e-12)
+
+            if 'CE' in self.weights:
+                loss = loss + self.weights['CE'] * -(log_pt * weight).sum() / norm
+            if 'Focal' in self.weights:
+                loss = loss + self.weights['Focal'] * -((1 - log_pt.exp()) ** self.gamma * log_pt * weight).sum() / norm
+
+        if 'Dice' in self.weights:
+            dice = (2 * tp + self.smooth) / (2 * tp + fp + fn + self.smooth)
+            loss = loss + self.weights['Dice'] * self._class_mean(1 - dice)
+        if 'Jaccard' in self.weights:
+            iou = (tp + self.smooth) / (tp + fp + fn + self.smooth)
+            loss = loss + self.weights['Jaccard'] * self._class_mean(1 - iou)
+        if 'Tversky' in self.weights or 'FocalTversky' in self.weights:
+            tversky = (tp + self.smooth) / (tp + self.alpha * fp + self.beta * fn + self.smooth)
+            if 'Tversky' in self.weights:
+                loss = loss + self.weights['Tversky'] * self._class_mean(1 - tversky)
+            if 'FocalTversky' in self.weights:
+                loss = loss + self.weights['FocalTversky'] * self._class_mean((1 - tversky) ** self.tversky_gamma)
+
+        return loss
+
+    def _statistics_softmax(self, x, y):
+        n_classes = x.shape[1]
+        if y.dim() == x.dim():
+            y = y.squeeze(1)
+        if x.dim() == 2:    # classification, (b, c)
+            x, y = x.unsqueeze(-1), y.unsqueeze(-1)
+        valid = (y != self.ignore_index)
+        y = torch.where(valid, y, torch.zeros_like(y))
+
+        log_p = F.log_softmax(x, dim=1)
+        log_pt = log_p.gather(1, y.unsqueeze(1)).squeeze(1)
+        valid = valid.to(log_pt.dtype)
+
+        # per-class sums of the probability at the target class, all probabilities and the target pixels
+        tp = torch.zeros(n_classes, dtype=log_pt.dtype, device=x.device).index_add_(0, y.flatten(), (log_pt.exp() * valid).flatten())
+        p_sum = torch.einsum('bcn,bn->c', log_p.exp().flatten(2), valid.flatten(1))
+        t_sum = torch.bincount(y.flatten(), weights=valid.flatten(), minlength=n_classes).to(log_pt.dtype)
+
+        return log_pt, tp, p_sum, t_sum, valid, y
+
+    def _statistics_sigmoid(self, x, y):
+        y = y.to(x.dtype).view_as(x)
+        dims = [0] + list(range(2, x.dim()))
+
+        # log(pt) of the binary cross entropy, pt = p if y = 1 else 1 - p
+        log_pt = -F.binary_cross_entropy_with_logits(x, y, reduction='none')
+        p = torch.sigmoid(x)
+
+        tp = (p * y).sum(dims)
+        p_sum = p.sum(dims)
+        t_sum = y.sum(dims)
+
+        return log_pt, tp, p_sum, t_sum, torch.ones_like(log_pt)
+
+    def _class_mean(self, value):
+        if self.class_weight is not None and len(self.class_weight) == len(value):
+            return (value * self.class_weight).sum() / self.class_weight.sum()
+
+        return value.mean()
+
+
 class JSDivergence(nn.Module):
     def __init__(self, reduction='batchmean'):
         super(JSDivergence, self).__init__()
@@ -492,3 +631,144 @@ class MSELoss_SSL(nn.Module):
             losses = [self.softmax_mse_loss(x[idx], y)]
 
         return sum(losses) / x_b
+
+
+def main():
+    from scipy.ndimage import distance_transform_edt as edt
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # parity of the torch distance transform with scipy, 2D and 3D
+    for shape in [(4, 1, 64, 48), (2, 1, 24, 20, 16)]:
+        mask = torch.rand(shape) > 0.3
+        mask[:, :, 0] = False   # scipy is undefined for masks without background
+        dt = utils.distance_transform_edt(mask.to(device)).cpu()
+        dt_scipy = np.stack([edt(m) for m in mask.numpy().reshape(-1, *shape[2:])]).reshape(shape)
+        print(f'distance_transform_edt {shape}: max abs error {np.abs(dt.numpy() - dt_scipy).max():.2e}')
+
+    # distance transform losses, batch 16 at 640x480
+    pred = torch.rand((16, 1, 480, 640), device=device)
+    target = (torch.rand((16, 1, 480, 640), device=device) > 0.5).float()
+
+    for criterion in [DTMSELoss(), HausdorffDTLoss()]:
+        criterion(pred, target)     # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        tt = time.perf_counter()
+        criterion(pred, target)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        print(f'{criterion.__class__.__name__} ({device.type}): {(time.perf_counter() - tt) * 1000:.1f} ms')
+
+    tt = time.perf_counter()
+    for m in (target.cpu().numpy()[:, 0] > 0.5):
+        edt(m)
+        edt(~m)
+    print(f'scipy edt, HausdorffDTLoss fields of target (cpu): {(time.perf_counter() - tt) * 1000:.1f} ms')
+
+    # fused compound loss against the separate losses on one-hot targets
+    logit = torch.randn((16, 4, 480, 640), device=device, requires_grad=True)
+    label = torch.randint(0, 4, (16, 480, 640), device=device)
+
+    def dice_ce_separate(x, y):
+        prob = F.softmax(x, dim=1)
+        one_hot = F.one_hot(y, x.shape[1]).permute(0, 3, 1, 2).float()
+        dice = sum(DiceLoss()(prob[:, c].contiguous(), one_hot[:, c].contiguous()) for c in range(x.shape[1])) / x.shape[1]
+        return F.cross_entropy(x, y) + dice
+
+    for name, criterion in [('separate CE + Dice', dice_ce_separate), ('CompoundLoss CE + Dice', CompoundLoss({'CE': 1.0, 'Dice': 1.0}).to(device))]:
+        criterion(logit, label).backward()     # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        tt = time.perf_counter()
+        loss = criterion(logit, label)
+        loss.backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        peak = f', peak {torch.cuda.max_memory_allocated(device) / 2 ** 20:.0f} MB' if device.type == 'cuda' else ''
+        print(f'{name}: {loss.item():.6f} ({device.type}, {(time.perf_counter() - tt) * 1000:.1f} ms forward + backward{peak})')
+
+    # class weighted CE with the (b, 1, h, w) targets of the data loaders
+    class_weight = [1, 3, 0.2, 1]
+    loss = CompoundLoss({'CE': 1.0}, class_weight=class_weight).to(device)(logit, label.unsqueeze(1))
+    loss_ref = F.cross_entropy(logit, label, weight=torch.tensor(class_weight, device=device))
+    print(f'CompoundLoss class weighted CE: {loss.item():.6f}, F.cross_entropy {loss_ref.item():.6f}')
+
+    # hard pixel mining against plain cross entropy
+    for name, criterion in [('CrossEntropy', CrossEntropy()), ('OHEMCrossEntropy top_k 0.25', OHEMCrossEntropy(top_k=0.25)),
+                            ('OHEMCrossEntropy threshold 0.7', OHEMCrossEntropy(top_k=0.05, threshold=0.7))]:
+        criterion = criterion.to(device)
+        criterion(logit, label).backward()     # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        tt = time.perf_counter()
+        loss = criterion(logit, label)
+        loss.backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        print(f'{name}: {loss.item():.6f} ({device.type}, {(time.perf_counter() - tt) * 1000:.1f} ms forward + backward)')
+
+    # class weighted hard pixel mining against a full sort of the unweighted pixel losses
+    def ohem_sorted(x, y, top_k, threshold, weight):
+        pixel_loss = F.cross_entropy(x, y, reduction='none').flatten(1)
+        pixel_weight = weight[y].flatten(1)
+        losses, weights = [], []
+        for loss_b, weight_b in zip(pixel_loss, pixel_weight):
+            order = loss_b.argsort(descending=True)
+            n_keep = max(int(len(order) * top_k), 1)
+            if threshold is not None:
+                n_keep = max(n_keep, int((loss_b > -math.log(threshold)).sum()))
+            losses.append((loss_b * weight_b)[order[:n_keep]].sum())
+            weights.append(weight_b[order[:n_keep]].sum())
+        return sum(losses) / sum(weights)
+
+    weight = torch.tensor(class_weight, device=device)
+    for top_k, threshold in [(0.25, None), (0.05, 0.7)]:
+        loss = OHEMCrossEntropy(top_k=top_k, threshold=threshold, class_weight=class_weight).to(device)(logit, label)
+        loss_ref = ohem_sorted(logit, label, top_k, threshold, weight)
+        print(f'OHEMCrossEntropy class weighted top_k {top_k} threshold {threshold}: {loss.item():.6f}, sorted {loss_ref.item():.6f}')
+
+    # erosion loss against the per-sample scipy loop
+    def perform_erosion_scipy(pred, target, alpha=2.0, erosions=10):
+        kernel = np.array([cv.getStructuringElement(cv.MORPH_CROSS, (3, 3))]) * 0.2
+        bound = (pred - target) ** 2
+        eroted = np.zeros_like(bound)
+        for batch in range(len(bound)):
+            for k in range(erosions):
+                erosion = convolve(bound[batch], kernel, mode="constant", cval=0.0) - 0.5
+                erosion[erosion < 0] = 0
+                if np.ptp(erosion) != 0:
+                    erosion = (erosion - erosion.min()) / np.ptp(erosion)
+                bound[batch] = erosion
+                eroted[batch] += erosion * (k + 1) ** alpha
+        return eroted
+
+    from scipy.ndimage import convolve
+
+    criterion = HausdorffERLoss()
+    pred_np, target_np = pred.cpu().numpy(), target.cpu().numpy()
+
+    tt = time.perf_counter()
+    loss_scipy = perform_erosion_scipy(pred_np, target_np).mean()
+    time_scipy = time.perf_counter() - tt
+
+    criterion(pred, target)     # warmup
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    tt = time.perf_counter()
+    loss = criterion(pred, target)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    time_torch = time.perf_counter() - tt
+
+    print(f'HausdorffERLoss: scipy {loss_scipy:.6f} ({time_scipy * 1000:.1f} ms), '
+          f'torch {loss.item():.6f} ({device.type}, {time_torch * 1000:.1f} ms)')
+
+    pred.requires_grad_(True)
+    HausdorffERLoss(differentiable=True)(pred, target).backward()
+    print(f'HausdorffERLoss (differentiable): grad norm {pred.grad.norm().item():.4e}')
+
+
+if __name__ == '__main__':
+    main()
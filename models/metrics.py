@@ -1,11 +1,15 @@
 import torch
 import torch.nn.functional as F
 import math
+import os
 import numpy as np
 
 from torch.autograd import Variable
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.metrics import cohen_kappa_score, accuracy_score
 from scipy.ndimage.morphology import distance_transform_edt as edt
+from scipy.ndimage import binary_erosion
+from models import utils
 
 
 class SSIM(torch.nn.Module):
@@ -204,6 +208,284 @@ class StreamSegMetrics_segmentation(_StreamMetrics):
         self.confusion_matrix = np.zeros((self.n_classes, self.n_classes))
 
 
+class StreamHausdorffMetrics(_StreamMetrics):
+    """
+    Per-class Hausdorff distance (HD) and its 95th percentile (HD95) for semantic segmentation, computed for every
+    sample and averaged over the samples. Only the sums are kept, not the distances of each sample.
+
+    Distances are taken between the surfaces of the prediction and the target as in medpy, in pixels.
+    A class absent in both prediction and target is skipped; a class present in only one of them counts as the
+    diagonal of the image. The 'thread' backend runs scipy's EDT on cropped masks in a thread pool, the 'torch'
+    backend runs the batched torch EDT on the device of the labels. Call 'close' to shut the thread pool down.
+    """
+
+    def __init__(self, n_classes, backend='thread', num_workers=None, include_background=False):
+        self.n_classes = n_classes
+        self.backend = backend
+        self.classes = list(range(0 if include_background else 1, n_classes))
+        self.pool = ThreadPoolExecutor(num_workers or os.cpu_count()) if backend == 'thread' else None
+
+        if backend not in ['thread', 'torch']:
+            raise Exception('No backend named', backend)
+
+        self.hd_sum = np.zeros(n_classes)
+        self.hd95_sum = np.zeros(n_classes)
+        self.count = np.zeros(n_classes)
+        self.metric_dict = {
+            "Mean HD": 0,
+            "Mean HD95": 0,
+            "Class HD": 0,
+            "Class HD95": 0
+        }
+
+    def update(self, label_trues, label_preds):
+        """
+        :param label_trues: (b, x, y) or (b, x, y, z) class indices, numpy array or tensor. a channel dim of size 1,
+            e.g. (b, 1, x, y) of the data loaders, is squeezed
+        :param label_preds: same as label_trues
+        """
+        label_trues = self._squeeze_channel(label_trues, label_preds)
+        label_preds = self._squeeze_channel(label_preds, label_trues)
+
+        if self.backend == 'torch':
+            results = self._update_torch(torch.as_tensor(label_trues), torch.as_tensor(label_preds))
+        else:
+            label_trues = label_trues.cpu().numpy() if torch.is_tensor(label_trues) else np.asarray(label_trues)
+            label_preds = label_preds.cpu().numpy() if torch.is_tensor(label_preds) else np.asarray(label_preds)
+            results = self._update_thread(label_trues, label_preds)
+
+        for cls, hd, hd95 in results:
+            self.hd_sum[cls] += hd
+            self.hd95_sum[cls] += hd95
+            self.count[cls] += 1
+
+    @staticmethod
+    def _squeeze_channel(labels, other):
+        if labels.ndim == other.ndim + 1 and labels.shape[1] == 1:
+            labels = labels[:, 0]
+
+        return labels
+
+    def _update_thread(self, label_trues, label_preds):
+        jobs = []
+        for lt, lp in zip(label_trues, label_preds):
+            present_true = np.bincount(lt[lt >= 0].ravel(), minlength=self.n_classes) > 0
+            present_pred = np.bincount(lp.ravel(), minlength=self.n_classes) > 0
+            diagonal = np.sqrt(np.sum(np.square(lt.shape)))
+
+            for cls in self.classes:
+                if not present_true[cls] and not present_pred[cls]:
+                    continue
+                elif present_true[cls] != present_pred[cls]:
+                    jobs.append((cls, diagonal, diagonal))
+                else:
+                    jobs.append((cls, self.pool.submit(self._hausdorff_np, lt == cls, lp == cls)))
+
+        return [job if len(job) == 3 else (job[0], *job[1].result()) for job in jobs]
+
+    @staticmethod
+    def _hausdorff_np(mask_true, mask_pred):
+        # crop to the bounding box of both masks. nearest surface points are always inside of it
+        union = mask_true | mask_pred
+        crop = []
+        for axis in range(union.ndim):
+            nonzero = np.flatnonzero(union.any(axis=tuple(i for i in range(union.ndim) if i != axis)))
+            crop.append(slice(max(nonzero[0] - 1, 0), nonzero[-1] + 2))
+        mask_true, mask_pred = mask_true[tuple(crop)], mask_pred[tuple(crop)]
+
+        surface_true = mask_true & ~binary_erosion(mask_true)
+        surface_pred = mask_pred & ~binary_erosion(mask_pred)
+
+        dist_pred_to_true = edt(~surface_true)[surface_pred]
+        dist_true_to_pred = edt(~surface_pred)[surface_true]
+
+        hd = max(dist_pred_to_true.max(), dist_true_to_pred.max())
+        hd95 = max(np.percentile(dist_pred_to_true, 95), np.percentile(dist_true_to_pred, 95))
+
+        return hd, hd95
+
+    def _update_torch(self, label_trues, label_preds):
+        label_preds = label_preds.to(label_trues.device)
+        diagonal = math.sqrt(sum(size ** 2 for size in label_trues.shape[1:]))
+        dims = tuple(range(1, label_trues.dim()))
+
+        classes = torch.tensor(self.classes, device=label_trues.device).view(1, -1, *[1] * len(dims))
+        mask_true = label_trues.unsqueeze(1) == classes     # (b, c, ...)
+        mask_pred = label_preds.unsqueeze(1) == classes
+        present_true = mask_true.flatten(2).any(2).cpu()
+        present_pred = mask_pred.flatten(2).any(2).cpu()
+
+        surface_true = mask_true & ~self._erosion_torch(mask_true)
+        surface_pred = mask_pred & ~self._erosion_torch(mask_pred)
+        dist_to_true = utils.distance_transform_edt(~surface_true)
+        dist_to_pred = utils.distance_transform_edt(~surface_pred)
+
+        results, values = [], []
+        for batch in range(len(label_trues)):
+            for idx, cls in enumerate(self.classes):
+                if not present_true[batch, idx] and not present_pred[batch, idx]:
+                    continue
+                elif present_true[batch, idx] != present_pred[batch, idx]:
+                    results.append((cls, diagonal, diagonal))
+                else:
+                    dist_pred_to_true = dist_to_true[batch, idx][surface_pred[batch, idx]]
+                    dist_true_to_pred = dist_to_pred[batch, idx][surface_true[batch, idx]]
+                    values.append((cls, torch.stack([torch.maximum(dist_pred_to_true.max(), dist_true_to_pred.max()),
+                                                     torch.maximum(torch.quantile(dist_pred_to_true, 0.95),
+                                                                   torch.quantile(dist_true_to_pred, 0.95))])))
+
+        if values:
+            hd_list = torch.stack([value for _, value in values]).tolist()   # one device sync
+            results += [(cls, hd, hd95) for (cls, _), (hd, hd95) in zip(values, hd_list)]
+
+        return results
+
+    @staticmethod
+    def _erosion_torch(mask):
+        """Binary erosion with the cross structure and zero border, as 'scipy.ndimage.binary_erosion'"""
+        spatial = mask.dim() - 2
+        padded = F.pad(mask, [1, 1] * spatial, value=False)
+        center = [slice(None)] * 2 + [slice(1, -1)] * spatial
+
+        eroded = mask.clone()
+        for axis in range(2, mask.dim()):
+            for shift in [slice(0, -2), slice(2, None)]:
+                neighbor = list(center)
+                neighbor[axis] = shift
+                eroded &= padded[tuple(neighbor)]
+        return eroded
+
+    @staticmethod
+    def to_str(results):
+        string = "\n"
+        for k, v in results.items():
+            if k not in ["Class HD", "Class HD95"]:
+                string += "%s: %f\n" % (k, v)
+
+        return string
+
+    def get_results(self):
+        count = np.where(self.count > 0, self.count, np.nan)
+        hd = self.hd_sum / count
+        hd95 = self.hd95_sum / count
+
+        self.metric_dict['Mean HD'] = np.nanmean(hd[self.classes]) if (self.count[self.classes] > 0).any() else np.nan
+        self.metric_dict['Mean HD95'] = np.nanmean(hd95[self.classes]) if (self.count[self.classes] > 0).any() else np.nan
+        self.metric_dict['Class HD'] = dict(zip(self.classes, hd[self.classes]))
+        self.metric_dict['Class HD95'] = dict(zip(self.classes, hd95[self.classes]))
+
+        return self.metric_dict
+
+    def reset(self):
+        self.hd_sum = np.zeros(self.n_classes)
+        self.hd95_sum = np.zeros(self.n_classes)
+        self.count = np.zeros(self.n_classes)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __del__(self):
+        self.close()
+
+
+class StreamProbabilityHistogram(_StreamMetrics):
+    """
+    Stream per-class histograms of softmax probabilities, split by ground truth, in fixed bins.
+
+    PR/ROC curves, AUC, average precision, the best-F1 threshold of every class and the calibration error (ECE of the
+    top-1 confidence) come from the histograms after one pass, with memory independent of the dataset size.
+    Thresholds are resolved to the bin width.
+    """
+
+    def __init__(self, n_classes, n_bins=1000):
+        self.n_classes = n_classes
+        self.n_bins = n_bins
+        self.reset()
+
+    def update(self, label_trues, probs):
+        """
+        :param label_trues: (b, ...) class indices, pixels out of [0, n_classes) are ignored
+        :param probs: (b, n_classes, ...) probabilities
+        """
+        label_trues = label_trues.to(probs.device)
+        valid = ((label_trues >= 0) & (label_trues < self.n_classes)).unsqueeze(1)
+        classes = torch.arange(self.n_classes, device=probs.device).view(1, -1, *[1] * (probs.dim() - 2))
+
+        hist = utils.probability_histogram(probs, label_trues.unsqueeze(1) == classes, self.n_bins, valid)
+
+        # top-1 confidence split by correctness, with the sum of confidences per bin for calibration
+        confidence, label_preds = probs.detach().max(1, keepdim=True)
+        calibration = utils.probability_histogram(confidence, label_preds == label_trues.unsqueeze(1), self.n_bins, valid)
+        confidence = confidence[valid]
+        confidence_sum = torch.bincount((confidence * self.n_bins).long().clamp(0, self.n_bins - 1),
+                                        weights=confidence.double(), minlength=self.n_bins)
+
+        if self.hist is None:
+            self.hist, self.calibration, self.confidence_sum = hist, calibration, confidence_sum
+        else:
+            self.hist += hist
+            self.calibration += calibration
+            self.confidence_sum += confidence_sum
+
+    def get_curves(self):
+        """ROC and PR curves of every class as numpy arrays, from the highest threshold down"""
+        fpr, tpr, thresholds = utils.histogram_roc(self.hist)
+        positives = self.hist[1].sum(-1, keepdim=True).double()
+        negatives = self.hist[0].sum(-1, keepdim=True).double()
+
+        tp = tpr * positives
+        fp = fpr * negatives
+        precision = torch.where(tp + fp > 0, tp / (tp + fp).clamp(min=1), torch.ones_like(tp))
+
+        return {'fpr': fpr.cpu().numpy(),
+                'tpr': tpr.cpu().numpy(),
+                'precision': precision.cpu().numpy(),
+                'recall': tpr.cpu().numpy(),
+                'thresholds': thresholds.cpu().numpy()}
+
+    @staticmethod
+    def to_str(results):
+        string = "\n"
+        for k, v in results.items():
+            if not k.startswith('Class'):
+                string += "%s: %f\n" % (k, v)
+
+        return string
+
+    def get_results(self):
+        curves = self.get_curves()
+        precision, recall, thresholds = curves['precision'], curves['recall'], curves['thresholds']
+
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+        best = f1.argmax(-1)
+        auc = utils.histogram_auc(self.hist).cpu().numpy()
+        ap = (np.diff(recall, axis=-1) * precision[:, 1:]).sum(-1)
+
+        counts = self.calibration.sum(0)[0].double()
+        correct = self.calibration[1, 0].double()
+        ece = ((correct - self.confidence_sum).abs().sum() / counts.sum().clamp(min=1)).item()
+
+        classes = range(self.n_classes)
+        self.metric_dict = {
+            'Mean AUC': auc.mean(),
+            'Mean AP': ap.mean(),
+            'ECE': ece,
+            'Class AUC': dict(zip(classes, auc)),
+            'Class AP': dict(zip(classes, ap)),
+            'Class Best F1': dict(zip(classes, f1[np.arange(self.n_classes), best])),
+            'Class Best Threshold': dict(zip(classes, thresholds[best])),
+        }
+
+        return self.metric_dict
+
+    def reset(self):
+        self.hist = None
+        self.calibration = None
+        self.confidence_sum = None
+
+
 class StreamSegMetrics_classification:
     def __init__(self, n_classes):
         self.metric_dict = {'Mean Kappa Score': -1,
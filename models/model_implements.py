@@ -1,12 +1,18 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import math
+import re
 
 
 from models.backbones import Resnet
 from models.backbones import Unet_part
 from models.backbones.Swin import SwinTransformer
+from models.backbones.HRNet import HighResolutionNet
 from models.blocks.Blocks import Upsample
 from models.heads.UPerHead import M_UPerHead
+from models.heads import ASPP
+from timm.layers import trunc_normal_
 
 from collections import OrderedDict
 
@@ -76,9 +82,11 @@ class Unet(nn.Module):
 
 
 class Swin(nn.Module):
-    def __init__(self, num_classes=2, in_channel=3):
+    def __init__(self, num_classes=2, in_channel=3, memory_efficient=False, full_resolution=True):
         super(Swin, self).__init__()
 
+        self.full_resolution = full_resolution  # else return the logits of the head, at 1/4 resolution
+
         self.swin_transformer = SwinTransformer(in_chans=in_channel,
                                                 embed_dim=96,
                                                 depths=[2, 2, 6, 2],
@@ -101,7 +109,8 @@ class Swin(nn.Module):
                                     channels=512,
                                     dropout_ratio=0.1,
                                     num_classes=num_classes,
-                                    align_corners=False,)
+                                    align_corners=False,
+                                    memory_efficient=memory_efficient)
 
     def load_pretrained(self, dst):
         pretrained_states = torch.load(dst)
@@ -132,13 +141,55 @@ class Swin(nn.Module):
 
         feat = self.swin_transformer(x)     # list of feature pyramid
         feat = self.uper_head(feat)
+        if self.full_resolution:
+            feat = Upsample(feat, x_size)
+
+        return feat
+
+
+class HRNet(nn.Module):
+    def __init__(self, num_classes=2, output_mode='concat', fused_channels=256):
+        super(HRNet, self).__init__()
+
+        self.hrnet = HighResolutionNet(output_mode=output_mode, fused_channels=fused_channels)
+        high_level_ch = self.hrnet.high_level_ch
+        self.last_layer = nn.Sequential(
+            nn.Conv2d(high_level_ch, high_level_ch, kernel_size=1),
+            nn.BatchNorm2d(high_level_ch),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(high_level_ch, num_classes, kernel_size=1)
+        )
+
+    def load_pretrained_imagenet(self, dst):
+        # HRNet initialization of the backbone, then the weights of the checkpoint, e.g. 'hrnetv2_w48_imagenet_pretrained.pth'
+        self.hrnet.init_weights(dst)
+
+    def load_pretrained(self, dst):
+        pretrained_states = torch.load(dst, map_location='cpu')
+        pretrained_states = OrderedDict((k.replace('module.', '', 1), v) for k, v in pretrained_states.items())   # strip wrapper class
+
+        self.load_state_dict(pretrained_states)
+
+    def forward(self, x):
+        x_size = x.shape[2:]
+
+        _, _, feat = self.hrnet(x)
+        feat = self.last_layer(feat)
         feat = Upsample(feat, x_size)
 
         return feat
 
 
 class ResNet18_multihead(nn.Module):
-    def __init__(self, num_classes=6, sub_classes=4):
+    """
+    ResNet18 with one MLP classifier per class, packed into (heads, in, out) weights.
+
+    All heads run as one batched matmul per layer instead of one small GEMM per head and layer. Checkpoints of the
+    former ModuleList layout ('classifiers.{i}.0' / 'classifiers.{i}.3') are converted on load, and
+    'unpack_state_dict' converts back.
+    """
+
+    def __init__(self, num_classes=6, sub_classes=4, hidden_dim=512):
         super(ResNet18_multihead, self).__init__()
 
         self.num_classes = num_classes
@@ -146,12 +197,60 @@ class ResNet18_multihead(nn.Module):
 
         self.resnet = Resnet.ResNet18()
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
-        self.classifiers = nn.ModuleList([nn.Sequential(*[
-            nn.Linear(512 * 4, 512),
-            nn.ReLU(),
-            nn.Dropout(),
-            nn.Linear(512, sub_classes)
-        ]) for _ in range(num_classes)])
+        self.classifier_weight1 = nn.Parameter(torch.empty(num_classes, 512 * 4, hidden_dim))
+        self.classifier_bias1 = nn.Parameter(torch.empty(num_classes, hidden_dim))
+        self.classifier_weight2 = nn.Parameter(torch.empty(num_classes, hidden_dim, sub_classes))
+        self.classifier_bias2 = nn.Parameter(torch.empty(num_classes, sub_classes))
+        self.relu = nn.ReLU()
+        self.dropout = nn.Dropout()
+
+        # same distribution as the default init of nn.Linear
+        for weight, bias in ((self.classifier_weight1, self.classifier_bias1),
+                             (self.classifier_weight2, self.classifier_bias2)):
+            bound = 1 / math.sqrt(weight.shape[1])
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+
+        self.register_load_state_dict_pre_hook(self._pack_hook)
+
+    @staticmethod
+    def pack_state_dict(state_dict, prefix=''):
+        """Converts the 'classifiers.{i}' ModuleList layout of a state dict to the packed layout, in place"""
+        layers = {'0': ('classifier_weight1', 'classifier_bias1'), '3': ('classifier_weight2', 'classifier_bias2')}
+        for layer, (weight_name, bias_name) in layers.items():
+            pattern = re.escape(prefix) + r'classifiers\.(\d+)\.' + layer + r'\.weight'
+            heads = sorted(int(m.group(1)) for m in map(lambda k: re.fullmatch(pattern, k), list(state_dict)) if m)
+            if not heads:
+                continue
+
+            keys = [f'{prefix}classifiers.{i}.{layer}.' for i in heads]
+            state_dict[prefix + weight_name] = torch.stack([state_dict.pop(k + 'weight').t() for k in keys])
+            state_dict[prefix + bias_name] = torch.stack([state_dict.pop(k + 'bias') for k in keys])
+
+        return state_dict
+
+    @staticmethod
+    def unpack_state_dict(state_dict, prefix=''):
+        """Converts the packed layout of a state dict to the 'classifiers.{i}' ModuleList layout, in place"""
+        layers = {'0': ('classifier_weight1', 'classifier_bias1'), '3': ('classifier_weight2', 'classifier_bias2')}
+        for layer, (weight_name, bias_name) in layers.items():
+            weights = state_dict.pop(prefix + weight_name)
+            biases = state_dict.pop(prefix + bias_name)
+            for i, (weight, bias) in enumerate(zip(weights, biases)):
+                state_dict[f'{prefix}classifiers.{i}.{layer}.weight'] = weight.t().contiguous()
+                state_dict[f'{prefix}classifiers.{i}.{layer}.bias'] = bias.clone()
+
+        return state_dict
+
+    @staticmethod
+    def _pack_hook(module, state_dict, prefix, *args):
+        ResNet18_multihead.pack_state_dict(state_dict, prefix)
+
+    def load_pretrained(self, dst):
+        pretrained_states = torch.load(dst, map_location='cpu')
+        pretrained_states = OrderedDict((k.replace('module.', '', 1), v) for k, v in pretrained_states.items())   # strip wrapper class
+
+        self.load_state_dict(pretrained_states)
 
     def forward(self, x):
         x = x.contiguous()
@@ -159,38 +258,36 @@ class ResNet18_multihead(nn.Module):
 
         final_feature = self.avgpool(final_feature)
         final_feature = torch.flatten(final_feature, 1)
-        outputs = [self.classifiers[i](final_feature) for i in range(self.num_classes)]
 
-        output = torch.cat([output.unsqueeze(1) for output in outputs], dim=1)
-        output = output.view([-1, self.sub_classes, self.num_classes])  # reshape for CE loss
+        final_feature = final_feature.expand(self.num_classes, *final_feature.shape)   # shared input of all heads
+        hidden = torch.baddbmm(self.classifier_bias1.unsqueeze(1), final_feature, self.classifier_weight1)
+        hidden = self.dropout(self.relu(hidden))
+        output = torch.baddbmm(self.classifier_bias2.unsqueeze(1), hidden, self.classifier_weight2)   # (heads, b, sub_classes)
+
+        output = output.transpose(0, 1).reshape([-1, self.sub_classes, self.num_classes])  # reshape for CE loss
 
         return output
 
 
 class DeepLabV3_Res50(nn.Module):
-    def __init__(self, num_classes=2):
+    """
+    Mixture of ResNet50 + ASPP experts, 'prefix' selects the expert of every sample.
+
+    The batch is grouped by expert, each expert runs once on its sub-batch and the upsampled logits are scattered back
+    in the order of the batch.
+    """
+
+    def __init__(self, num_classes=2, num_experts=5):
         super(DeepLabV3_Res50, self).__init__()
 
-        self.model_0 = nn.Sequential(*[
-            Resnet.ResNet50(),
-            ASPP.ASPP(num_classes=num_classes, in_channel=2048)
-        ])
-        self.model_1 = nn.Sequential(*[
-            Resnet.ResNet50(),
-            ASPP.ASPP(num_classes=num_classes, in_channel=2048)
-        ])
-        self.model_2 = nn.Sequential(*[
-            Resnet.ResNet50(),
-            ASPP.ASPP(num_classes=num_classes, in_channel=2048)
-        ])
-        self.model_3 = nn.Sequential(*[
-            Resnet.ResNet50(),
-            ASPP.ASPP(num_classes=num_classes, in_channel=2048)
-        ])
-        self.model_4 = nn.Sequential(*[
-            Resnet.ResNet50(),
-            ASPP.ASPP(num_classes=num_classes, in_channel=2048)
-        ])
+        self.num_classes = num_classes
+        self.num_experts = num_experts
+
+        for i in range(num_experts):
+            self.add_module(f'model_{i}', nn.Sequential(*[
+                Resnet.ResNet50(),
+                ASPP.ASPP(num_classes=num_classes, in_channel=2048)
+            ]))
 
         self.apply(self._init_weights)
 
@@ -205,28 +302,44 @@ class DeepLabV3_Res50(nn.Module):
 
     def forward(self, x, prefix):
         x = x.contiguous()
-        _, _, h, w = x.shape
-
-        output = []
-        for idx, item in enumerate(prefix):
-            if item == 0:
-                _, _, _, tmp = self.model_0[0](x[idx])
-                output.append(self.model_0[1](tmp))
-            elif item == 1:
-                _, _, _, tmp = self.model_1[0](x[idx])
-                output.append(self.model_1[1](tmp))
-            elif item == 2:
-                _, _, _, tmp = self.model_2[0](x[idx])
-                output.append(self.model_2[1](tmp))
-            elif item == 3:
-                _, _, _, tmp = self.model_3[0](x[idx])
-                output.append(self.model_3[1](tmp))
-            elif item == 4:
-                _, _, _, tmp = self.model_4[0](x[idx])
-                output.append(self.model_4[1](tmp))
-
-        output = torch.cat([item for item in output], dim=0)
-
-        output = F.interpolate(x, size=[h, w], mode='bilinear', align_corners=False)
+        b, _, h, w = x.shape
+
+        prefix = torch.as_tensor(prefix, device=x.device).view(-1)
+        output = x.new_empty(b, self.num_classes, h, w)
+
+        for expert_idx in torch.unique(prefix).tolist():
+            if not 0 <= expert_idx < self.num_experts:
+                raise Exception('No expert named', expert_idx)
+
+            expert = getattr(self, f'model_{expert_idx}')
+            sample_idx = torch.nonzero(prefix == expert_idx).squeeze(1)
+
+            _, _, _, feat = expert[0](x.index_select(0, sample_idx))
+            feat = F.interpolate(expert[1](feat), size=[h, w], mode='bilinear', align_corners=False)
+            output.index_copy_(0, sample_idx, feat)
 
         return output
+
+
+def main():
+    torch.manual_seed(0)
+    model = DeepLabV3_Res50(num_classes=3, num_experts=2)
+    x = torch.randn(3, 3, 64, 64)
+
+    # routed sub-batches against every sample through its own expert
+    model.eval()
+    prefix = [1, 0, 1]
+    with torch.no_grad():
+        output = model(x, prefix)
+        reference = torch.cat([model(x[i:i + 1], prefix[i:i + 1]) for i in range(len(prefix))])
+    print(f'DeepLabV3_Res50 eval: max abs error against per sample {(output - reference).abs().max().item():.2e}')
+
+    # a sub-batch of a single sample in training mode
+    model.train()
+    output = model(x, [0, 0, 1])
+    output.mean().backward()
+    print(f'DeepLabV3_Res50 train, prefix [0, 0, 1]: output {tuple(output.shape)}, backward ok')
+
+
+if __name__ == '__main__':
+    main()
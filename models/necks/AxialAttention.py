@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch.utils.checkpoint import checkpoint
+
 
 class Conv(nn.Module):
     def __init__(self, nIn, nOut, kSize, stride, padding, dilation=(1, 1), groups=1, bn_acti=False, bias=False):
@@ -39,12 +41,12 @@ class BNPReLU(nn.Module):
 
 
 class AA_kernel(nn.Module):
-    def __init__(self, in_channel, out_channel):
+    def __init__(self, in_channel, out_channel, chunk_size=None):
         super(AA_kernel, self).__init__()
         self.conv0 = Conv(in_channel, out_channel, kSize=1,stride=1,padding=0)
         self.conv1 = Conv(out_channel, out_channel, kSize=(3, 3),stride = 1, padding=1)
-        self.Hattn = self_attn(out_channel, mode='h')
-        self.Wattn = self_attn(out_channel, mode='w')
+        self.Hattn = self_attn(out_channel, mode='h', chunk_size=chunk_size)
+        self.Wattn = self_attn(out_channel, mode='w', chunk_size=chunk_size)
 
     def forward(self, x):
         x = self.conv0(x)
@@ -57,10 +59,18 @@ class AA_kernel(nn.Module):
 
 
 class self_attn(nn.Module):
-    def __init__(self, in_channels, mode='hw'):
+    """
+    Sigmoid attention over 'axis' = H, W or H * W positions of the flattened projections.
+
+    :param chunk_size: number of queries attended at once, or None for all. The (B, chunk_size, axis) attention map of
+    each chunk is recomputed in backward instead of stored, so the memory is bounded for mode='hw' in training as well
+    """
+
+    def __init__(self, in_channels, mode='hw', chunk_size=None):
         super(self_attn, self).__init__()
 
         self.mode = mode
+        self.chunk_size = chunk_size
 
         self.query_conv = Conv(in_channels, in_channels // 8, kSize=(1, 1),stride=1,padding=0)
         self.key_conv = Conv(in_channels, in_channels // 8, kSize=(1, 1),stride=1,padding=0)
@@ -69,6 +79,11 @@ class self_attn(nn.Module):
         self.gamma = nn.Parameter(torch.zeros(1))
         self.sigmoid = nn.Sigmoid()
 
+    def _attend(self, query, key, value):
+        attention = self.sigmoid(torch.bmm(query.transpose(1, 2), key))
+
+        return torch.bmm(value, attention.transpose(1, 2))
+
     def forward(self, x):
         batch_size, channel, height, width = x.size()
 
@@ -80,14 +95,23 @@ class self_attn(nn.Module):
 
         view = (batch_size, -1, axis)
 
-        projected_query = self.query_conv(x).view(*view).permute(0, 2, 1)
-        projected_key = self.key_conv(x).view(*view)
-
-        attention_map = torch.bmm(projected_query, projected_key)
-        attention = self.sigmoid(attention_map)
-        projected_value = self.value_conv(x).view(*view)
+        projected_query = self.query_conv(x).reshape(*view)
+        projected_key = self.key_conv(x).reshape(*view)
+        projected_value = self.value_conv(x).reshape(*view)
+
+        chunk_size = self.chunk_size if self.chunk_size else axis
+        if chunk_size >= axis:
+            out = self._attend(projected_query, projected_key, projected_value)
+        else:
+            out = projected_value.new_empty(projected_value.shape)
+            for start in range(0, axis, chunk_size):
+                query = projected_query[..., start:start + chunk_size]
+                if torch.is_grad_enabled():
+                    out[..., start:start + chunk_size] = checkpoint(self._attend, query, projected_key, projected_value,
+                                                                    use_reentrant=False)
+                else:
+                    out[..., start:start + chunk_size] = self._attend(query, projected_key, projected_value)
 
-        out = torch.bmm(projected_value, attention.permute(0, 2, 1))
         out = out.view(batch_size, channel, height, width)
 
         out = self.gamma * out + x
@@ -210,4 +234,65 @@ class CFPModule(nn.Module):
         output = self.bn_relu_2(output)
         output = self.conv1x1(output)
 
-        return output + input
\ No newline at end of file
+        return output + input
+
+
+def _reference_attn(module, x):
+    # dense formulation of self_attn.forward, for the parity check
+    batch_size, channel, height, width = x.size()
+    axis = (height if 'h' in module.mode else 1) * (width if 'w' in module.mode else 1)
+    view = (batch_size, -1, axis)
+
+    projected_query = module.query_conv(x).view(*view).permute(0, 2, 1)
+    projected_key = module.key_conv(x).view(*view)
+    attention = module.sigmoid(torch.bmm(projected_query, projected_key))
+    projected_value = module.value_conv(x).view(*view)
+    out = torch.bmm(projected_value, attention.permute(0, 2, 1)).view(batch_size, channel, height, width)
+
+    return module.gamma * out + x
+
+
+def _peak_memory(mode, chunk_size, size, channels=64):
+    # increase of the peak resident memory during a forward-backward, run in a fresh process
+    import resource
+
+    torch.manual_seed(0)
+    module = self_attn(channels, mode=mode, chunk_size=chunk_size)
+    x = torch.rand(1, channels, size, size, requires_grad=True)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    module(x).sum().backward()
+
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+
+
+def main():
+    import multiprocessing
+
+    torch.manual_seed(0)
+
+    # parity with the dense formulation, for chunks that do and do not divide the axis
+    x = torch.rand(2, 32, 24, 40, requires_grad=True)
+    for mode in ('h', 'w', 'hw'):
+        module = self_attn(32, mode=mode)
+        nn.init.constant_(module.gamma, 1.)
+        expected = _reference_attn(module, x)
+        grad_expected = torch.autograd.grad(expected.square().sum(), x)[0]
+        for chunk_size in (None, 7, 16):
+            module.chunk_size = chunk_size
+            out = module(x)
+            grad = torch.autograd.grad(out.square().sum(), x)[0]
+            print('mode=%s chunk_size=%s: max relative error of output %.2e, of gradient %.2e'
+                  % (mode, chunk_size, ((out - expected).abs().max() / expected.abs().max()).item(),
+                     ((grad - grad_expected).abs().max() / grad_expected.abs().max()).item()))
+
+    # peak memory of mode='hw' vs resolution
+    pool = multiprocessing.get_context('fork').Pool(1, maxtasksperchild=1)
+    for size in (32, 64, 96):
+        for chunk_size in (None, 256):
+            peak = pool.apply(_peak_memory, ('hw', chunk_size, size))
+            print('hw %dx%d chunk_size=%s: +%.1f MB peak memory' % (size, size, chunk_size, peak))
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
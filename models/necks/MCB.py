@@ -1,8 +1,5 @@
 import torch
 import torch.nn as nn
-import types
-
-from torch.autograd import Function
 
 """
 https://github.com/gdlg/pytorch_compact_bilinear_pooling
@@ -12,64 +9,17 @@ Akira Fukui et al. "Multimodal Compact Bilinear Pooling for Visual Question Answ
 """
 
 
-def CountSketchFn_forward(h, s, output_size, x, force_cpu_scatter_add=False):
-    x_size = tuple(x.size())
-
-    s_view = (1,) * (len(x_size)-1) + (x_size[-1],)
-
-    out_size = x_size[:-1] + (output_size,)
-
-    # Broadcast s and compute x * s
-    s = s.view(s_view)
-    xs = x * s
-
-    # Broadcast h then compute h:
-    # out[h_i] += x_i * s_i
-    h = h.view(s_view).expand(x_size)
-
-    if force_cpu_scatter_add:
-        out = x.new(*out_size).zero_().cpu()
-        return out.scatter_add_(-1, h.cpu(), xs.cpu()).cuda()
-    else:
-        out = x.new(*out_size).zero_()
-        return out.scatter_add_(-1, h, xs)
-
-
-def CountSketchFn_backward(h, s, x_size, grad_output):
-    s_view = (1,) * (len(x_size)-1) + (x_size[-1],)
-
-    s = s.view(s_view)
-    h = h.view(s_view).expand(x_size)
-
-    grad_x = grad_output.gather(-1, h)
-    grad_x = grad_x * s
-    return grad_x
-
-
-def ComplexMultiply_forward(X_re, X_im, Y_re, Y_im):
-    Z_re = torch.addcmul(X_re*Y_re, X_im, Y_im, value=-1)
-    Z_im = torch.addcmul(X_re*Y_im, X_im, Y_re, value=1)
-    return Z_re,Z_im
-
-
-class CountSketchFn(Function):
-
-    @staticmethod
-    def forward(ctx, h, s, output_size, x, force_cpu_scatter_add=False):
-        x_size = tuple(x.size())
-
-        ctx.save_for_backward(h,s)
-        ctx.x_size = tuple(x.size())
-
-        return CountSketchFn_forward(h, s, output_size, x, force_cpu_scatter_add)
-
+def count_sketch(x, h, s, output_size):
+    """
+    out[..., h_i] += s_i * x[..., i], differentiable through index_add.
 
-    @staticmethod
-    def backward(ctx, grad_output):
-        h,s = ctx.saved_variables
+    :param x: (..., input_size)
+    :param h: (input_size) int64 indices in [0, output_size)
+    :param s: (input_size) signs
+    """
+    out = x.new_zeros(*x.shape[:-1], output_size)
 
-        grad_x = CountSketchFn_backward(h,s,ctx.x_size,grad_output)
-        return None, None, None, grad_x
+    return out.index_add_(-1, h, x * s)
 
 
 class CountSketch(nn.Module):
@@ -98,7 +48,7 @@ class CountSketch(nn.Module):
         Akira Fukui et al. "Multimodal Compact Bilinear Pooling for Visual Question Answering and Visual Grounding", arXiv:1606.01847 (2016).
     """
 
-    def __init__(self, input_size, output_size, h = None, s = None):
+    def __init__(self, input_size, output_size, h=None, s=None):
         super(CountSketch, self).__init__()
 
         self.input_size = input_size
@@ -107,112 +57,16 @@ class CountSketch(nn.Module):
         if h is None:
             h = torch.LongTensor(input_size).random_(0, output_size)
         if s is None:
-            s = 2 * torch.Tensor(input_size).random_(0,2) - 1
-
-        # The Variable h being a list of indices,
-        # If the type of this module is changed (e.g. float to double),
-        # the variable h should remain a LongTensor
-        # therefore we force float() and double() to be no-ops on the variable h.
-        def identity(self):
-            return self
+            s = 2 * torch.Tensor(input_size).random_(0, 2) - 1
 
-        h.float = types.MethodType(identity,h)
-        h.double = types.MethodType(identity,h)
-
-        self.register_buffer('h',h)
-        self.register_buffer('s',s)
+        # float() / double() of the module only cast floating point buffers, so h stays a LongTensor
+        self.register_buffer('h', torch.as_tensor(h, dtype=torch.long))
+        self.register_buffer('s', torch.as_tensor(s, dtype=torch.get_default_dtype()))
 
     def forward(self, x):
-        x_size = list(x.size())
-
-        assert(x_size[-1] == self.input_size)
-
-        return CountSketchFn.apply(self.h, self.s, self.output_size, x)
-
-
-class CompactBilinearPoolingFn(Function):
-
-    @staticmethod
-    def forward(ctx, h1, s1, h2, s2, output_size, x, y, force_cpu_scatter_add=False):
-        ctx.save_for_backward(h1, s1, h2, s2, x, y)
-        ctx.x_size = tuple(x.size())
-        ctx.y_size = tuple(y.size())
-        ctx.force_cpu_scatter_add = force_cpu_scatter_add
-        ctx.output_size = output_size
-
-        # Compute the count sketch of each input
-        px = CountSketchFn_forward(h1, s1, output_size, x, force_cpu_scatter_add)
-        fx = torch.rfft(px, 1)
-        re_fx = fx.select(-1, 0)
-        im_fx = fx.select(-1, 1)
-        del px
-        py = CountSketchFn_forward(h2, s2, output_size, y, force_cpu_scatter_add)
-        fy = torch.rfft(py, 1)
-        re_fy = fy.select(-1, 0)
-        im_fy = fy.select(-1, 1)
-        del py
-
-        # Convolution of the two sketch using an FFT.
-        # Compute the FFT of each sketch
-
-        # Complex multiplication
-        re_prod, im_prod = ComplexMultiply_forward(re_fx, im_fx, re_fy, im_fy)
-
-        # Back to real domain
-        # The imaginary part should be zero's
-        re = torch.irfft(torch.stack((re_prod, im_prod), re_prod.dim()), 1, signal_sizes=(output_size,))
-
-        return re
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        h1, s1, h2, s2, x, y = ctx.saved_tensors
-
-        # Recompute part of the forward pass to get the input to the complex product
-        # Compute the count sketch of each input
-        px = CountSketchFn_forward(h1, s1, ctx.output_size, x, ctx.force_cpu_scatter_add)
-        py = CountSketchFn_forward(h2, s2, ctx.output_size, y, ctx.force_cpu_scatter_add)
-
-        # Then convert the output to Fourier domain
-        grad_output = grad_output.contiguous()
-        grad_prod = torch.rfft(grad_output, 1)
-        grad_re_prod = grad_prod.select(-1, 0)
-        grad_im_prod = grad_prod.select(-1, 1)
-
-        # Compute the gradient of x first then y
-
-        # Gradient of x
-        # Recompute fy
-        fy = torch.rfft(py, 1)
-        re_fy = fy.select(-1, 0)
-        im_fy = fy.select(-1, 1)
-        del py
-        # Compute the gradient of fx, then back to temporal space
-        grad_re_fx = torch.addcmul(grad_re_prod * re_fy, grad_im_prod, im_fy, value=1)
-        grad_im_fx = torch.addcmul(grad_im_prod * re_fy, grad_re_prod, im_fy, value=-1)
-        grad_fx = torch.irfft(torch.stack((grad_re_fx, grad_im_fx), grad_re_fx.dim()), 1,
-                              signal_sizes=(ctx.output_size,))
-        # Finally compute the gradient of x
-        grad_x = CountSketchFn_backward(h1, s1, ctx.x_size, grad_fx)
-        del re_fy, im_fy, grad_re_fx, grad_im_fx, grad_fx
-
-        # Gradient of y
-        # Recompute fx
-        fx = torch.rfft(px, 1)
-        re_fx = fx.select(-1, 0)
-        im_fx = fx.select(-1, 1)
-        del px
-
-        # Compute the gradient of fy, then back to temporal space
-        grad_re_fy = torch.addcmul(grad_re_prod * re_fx, grad_im_prod, im_fx, value=1)
-        grad_im_fy = torch.addcmul(grad_im_prod * re_fx, grad_re_prod, im_fx, value=-1)
-        grad_fy = torch.irfft(torch.stack((grad_re_fy, grad_im_fy), grad_re_fy.dim()), 1,
-                              signal_sizes=(ctx.output_size,))
-        # Finally compute the gradient of y
-        grad_y = CountSketchFn_backward(h2, s2, ctx.y_size, grad_fy)
-        del re_fx, im_fx, grad_re_fy, grad_im_fy, grad_fy
-
-        return None, None, None, None, None, grad_x, grad_y, None
+        assert x.shape[-1] == self.input_size
+
+        return count_sketch(x, self.h, self.s, self.output_size)
 
 
 class CompactBilinearPooling(nn.Module):
@@ -222,6 +76,9 @@ class CompactBilinearPooling(nn.Module):
 
         out = \Psi (x,h_1,s_1) \ast \Psi (y,h_2,s_2)
 
+    The circular convolution of the two sketches is a product in the Fourier domain (torch.fft.rfft / irfft),
+    differentiated by autograd. All leading dimensions are batch dimensions, e.g. every spatial position of a feature map.
+
     Args:
         input_size1 (int): Number of channels in the first input array
         input_size2 (int): Number of channels in the second input array
@@ -230,7 +87,8 @@ class CompactBilinearPooling(nn.Module):
         s1 (array, optional): Optional array of size input_size of -1 and 1.
         h2 (array, optional): Optional array of size input_size of indices in the range [0,output_size]
         s2 (array, optional): Optional array of size input_size of -1 and 1.
-        force_cpu_scatter_add (boolean, optional): Force the scatter_add operation to run on CPU for testing purposes
+        fused (boolean, optional): Sketch both inputs with a single index_add into a (..., 2, output_size) buffer
+            with the concatenated projections, followed by a single FFT
 
     .. note::
 
@@ -246,57 +104,86 @@ class CompactBilinearPooling(nn.Module):
         Akira Fukui et al. "Multimodal Compact Bilinear Pooling for Visual Question Answering and Visual Grounding", arXiv:1606.01847 (2016).
     """
 
-    def __init__(self, input1_size, input2_size, output_size, h1=None, s1=None, h2=None, s2=None,
-                 force_cpu_scatter_add=False):
+    def __init__(self, input1_size, input2_size, output_size, h1=None, s1=None, h2=None, s2=None, fused=False):
         super(CompactBilinearPooling, self).__init__()
         self.add_module('sketch1', CountSketch(input1_size, output_size, h1, s1))
         self.add_module('sketch2', CountSketch(input2_size, output_size, h2, s2))
         self.output_size = output_size
-        self.force_cpu_scatter_add = force_cpu_scatter_add
+        self.fused = fused
 
     def forward(self, x, y=None):
         if y is None:
             y = x
 
-        return CompactBilinearPoolingFn.apply(self.sketch1.h, self.sketch1.s, self.sketch2.h, self.sketch2.s,
-                                              self.output_size, x, y, self.force_cpu_scatter_add)
+        if self.fused:
+            shape = torch.broadcast_shapes(x.shape[:-1], y.shape[:-1])
+            xy = torch.cat([x.expand(*shape, x.shape[-1]), y.expand(*shape, y.shape[-1])], -1)
+            h = torch.cat([self.sketch1.h, self.sketch2.h + self.output_size])
+            s = torch.cat([self.sketch1.s, self.sketch2.s])
+
+            sketch = count_sketch(xy, h, s, 2 * self.output_size)
+            fx, fy = torch.fft.rfft(sketch.unflatten(-1, (2, self.output_size))).unbind(-2)
+        else:
+            fx = torch.fft.rfft(self.sketch1(x))
+            fy = torch.fft.rfft(self.sketch2(y))
+
+        return torch.fft.irfft(fx * fy, n=self.output_size)
 
 
 class MCB(nn.Module):
 
-    def __init__(self, input_size, output_size):
+    def __init__(self, input_size, output_size, fused=False):
         super(MCB, self).__init__()
 
-        self.mcb_layer = CompactBilinearPooling(input_size, input_size, output_size).cuda()
+        self.mcb_layer = CompactBilinearPooling(input_size, input_size, output_size, fused=fused)
 
     def forward(self, x1, x2):
+        """(b, c, ...) feature maps to (b, output_size, ...), pooled at every position"""
+        x1 = x1.movedim(1, -1)
+        x2 = x2.movedim(1, -1)
 
         z = self.mcb_layer(x1, x2)
 
-        return z
-
-
-# def main():
-#     import time
-#
-#     mcb = MCB(1024, 2048)
-#
-#     tt = time.time()
-#
-#     # input.requires_grad() to backward as there's no param in module
-#     x1 = torch.rand(1, 2048, 1, 1).cuda().requires_grad_()
-#     x2 = torch.rand(1, 2048, 1, 1).cuda().requires_grad_()
-#
-#     y = torch.rand(4, 16384, 1, 1).cuda()
-#
-#     z = mcb(x1, x2)
-#
-#     loss = nn.functional.mse_loss(y, z)
-#     loss.backward()     # check backward-able
-#
-#     print('compute time', time.time() - tt)
-#     print('max mem:', torch.cuda.max_memory_allocated())
-#
-#
-# if __name__ == '__main__':
-#     main()
+        return z.movedim(-1, 1)
+
+
+def main():
+    import time
+
+    torch.manual_seed(0)
+
+    # parity with the explicit definition: out_k = sum_{(h1_i + h2_j) mod d = k} s1_i s2_j x_i y_j
+    d = 37
+    mcb = CompactBilinearPooling(11, 13, d).double()
+    x, y = torch.rand(5, 11, dtype=torch.float64), torch.rand(5, 13, dtype=torch.float64)
+    index = (mcb.sketch1.h[:, None] + mcb.sketch2.h[None]) % d
+    outer = (mcb.sketch1.s[:, None] * mcb.sketch2.s[None]) * x[:, :, None] * y[:, None]
+    expected = x.new_zeros(5, d).index_add_(-1, index.flatten(), outer.flatten(1))
+    for fused in (False, True):
+        mcb.fused = fused
+        print('fused=%s max abs error: %.2e' % (fused, (mcb(x, y) - expected).abs().max().item()))
+
+    # gradients against finite differences
+    x.requires_grad_()
+    y.requires_grad_()
+    print('gradcheck:', torch.autograd.gradcheck(lambda a, b: mcb(a, b), (x, y)))
+
+    # 2048 -> 16000 on CPU, every position of a (b, 2048, 7, 7) feature map
+    x1 = torch.rand(4, 2048, 7, 7).requires_grad_()
+    x2 = torch.rand(4, 2048, 7, 7).requires_grad_()
+    for fused in (False, True):
+        torch.manual_seed(0)
+        mcb = MCB(2048, 16000, fused=fused)
+
+        z = mcb(x1, x2)
+        z.square().mean().backward()
+
+        tt = time.time()
+        for _ in range(5):
+            z = mcb(x1, x2)
+            z.square().mean().backward()
+        print('fused=%s %s: %.1f ms / forward-backward' % (fused, tuple(z.shape), (time.time() - tt) / 5 * 1000))
+
+
+if __name__ == '__main__':
+    main()
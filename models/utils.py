@@ -1,12 +1,16 @@
+import os
+import copy
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import math
 import random
 import time
 
-from torch.autograd import Variable
-from sklearn.metrics import auc, roc_curve, confusion_matrix
+from torch.overrides import TorchFunctionMode
+from torch.utils._pytree import tree_flatten
+from scipy import ndimage
 from matplotlib.image import imread
 from PIL import Image
 
@@ -129,14 +133,386 @@ class FunctionTimer:
         self.__func = _func
 
     def __call__(self, *args, **kwargs):
-        tt = time.time()
-        self.__func(*args, **kwargs)
-        print(f'\"{self.__func.__name__}\" play time: {time.time() - tt}')
+        tt = time.perf_counter()
+        result = self.__func(*args, **kwargs)
+        print(f'\"{self.__func.__name__}\" play time: {time.perf_counter() - tt}')
+
+        return result
 
     def __enter__(self):
         return self
 
 
+class StepProfiler:
+    """
+    Per-stage timer for the training loop.
+
+    Call 'start' before the loop and 'lap(stage)' after each stage of a step; the elapsed time since the previous lap
+    is stored in a fixed-size ring buffer per stage. Time between the end of a step and the next batch arriving is
+    recorded by lapping 'data' at the top of the loop. Call 'close' when training ends to export an open trace.
+
+    :param stages: names of the stages to record
+    :param device: torch.device of the model, used for synchronization
+    :param enabled: every method is a no-op when False
+    :param sync: synchronize the device on every lap so that asynchronous kernels are charged to the right stage
+    :param history: ring buffer length per stage
+    :param trace_steps: [start, end) global step range to capture with torch.profiler, None to deactivate
+    :param trace_dir: directory for the exported chrome trace
+    """
+
+    def __init__(self, stages, device, enabled=True, sync=False, history=1000, trace_steps=None, trace_dir='.'):
+        self.stages = list(stages)
+        self.device = device
+        self.enabled = enabled
+        self.sync = sync and device.type == 'cuda'
+        self.history = history
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+
+        self.buffers = {stage: np.zeros(history + 1) for stage in self.stages}     # plus the slot of the step in progress
+        self.count = 0
+        self.global_step = 0
+        self._cursor = 0
+        self._tick = None
+        self._trace = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._tick = self._now()
+
+    def lap(self, stage):
+        if not self.enabled:
+            return
+        now = self._now()
+        self.buffers[stage][self._cursor] = now - self._tick
+        self._tick = now
+
+    def step(self):
+        """Closes the current step. Advances the ring buffer and the profiler trace window."""
+        if not self.enabled:
+            return
+        self._cursor = (self._cursor + 1) % (self.history + 1)
+        self.count = min(self.count + 1, self.history)
+        self.global_step += 1
+        for stage in self.stages:
+            self.buffers[stage][self._cursor] = 0    # stages skipped on the next step are recorded as 0
+
+        if self.trace_steps is not None:
+            if self.global_step == self.trace_steps[0]:
+                self._trace = torch.profiler.profile(record_shapes=True, with_stack=False)
+                self._trace.__enter__()
+            elif self.global_step == self.trace_steps[1]:
+                self._export_trace()
+
+        self._tick = self._now()
+
+    def _export_trace(self):
+        if self._trace is None:
+            return
+        self._trace.__exit__(None, None, None)
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        file_path = os.path.join(self.trace_dir, f'trace_step_{self.trace_steps[0]}_{min(self.global_step, self.trace_steps[1])}.json')
+        self._trace.export_chrome_trace(file_path)
+        print(file_path + '\t profiler trace saved!!')
+        self._trace = None
+
+    def close(self):
+        """Exports the trace window still open, e.g. when training ends before its last step"""
+        if not self.enabled:
+            return
+        self._export_trace()
+
+    def get_results(self, percentiles=(50, 90, 99)):
+        """Returns {stage: {'p50': sec, ...}} over the buffered steps, without the step in progress"""
+        index = (self._cursor - 1 - np.arange(self.count)) % (self.history + 1)
+        results = {}
+        for stage in self.stages:
+            values = self.buffers[stage][index]
+            results[stage] = {f'p{p}': float(np.percentile(values, p)) if self.count else 0. for p in percentiles}
+        return results
+
+    @staticmethod
+    def to_str(results):
+        string = ''
+        for stage, values in results.items():
+            string += f'\t {stage:<10}' + ' '.join(f'{k} {v * 1000:8.2f}ms' for k, v in values.items()) + '\n'
+        return string
+
+    def to_wandb(self, results, prefix='Profile'):
+        return {f'{prefix} {stage} {k}': v for stage, values in results.items() for k, v in values.items()}
+
+    def reset(self):
+        for stage in self.stages:
+            self.buffers[stage][:] = 0
+        self.count = 0
+        self._cursor = 0
+
+
+class DataStallMonitor:
+    """
+    Tracks the fraction of training wall time spent waiting on the data loader.
+
+    Call 'wait' before requesting a batch (before the loop and at the end of each step), 'data_ready' when the batch
+    arrives and 'step_end' after the optimizer step. A ratio above 'threshold' means the device is starved by the input pipeline.
+    """
+
+    def __init__(self, threshold=0.3):
+        self.threshold = threshold
+        self.wait_time = 0.
+        self.compute_time = 0.
+        self.num_steps = 0
+        self._tick = time.perf_counter()
+
+    def wait(self):
+        self._tick = time.perf_counter()
+
+    def data_ready(self):
+        now = time.perf_counter()
+        self.wait_time += now - self._tick
+        self._tick = now
+
+    def step_end(self):
+        now = time.perf_counter()
+        self.compute_time += now - self._tick
+        self.num_steps += 1
+        self._tick = now
+
+    def get_results(self):
+        total = self.wait_time + self.compute_time
+        return {'Data Wait Ratio': self.wait_time / total if total > 0 else 0.,
+                'Data Wait per Step': self.wait_time / max(1, self.num_steps)}
+
+    def is_stalled(self):
+        return self.get_results()['Data Wait Ratio'] > self.threshold
+
+    def reset(self):
+        self.wait_time = 0.
+        self.compute_time = 0.
+        self.num_steps = 0
+
+
+class ModelEma:
+    """
+    Exponential moving average of the model parameters and buffers, updated with foreach kernels.
+
+    Drop-in for timm 'ModelEmaV2': the averaged copy is 'module', updated by 'update(model)' after the optimizer step.
+    The tensor lists of both models are gathered once, and each update is a single '_foreach_mul_' / '_foreach_add_'
+    pair instead of a Python loop over parameters.
+
+    :param model: model to average. Create the EMA after moving it to the device and wrapping it
+    :param decay: decay per optimizer step
+    :param update_every: update every N steps, with decay ** N to keep the same time constant
+    :param warmup: use min(decay, (1 + n) / (10 + n)) for the n-th update, so early weights are forgotten quickly
+    :param device: device of the averaged copy, e.g. 'cpu' to save device memory. defaults to the model device
+    """
+
+    def __init__(self, model, decay=0.9999, update_every=1, warmup=False, device=None):
+        self.module = copy.deepcopy(model)
+        self.module.eval()
+        self.module.requires_grad_(False)
+        if device is not None:
+            self.module.to(device)
+
+        self.decay = decay
+        self.update_every = update_every
+        self.warmup = warmup
+        self.device = device
+        self.num_steps = 0
+        self.num_updates = 0
+
+        self._model_key = None
+        self._model_float = None
+        self._model_other = None
+        self._ema_float, self._ema_other = self._split_tensors(self.module)
+
+    @staticmethod
+    def _split_tensors(model):
+        tensors = list(model.state_dict().values())
+        float_tensors = [t for t in tensors if t.is_floating_point()]
+        other_tensors = [t for t in tensors if not t.is_floating_point()]   # e.g. BN 'num_batches_tracked', copied
+
+        return float_tensors, other_tensors
+
+    def get_decay(self):
+        decay = self.decay
+        if self.warmup:
+            decay = min(decay, (1 + self.num_updates) / (10 + self.num_updates))
+
+        return decay ** self.update_every
+
+    @torch.no_grad()
+    def update(self, model):
+        self.num_steps += 1
+        if self.num_steps % self.update_every != 0:
+            return
+
+        if self._model_key != id(model):
+            self._model_key = id(model)
+            self._model_float, self._model_other = self._split_tensors(model)
+
+        decay = self.get_decay()
+        model_float = self._model_float
+        if self.device is not None:
+            model_float = [t.to(self.device) for t in model_float]   # blocking: a non_blocking device to host copy is not synchronized with the foreach ops
+
+        torch._foreach_mul_(self._ema_float, decay)
+        torch._foreach_add_(self._ema_float, model_float, alpha=1. - decay)
+        for ema_v, model_v in zip(self._ema_other, self._model_other):
+            ema_v.copy_(model_v)
+
+        self.num_updates += 1
+
+    @torch.no_grad()
+    def set(self, model):
+        for ema_v, model_v in zip(self.module.state_dict().values(), model.state_dict().values()):
+            ema_v.copy_(model_v)
+
+    def state_dict(self):
+        return {'module': self.module.state_dict(),
+                'num_steps': self.num_steps,
+                'num_updates': self.num_updates}
+
+    def load_state_dict(self, state_dict):
+        self.module.load_state_dict(state_dict['module'])
+        self.num_steps = state_dict['num_steps']
+        self.num_updates = state_dict['num_updates']
+
+
+_CONV_BN = ((torch.nn.Conv1d, torch.nn.BatchNorm1d), (torch.nn.Conv2d, torch.nn.BatchNorm2d), (torch.nn.Conv3d, torch.nn.BatchNorm3d))
+_METADATA_FUNCTIONS = {'__get__', 'size', 'dim', 'numel', 'is_contiguous', '__len__'}   # not a use of the tensor values
+
+
+def _is_conv_bn(conv, bn):
+    return any(type(bn) is bn_type and isinstance(conv, conv_type) for conv_type, bn_type in _CONV_BN) \
+        and bn.track_running_stats and bn.running_mean is not None and bn.num_features == conv.out_channels
+
+
+def _sequential_conv_bn_pairs(model):
+    # a conv directly followed by a BN in a Sequential, always safe to fold
+    pairs = []
+    for module in model.modules():
+        if isinstance(module, torch.nn.Sequential):
+            children = list(module.children())
+            pairs += [(conv, bn) for conv, bn in zip(children[:-1], children[1:]) if _is_conv_bn(conv, bn)]
+
+    return pairs
+
+
+class _UseCounter(TorchFunctionMode):
+    """Counts the torch functions that read the values of the watched tensors"""
+
+    def __init__(self, outputs):
+        super().__init__()
+        self.outputs = outputs
+        self.uses = dict()
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if getattr(func, '__name__', None) not in _METADATA_FUNCTIONS:
+            for arg in tree_flatten((args, kwargs))[0]:
+                if isinstance(arg, torch.Tensor) and id(arg) in self.outputs:
+                    self.uses[id(arg)] = self.uses.get(id(arg), 0) + 1
+
+        return func(*args, **kwargs)
+
+
+def _traced_conv_bn_pairs(model, example_inputs):
+    # a conv whose output is only read by a BN, found by running the forward once
+    outputs = dict()    # id of the output -> (output, conv), the outputs are kept alive so the ids stay unique
+    calls = dict()
+    bn_inputs = dict()  # bn -> input, kept alive as well so that no later conv output can reuse the id of a freed input
+    counter = _UseCounter(outputs)
+
+    def conv_hook(module, input, output):
+        calls[module] = calls.get(module, 0) + 1
+        outputs[id(output)] = (output, module)
+
+    def bn_hook(module, input):
+        calls[module] = calls.get(module, 0) + 1
+        bn_inputs[module] = input[0]
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv1d, torch.nn.Conv2d, torch.nn.Conv3d)):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, (torch.nn.BatchNorm1d, torch.nn.BatchNorm2d, torch.nn.BatchNorm3d)):
+            hooks.append(module.register_forward_pre_hook(bn_hook))
+
+    try:
+        with torch.no_grad(), counter:
+            model(*example_inputs)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    pairs = []
+    for bn, bn_input in bn_inputs.items():
+        output, conv = outputs.get(id(bn_input), (None, None))
+        if output is not bn_input or counter.uses.get(id(bn_input)) != 1:
+            continue
+        if calls[conv] == 1 and calls[bn] == 1 and _is_conv_bn(conv, bn):
+            pairs.append((conv, bn))
+
+    return pairs
+
+
+@torch.no_grad()
+def _fold_batch_norm(conv, bn):
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+
+    conv.weight.mul_(scale.view(-1, *[1] * (conv.weight.dim() - 1)))
+    if conv.bias is None:
+        conv.bias = torch.nn.Parameter(shift)
+    else:
+        conv.bias.mul_(scale).add_(shift)
+
+
+@torch.no_grad()
+def fuse_for_inference(model, *example_inputs):
+    """
+    Folds every BatchNorm into the convolution that feeds it, for inference. The forward of the model is unchanged:
+    the weights of the convolution are rescaled and the BatchNorm is replaced by nn.Identity. Calling it again is a no-op.
+
+    Without 'example_inputs' only the Conv -> BN pairs inside nn.Sequential are folded. With them the forward is run
+    once to also find the pairs of custom forwards, folding a BN only if its input is the output of a convolution that
+    nothing else reads and both modules are called once.
+
+    :param model: model to fuse in place, set to eval mode
+    :param example_inputs: arguments of one forward of the model
+    :returns: the model and the number of folded BatchNorms
+    """
+    model.eval()
+
+    pairs = _sequential_conv_bn_pairs(model)
+    if example_inputs:
+        pairs += _traced_conv_bn_pairs(model, example_inputs)
+
+    folded = dict()
+    for conv, bn in pairs:
+        if bn not in folded:
+            _fold_batch_norm(conv, bn)
+            folded[bn] = conv
+
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if child in folded:
+                setattr(parent, name, torch.nn.Identity())
+
+    return model, len(folded)
+
+
 class ImageProcessing(object):
     '''
     @issue
@@ -144,128 +520,88 @@ class ImageProcessing(object):
 
     '''
 
+    @staticmethod
+    def _color_matmul(matrix, img):
+        """Multiplies every pixel of (b, 3, h, w) 'img' by a 3x3 'matrix' given as [input channel][output channel]"""
+        matrix = torch.tensor(matrix, dtype=img.dtype, device=img.device)
+
+        return torch.einsum('ji,bjhw->bihw', matrix, img)
+
     @staticmethod
     def rgb_to_lab(img, is_training=True):
         """ PyTorch implementation of RGB to LAB conversion: https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
         Based roughly on a similar implementation here: https://github.com/affinelayer/pix2pix-tensorflow/blob/master/pix2pix.py
-        :param img: image to be adjusted
-        :returns: adjusted image
+        :param img: RGB image in [0, 1] of shape (3, H, W) or (B, 3, H, W), on any device
+        :returns: LAB image scaled to [0, 1], same shape
         :rtype: Tensor
 
         """
-        img = img.permute(2, 1, 0)
-        shape = img.shape
-        img = img.contiguous()
-        img = img.view(-1, 3)
-
-        img = (img / 12.92) * img.le(0.04045).float() + (((torch.clamp(img,
-                                                                       min=0.0001) + 0.055) / 1.055) ** 2.4) * img.gt(
-            0.04045).float()
-
-        rgb_to_xyz = Variable(torch.FloatTensor([  # X        Y          Z
-            [0.412453, 0.212671, 0.019334],  # R
-            [0.357580, 0.715160, 0.119193],  # G
-            [0.180423, 0.072169,
-             0.950227],  # B
-        ]), requires_grad=False).cuda()
-
-        img = torch.matmul(img, rgb_to_xyz)
-        img = torch.mul(img, Variable(torch.FloatTensor(
-            [1 / 0.950456, 1.0, 1 / 1.088754]), requires_grad=False).cuda())
-
-        epsilon = 6 / 29
+        unbatched = img.dim() == 3
+        if unbatched:
+            img = img.unsqueeze(0)
 
-        img = ((img / (3.0 * epsilon ** 2) + 4.0 / 29.0) * img.le(epsilon ** 3).float()) + \
-              (torch.clamp(img, min=0.0001) **
-               (1.0 / 3.0) * img.gt(epsilon ** 3).float())
+        img = torch.where(img <= 0.04045, img / 12.92, ((img.clamp(min=0.0001) + 0.055) / 1.055) ** 2.4)
 
-        fxfyfz_to_lab = Variable(torch.FloatTensor([[0.0, 500.0, 0.0],  # fx
-                                                    # fy
-                                                    [116.0, -500.0, 200.0],
-                                                    # fz
-                                                    [0.0, 0.0, -200.0],
-                                                    ]), requires_grad=False).cuda()
+        img = ImageProcessing._color_matmul([  # X        Y          Z
+            [0.412453 / 0.950456, 0.212671, 0.019334 / 1.088754],  # R
+            [0.357580 / 0.950456, 0.715160, 0.119193 / 1.088754],  # G
+            [0.180423 / 0.950456, 0.072169, 0.950227 / 1.088754],  # B, normalized for D65 white point
+        ], img)
 
-        img = torch.matmul(img, fxfyfz_to_lab) + Variable(
-            torch.FloatTensor([-16.0, 0.0, 0.0]), requires_grad=False).cuda()
+        epsilon = 6 / 29
 
-        img = img.view(shape)
-        img = img.permute(2, 1, 0)
+        img = torch.where(img <= epsilon ** 3, img / (3.0 * epsilon ** 2) + 4.0 / 29.0, img.clamp(min=0.0001) ** (1.0 / 3.0))
 
         '''
         L_chan: black and white with input range [0, 100]
-        a_chan/b_chan: color channels with input range ~[-110, 110], not exact 
+        a_chan/b_chan: color channels with input range ~[-110, 110], not exact
         [0, 100] => [0, 1],  ~[-110, 110] => [0, 1]
         '''
-        img[0, :, :] = img[0, :, :] / 100
-        img[1, :, :] = (img[1, :, :] / 110 + 1) / 2
-        img[2, :, :] = (img[2, :, :] / 110 + 1) / 2
+        img = ImageProcessing._color_matmul([[0.0, 500.0 / 220, 0.0],  # fx
+                                             [116.0 / 100, -500.0 / 220, 200.0 / 220],  # fy
+                                             [0.0, 0.0, -200.0 / 220],  # fz
+                                             ], img)
+        img = img + torch.tensor([-16.0 / 100, 0.5, 0.5], dtype=img.dtype, device=img.device).view(1, 3, 1, 1)
 
-        img[(img != img).detach()] = 0
+        img = torch.nan_to_num(img, nan=0.0)
 
-        img = img.contiguous()
-
-        return img.cuda()
+        return img.squeeze(0) if unbatched else img
 
     @staticmethod
     def lab_to_rgb(img, is_training=True):
         """ PyTorch implementation of LAB to RGB conversion: https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
         Based roughly on a similar implementation here: https://github.com/affinelayer/pix2pix-tensorflow/blob/master/pix2pix.py
-        :param img: image to be adjusted
-        :returns: adjusted image
+        :param img: LAB image scaled to [0, 1] of shape (3, H, W) or (B, 3, H, W), on any device
+        :returns: RGB image, same shape
         :rtype: Tensor
         """
-        img = img.permute(2, 1, 0)
-        shape = img.shape
-        img = img.contiguous()
-        img = img.view(-1, 3)
-        img_copy = img.clone()
-
-        img_copy[:, 0] = img[:, 0] * 100
-        img_copy[:, 1] = ((img[:, 1] * 2) - 1) * 110
-        img_copy[:, 2] = ((img[:, 2] * 2) - 1) * 110
-
-        img = img_copy.clone().cuda()
-        del img_copy
-
-        lab_to_fxfyfz = Variable(torch.FloatTensor([  # X Y Z
-            [1 / 116.0, 1 / 116.0, 1 / 116.0],  # R
-            [1 / 500.0, 0, 0],  # G
-            [0, 0, -1 / 200.0],  # B
-        ]), requires_grad=False).cuda()
-
-        img = torch.matmul(
-            img + Variable(torch.cuda.FloatTensor([16.0, 0.0, 0.0])), lab_to_fxfyfz)
+        unbatched = img.dim() == 3
+        if unbatched:
+            img = img.unsqueeze(0)
+
+        # [0, 1] => L [0, 100], a/b ~[-110, 110], then to fx, fy, fz
+        img = img - torch.tensor([-16.0 / 100, 0.5, 0.5], dtype=img.dtype, device=img.device).view(1, 3, 1, 1)
+        img = ImageProcessing._color_matmul([  # fx fy fz
+            [100 / 116.0, 100 / 116.0, 100 / 116.0],  # L
+            [220 / 500.0, 0, 0],  # a
+            [0, 0, -220 / 200.0],  # b
+        ], img)
 
         epsilon = 6.0 / 29.0
 
-        img = (((3.0 * epsilon ** 2 * (img - 4.0 / 29.0)) * img.le(epsilon).float()) +
-               ((torch.clamp(img, min=0.0001) ** 3.0) * img.gt(epsilon).float()))
-
-        # denormalize for D65 white point
-        img = torch.mul(img, Variable(
-            torch.cuda.FloatTensor([0.950456, 1.0, 1.088754])))
-
-        xyz_to_rgb = Variable(torch.FloatTensor([  # X Y Z
-            [3.2404542, -0.9692660, 0.0556434],  # R
-            [-1.5371385, 1.8760108, -0.2040259],  # G
-            [-0.4985314, 0.0415560, 1.0572252],  # B
-        ]), requires_grad=False).cuda()
+        img = torch.where(img <= epsilon, 3.0 * epsilon ** 2 * (img - 4.0 / 29.0), img.clamp(min=0.0001) ** 3.0)
 
-        img = torch.matmul(img, xyz_to_rgb)
+        img = ImageProcessing._color_matmul([  # R G B
+            [3.2404542 * 0.950456, -0.9692660 * 0.950456, 0.0556434 * 0.950456],  # X, denormalized for D65 white point
+            [-1.5371385, 1.8760108, -0.2040259],  # Y
+            [-0.4985314 * 1.088754, 0.0415560 * 1.088754, 1.0572252 * 1.088754],  # Z
+        ], img)
 
-        img = (img * 12.92 * img.le(0.0031308).float()) + ((torch.clamp(img,
-                                                                        min=0.0001) ** (
-                                                                        1 / 2.4) * 1.055) - 0.055) * img.gt(
-            0.0031308).float()
+        img = torch.where(img <= 0.0031308, img * 12.92, (img.clamp(min=0.0001) ** (1 / 2.4)) * 1.055 - 0.055)
 
-        img = img.view(shape)
-        img = img.permute(2, 1, 0)
+        img = torch.nan_to_num(img, nan=0.0)
 
-        img = img.contiguous()
-        img[(img != img).detach()] = 0
-
-        return img
+        return img.squeeze(0) if unbatched else img
 
     @staticmethod
     def swapimdims_3HW_HW3(img):
@@ -364,53 +700,20 @@ class ImageProcessing(object):
         PyTorch implementation of RGB to HSV conversion: https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
         Based roughly on a similar implementation here: http://code.activestate.com/recipes/576919-python-rgb-and-hsv-conversion/
 
-        :param img: HSV image
-        :returns: RGB image
+        :param img: HSV image in [0, 1] of shape (3, H, W) or (B, 3, H, W), on any device
+        :returns: RGB image, same shape
         :rtype: Tensor
 
         """
         img = torch.clamp(img, 0, 1)
-        img = img.permute(2, 1, 0)
-
-        m1 = 0
-        m2 = (img[:, :, 2] * (1 - img[:, :, 1]) - img[:, :, 2]) / 60
-        m3 = 0
-        m4 = -1 * m2
-        m5 = 0
-
-        r = img[:, :, 2] + torch.clamp(img[:, :, 0] * 360 - 0, 0, 60) * m1 + torch.clamp(img[:, :, 0] * 360 - 60, 0,
-                                                                                         60) * m2 + torch.clamp(
-            img[:, :, 0] * 360 - 120, 0, 120) * m3 + torch.clamp(img[:, :, 0] * 360 - 240, 0, 60) * m4 + torch.clamp(
-            img[:, :, 0] * 360 - 300, 0, 60) * m5
-
-        m1 = (img[:, :, 2] - img[:, :, 2] * (1 - img[:, :, 1])) / 60
-        m2 = 0
-        m3 = -1 * m1
-        m4 = 0
-
-        g = img[:, :, 2] * (1 - img[:, :, 1]) + torch.clamp(img[:, :, 0] * 360 - 0, 0, 60) * m1 + torch.clamp(
-            img[:, :, 0] * 360 - 60,
-            0, 120) * m2 + torch.clamp(img[:, :, 0] * 360 - 180, 0, 60) * m3 + torch.clamp(img[:, :, 0] * 360 - 240, 0,
-                                                                                           120) * m4
-
-        m1 = 0
-        m2 = (img[:, :, 2] - img[:, :, 2] * (1 - img[:, :, 1])) / 60
-        m3 = 0
-        m4 = -1 * m2
-
-        b = img[:, :, 2] * (1 - img[:, :, 1]) + torch.clamp(img[:, :, 0] * 360 - 0, 0, 120) * m1 + torch.clamp(
-            img[:, :, 0] * 360 -
-            120, 0, 60) * m2 + torch.clamp(img[:, :, 0] * 360 - 180, 0, 120) * m3 + torch.clamp(
-            img[:, :, 0] * 360 - 300, 0, 60) * m4
-
-        img = torch.stack((r, g, b), 2)
-        img[(img != img).detach()] = 0
-
-        img = img.permute(2, 1, 0)
-        img = img.contiguous()
-        img = torch.clamp(img, 0, 1)
+        h, s, v = img.unbind(-3)
 
-        return img
+        # channel n of RGB is v - v * s * clamp(min(k, 4 - k), 0, 1) with k = (n + 6h) mod 6 for n = 5, 3, 1
+        n = torch.tensor([5.0, 3.0, 1.0], dtype=img.dtype, device=img.device).view(3, 1, 1)
+        k = torch.remainder(n + h.unsqueeze(-3) * 6, 6)
+        img = v.unsqueeze(-3) * (1 - s.unsqueeze(-3) * torch.minimum(k, 4 - k).clamp(0, 1))
+
+        return torch.clamp(img, 0, 1)
 
     @staticmethod
     def rgb_to_hsv(img):
@@ -418,81 +721,68 @@ class ImageProcessing(object):
         PyTorch implementation of RGB to HSV conversion: https://docs.opencv.org/3.3.0/de/d25/imgproc_color_conversions.html
         Based roughly on a similar implementation here: http://code.activestate.com/recipes/576919-python-rgb-and-hsv-conversion/
 
-        :param img: RGB image
-        :returns: HSV image
+        :param img: RGB image in [0, 1] of shape (3, H, W) or (B, 3, H, W), on any device
+        :returns: HSV image in [0, 1], same shape
         :rtype: Tensor
 
         """
         img = torch.clamp(img, 0.000000001, 1)
+        r, g, b = img.unbind(-3)
 
-        img = img.permute(2, 1, 0)
-        # 3, H, W
-        shape = img.shape
-
-        img = img.contiguous()
-        img = img.view(-1, 3)
-
-        mx = torch.max(img, 1)[0]
-        mn = torch.min(img, 1)[0]
-
-        ones = Variable(torch.FloatTensor(
-            torch.ones((img.shape[0])))).cuda()
-        zero = Variable(torch.FloatTensor(torch.zeros(shape[0:2]))).cuda()
+        mx, argmx = img.max(-3)
+        df = mx - img.min(-3)[0]
+        df_safe = torch.where(df > 0, df, torch.ones_like(df))
 
-        img = img.view(shape)
+        # hue in 1/6 turns from the maximum channel, 0 for grey
+        h = torch.where(argmx == 0, torch.remainder((g - b) / df_safe, 6),
+                        torch.where(argmx == 1, (b - r) / df_safe + 2.0, (r - g) / df_safe + 4.0))
+        h = torch.where(df > 0, h / 6, torch.zeros_like(h))
+        s = df / mx
 
-        ones1 = ones[0:math.floor((ones.shape[0] / 2))]
-        ones2 = ones[math.floor(ones.shape[0] / 2):(ones.shape[0])]
+        img = torch.stack((h, s, mx), -3)
 
-        mx1 = mx[0:math.floor((ones.shape[0] / 2))]
-        mx2 = mx[math.floor(ones.shape[0] / 2):(ones.shape[0])]
-        mn1 = mn[0:math.floor((ones.shape[0] / 2))]
-        mn2 = mn[math.floor(ones.shape[0] / 2):(ones.shape[0])]
+        return torch.clamp(img, 0.000000001, 1)
 
-        df1 = torch.add(mx1, torch.mul(ones1 * -1, mn1))
-        df2 = torch.add(mx2, torch.mul(ones2 * -1, mn2))
-
-        df = torch.cat((df1, df2), 0)
-        del df1, df2
-        df = df.view(shape[0:2]) + 1e-10
-        mx = mx.view(shape[0:2])
-
-        img = img.cuda()
-        df = df.cuda()
-        mx = mx.cuda()
-
-        g = img[:, :, 1].clone().cuda()
-        b = img[:, :, 2].clone().cuda()
-        r = img[:, :, 0].clone().cuda()
-
-        img_copy = img.clone()
-
-        img_copy[:, :, 0] = (((g - b) / df) * r.eq(mx).float() + (2.0 + (b - r) / df)
-                             * g.eq(mx).float() + (4.0 + (r - g) / df) * b.eq(mx).float())
-        img_copy[:, :, 0] = img_copy[:, :, 0] * 60.0
+    @staticmethod
+    def curve_scale(x, C, clamp=True):
+        """Evaluates piecewise linear curves defined by a set of knot points, for every channel at once
 
-        zero = zero.cuda()
-        img_copy2 = img_copy.clone()
+        The curve starts at C[0] and follows the slopes between the knots over 'x' * (number of segments).
+        As in the original loop implementation, the last segment is not used.
 
-        img_copy2[:, :, 0] = img_copy[:, :, 0].lt(zero).float(
-        ) * (img_copy[:, :, 0] + 360) + img_copy[:, :, 0].ge(zero).float() * (img_copy[:, :, 0])
+        :param x: channels to evaluate the curves at, (B, N, H, W)
+        :param C: knot points of one curve per channel, (N, K + 1) or (B, N, K + 1)
+        :param clamp: saturate at the knots, otherwise extend the curve linearly
+        :returns: curve values, (B, N, H, W)
+        :rtype: Tensor
 
-        img_copy2[:, :, 0] = img_copy2[:, :, 0] / 360
+        """
+        C = C.expand(x.shape[0], *C.shape[-2:])
+        steps = C.shape[-1] - 1
+        slope = C[..., 1:] - C[..., :-1]
 
-        del img, r, g, b
+        if not clamp:
+            offset = C[..., 0] - (slope[..., :-1] * torch.arange(steps - 1, dtype=C.dtype, device=C.device)).sum(-1)
+            gain = slope[..., :-1].sum(-1) * steps
+            return offset[..., None, None] + gain[..., None, None] * x
 
-        img_copy2[:, :, 1] = mx.ne(zero).float() * (df / mx) + \
-                             mx.eq(zero).float() * (zero)
-        img_copy2[:, :, 2] = mx
+        # curve value and slope at every used knot. the last knot is flat to cover the upper end of the last segment
+        values = torch.cat([C[..., :1], C[..., :1] + slope[..., :-1].cumsum(-1)], -1)
+        slope = torch.cat([slope[..., :-1], torch.zeros_like(slope[..., :1])], -1)
 
-        img_copy2[(img_copy2 != img_copy2).detach()] = 0
+        position = (x * steps).clamp(0, max(steps - 1, 0))
+        index = position.long()     # floor, position is not negative
+        frac = position - index
 
-        img = img_copy2.clone()
+        index = index.flatten(2)
+        return values.gather(-1, index).view_as(x) + slope.gather(-1, index).view_as(x) * frac
 
-        img = img.permute(2, 1, 0)
-        img = torch.clamp(img, 0.000000001, 1)
+    @staticmethod
+    def curve_smoothness(C):
+        """Squared difference between consecutive slopes of the curves 'C' (..., K + 1), summed over the last dims"""
+        slope = C[..., 1:] - C[..., :-1]
 
-        return img
+        return ((slope[..., 1:] - slope[..., :-1]) ** 2).flatten(-2).sum(-1)
 
     @staticmethod
     def apply_curve(img, C, slope_sqr_diff, channel_in, channel_out,
@@ -500,246 +790,135 @@ class ImageProcessing(object):
         """Applies a peicewise linear curve defined by a set of knot points to
         an image channel
 
-        :param img: image to be adjusted
-        :param C: predicted knot points of curve
-        :returns: adjusted image
-        :rtype: Tensor
+        :param img: image to be adjusted, (3, H, W) or (B, 3, H, W)
+        :param C: predicted knot points of curve, (K + 1) or (B, K + 1)
+        :returns: adjusted image, slope_sqr_diff plus the regularisation term of the curve
+        :rtype: Tensor, Tensor
 
         """
-        slope = Variable(torch.zeros((C.shape[0] - 1))).cuda()
-        curve_steps = C.shape[0] - 1
-        '''
-        Compute the slope of the line segments
-        '''
-        for i in range(0, C.shape[0] - 1):
-            slope[i] = C[i + 1] - C[i]
+        unbatched = img.dim() == 3
+        if unbatched:
+            img = img.unsqueeze(0)
 
-        '''
-        Compute the squared difference between slopes
-        '''
-        for i in range(0, slope.shape[0] - 1):
-            slope_sqr_diff += (slope[i + 1] - slope[i]) * (slope[i + 1] - slope[i])
+        slope_sqr_diff = slope_sqr_diff + ImageProcessing.curve_smoothness(C.unsqueeze(-2))
 
-        '''
-        Use predicted line segments to compute scaling factors for the channel
-        '''
-        scale = float(C[0])
-        for i in range(0, slope.shape[0] - 1):
-            if clamp:
-                scale += float(slope[i]) * (torch.clamp(img[:, :, channel_in] * curve_steps - i, 0, 1))
-                # scale += float(slope[i]) * (torch.clamp(img[:, :, channel_in], 0, 1))
-            else:
-                scale += float(slope[i]) * (img[:, :, channel_in] * curve_steps - i)
-        img_copy = img.clone()
-
-        if same_channel:
-            # channel in and channel out are the same channel
-            img_copy[:, :, channel_out] = img[:, :, channel_in] * scale
-        else:
-            # otherwise
-            img_copy[:, :, channel_out] = img[:, :, channel_out] * scale
+        x = img[:, channel_in:channel_in + 1]
+        scale = ImageProcessing.curve_scale(x, C.unsqueeze(-2), clamp=clamp)
+        out = (x if same_channel else img[:, channel_out:channel_out + 1]) * scale
 
-        img_copy = torch.clamp(img_copy, 0, 1)
+        channels = list(img.unbind(1))
+        channels[channel_out] = out.squeeze(1)
+        img = torch.clamp(torch.stack(channels, 1), 0, 1)
+
+        return img.squeeze(0) if unbatched else img, slope_sqr_diff
+
+    @staticmethod
+    def split_curves(params, num_curves):
+        """Splits the predicted parameters (P) or (B, P) into 'num_curves' curves of positive knot points"""
+        knots = params.shape[-1] // num_curves
 
-        return img_copy, slope_sqr_diff
+        return torch.exp(params[..., :num_curves * knots]).unflatten(-1, (num_curves, knots))
 
     @staticmethod
     def adjust_hsv(img, S):
         """Adjust the HSV channels of a HSV image using learnt curves
 
-        :param img: image to be adjusted
-        :param S: predicted parameters of piecewise linear curves
+        :param img: image to be adjusted, (3, H, W) or (B, 3, H, W)
+        :param S: predicted parameters of piecewise linear curves, (P) or (B, P)
         :returns: adjust image, regularisation term
-        :rtype: Tensor, float
+        :rtype: Tensor, Tensor
 
         """
-        img = img.squeeze(0).permute(2, 1, 0)
-        shape = img.shape
-        img = img.contiguous()
+        unbatched = img.dim() == 3
+        if unbatched:
+            img = img.unsqueeze(0)
 
-        S1 = torch.exp(S[0:int(S.shape[0] / 4)])
-        S2 = torch.exp(S[(int(S.shape[0] / 4)):(int(S.shape[0] / 4) * 2)])
-        S3 = torch.exp(S[(int(S.shape[0] / 4) * 2):(int(S.shape[0] / 4) * 3)])
-        S4 = torch.exp(S[(int(S.shape[0] / 4) * 3):(int(S.shape[0] / 4) * 4)])
-
-        slope_sqr_diff = Variable(torch.zeros(1) * 0.0).cuda()
-
-        '''
-        Adjust Hue channel based on Hue using the predicted curve
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img, S1, slope_sqr_diff, channel_in=0, channel_out=0)
-
-        '''
-        Adjust Saturation channel based on Hue using the predicted curve
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, S2, slope_sqr_diff, channel_in=0, channel_out=1, same_channel=False)
+        curves = ImageProcessing.split_curves(S, 4)
+        h, s, v = img.unbind(1)
 
         '''
-        Adjust Saturation channel based on Saturation using the predicted curve
+        Adjust Hue channel based on Hue, then Saturation channel based on the adjusted Hue
         '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, S3, slope_sqr_diff, channel_in=1, channel_out=1)
+        h = torch.clamp(h * ImageProcessing.curve_scale(h.unsqueeze(1), curves[..., 0:1, :]).squeeze(1), 0, 1)
+        s = torch.clamp(s, 0, 1) * ImageProcessing.curve_scale(h.unsqueeze(1), curves[..., 1:2, :]).squeeze(1)
 
         '''
-        Adjust Value channel based on Value using the predicted curve
+        Adjust Saturation channel based on Saturation and Value channel based on Value using the predicted curves
         '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, S4, slope_sqr_diff, channel_in=2, channel_out=2)
+        sv = torch.clamp(torch.stack((s, v), 1), 0, 1)
+        sv = sv * ImageProcessing.curve_scale(sv, curves[..., 2:4, :])
 
-        img = img_copy.clone()
-        del img_copy
+        img = torch.clamp(torch.cat((h.unsqueeze(1), sv), 1), 0, 1)
+        img = torch.nan_to_num(img, nan=0.0)
+        slope_sqr_diff = ImageProcessing.curve_smoothness(curves)
 
-        img[(img != img).detach()] = 0
-
-        img = img.permute(2, 1, 0)
-        img = img.contiguous()
-
-        return img, slope_sqr_diff
+        return img.squeeze(0) if unbatched else img, slope_sqr_diff
 
     @staticmethod
     def adjust_sv(img, S):
         """Adjust the HSV channels of a HSV image using learnt curves
 
-        :param img: image to be adjusted
-        :param S: predicted parameters of piecewise linear curves
+        :param img: image to be adjusted, (3, H, W) or (B, 3, H, W)
+        :param S: predicted parameters of piecewise linear curves, (P) or (B, P)
         :returns: adjust image, regularisation term
-        :rtype: Tensor, float
+        :rtype: Tensor, Tensor
 
         """
-        img = img.squeeze(0).permute(2, 1, 0)
-        img = img.contiguous()
+        unbatched = img.dim() == 3
+        if unbatched:
+            img = img.unsqueeze(0)
 
-        S3 = torch.exp(S[(int(S.shape[0] / 2) * 0):(int(S.shape[0] / 2) * 1)])
-        S4 = torch.exp(S[(int(S.shape[0] / 2) * 1):(int(S.shape[0] / 2) * 2)])
-
-        slope_sqr_diff = Variable(torch.zeros(1) * 0.0).cuda()
+        curves = ImageProcessing.split_curves(S, 2)
 
         '''
-        Adjust Saturation channel based on Saturation using the predicted curve
+        Adjust Saturation channel based on Saturation and Value channel based on Value using the predicted curves
         '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img, S3, slope_sqr_diff, channel_in=1, channel_out=1)
-
-        '''
-        Adjust Value channel based on Value using the predicted curve
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, S4, slope_sqr_diff, channel_in=2, channel_out=2)
-
-        img = img_copy.clone()
-        del img_copy
+        sv = torch.clamp(img[:, 1:3], 0, 1)
+        sv = sv * ImageProcessing.curve_scale(sv, curves)
 
-        img[(img != img).detach()] = 0
+        img = torch.clamp(torch.cat((img[:, 0:1], sv), 1), 0, 1)
+        img = torch.nan_to_num(img, nan=0.0)
+        slope_sqr_diff = ImageProcessing.curve_smoothness(curves)
 
-        img = img.permute(2, 1, 0)
-        img = img.contiguous()
-
-        return img, slope_sqr_diff
+        return img.squeeze(0) if unbatched else img, slope_sqr_diff
 
     @staticmethod
     def adjust_rgb(img, R):
         """Adjust the RGB channels of a RGB image using learnt curves
 
-        :param img: image to be adjusted
-        :param S: predicted parameters of piecewise linear curves
+        :param img: image to be adjusted, (3, H, W) or (B, 3, H, W)
+        :param R: predicted parameters of piecewise linear curves, (P) or (B, P)
         :returns: adjust image, regularisation term
-        :rtype: Tensor, float
+        :rtype: Tensor, Tensor
 
         """
-        img = img.squeeze(0).permute(2, 1, 0)
-        shape = img.shape
-        img = img.contiguous()
-
-        '''
-        Extract the parameters of the three curves
-        '''
-        R1 = torch.exp(R[0:int(R.shape[0] / 3)])
-        R2 = torch.exp(R[(int(R.shape[0] / 3)):(int(R.shape[0] / 3) * 2)])
-        R3 = torch.exp(R[(int(R.shape[0] / 3) * 2):(int(R.shape[0] / 3) * 3)])
-
-        '''
-        Apply the curve to the R channel 
-        '''
-        slope_sqr_diff = Variable(torch.zeros(1) * 0.0).cuda()
-
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img, R1, slope_sqr_diff, channel_in=0, channel_out=0)
-
-        '''
-        Apply the curve to the G channel 
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, R2, slope_sqr_diff, channel_in=1, channel_out=1)
-
-        '''
-        Apply the curve to the B channel 
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, R3, slope_sqr_diff, channel_in=2, channel_out=2)
-
-        img = img_copy.clone()
-        del img_copy
-
-        img[(img != img).detach()] = 0
-
-        img = img.permute(2, 1, 0)
-        img = img.contiguous()
-
-        return img, slope_sqr_diff
+        return ImageProcessing._adjust_channels(img, R)
 
     @staticmethod
     def adjust_lab(img, L):
         """Adjusts the image in LAB space using the predicted curves
 
-        :param img: Image tensor
-        :param L: Predicited curve parameters for LAB channels
+        :param img: Image tensor, (3, H, W) or (B, 3, H, W)
+        :param L: Predicited curve parameters for LAB channels, (P) or (B, P)
         :returns: adjust image, and regularisation parameter
-        :rtype: Tensor, float
+        :rtype: Tensor, Tensor
 
         """
-        img = img.permute(2, 1, 0)
-
-        shape = img.shape
-        img = img.contiguous()
-
-        '''
-        Extract predicted parameters for each L,a,b curve
-        '''
-        L1 = torch.exp(L[0:int(L.shape[0] / 3)])
-        L2 = torch.exp(L[(int(L.shape[0] / 3)):(int(L.shape[0] / 3) * 2)])
-        L3 = torch.exp(L[(int(L.shape[0] / 3) * 2):(int(L.shape[0] / 3) * 3)])
-
-        slope_sqr_diff = Variable(torch.zeros(1) * 0.0).cuda()
+        return ImageProcessing._adjust_channels(img, L)
 
-        '''
-        Apply the curve to the L channel 
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img, L1, slope_sqr_diff, channel_in=0, channel_out=0)
-
-        '''
-        Now do the same for the a channel
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, L2, slope_sqr_diff, channel_in=1, channel_out=1)
-
-        '''
-        Now do the same for the b channel
-        '''
-        img_copy, slope_sqr_diff = ImageProcessing.apply_curve(
-            img_copy, L3, slope_sqr_diff, channel_in=2, channel_out=2)
-
-        img = img_copy.clone()
-        del img_copy
-
-        img[(img != img).detach()] = 0
+    @staticmethod
+    def _adjust_channels(img, params):
+        """Applies one predicted curve to each channel, based on the channel itself"""
+        unbatched = img.dim() == 3
+        if unbatched:
+            img = img.unsqueeze(0)
 
-        img = img.permute(2, 1, 0)
-        img = img.contiguous()
+        curves = ImageProcessing.split_curves(params, 3)
+        img = torch.clamp(img * ImageProcessing.curve_scale(img, curves), 0, 1)
+        img = torch.nan_to_num(img, nan=0.0)
+        slope_sqr_diff = ImageProcessing.curve_smoothness(curves)
 
-        return img, slope_sqr_diff
+        return img.squeeze(0) if unbatched else img, slope_sqr_diff
 
 
 def cut_mix(_input, mask_1, _refer, mask_2) -> (Image, Image):
@@ -805,66 +984,410 @@ def grey_to_heatmap(img):
     return heatmap
 
 
+def _edt_axis_binary(zero, dim):
+    """Squared distance to the nearest zero along 'dim' of a binary tensor, in linear time with cummax. inf if none"""
+    zero = zero.movedim(dim, -1)
+    n = zero.shape[-1]
+    pos = torch.arange(n, device=zero.device, dtype=torch.int32)
+
+    last_left = torch.where(zero, pos, torch.full_like(pos, -2 * n)).cummax(-1)[0]
+    first_right = torch.where(zero, pos, torch.full_like(pos, 3 * n)).flip(-1).cummin(-1)[0].flip(-1)
+    dist = torch.minimum(pos - last_left, first_right - pos).double()
+    dist = torch.where(dist > n, torch.full_like(dist, math.inf), dist)
+
+    return (dist * dist).movedim(-1, dim)
+
+
+def _edt_axis(f):
+    """
+    Squared euclidean distance transform along the first dim of 'f' (n, lines), where 'f' holds the squared distances
+    of the previous axes (inf for unknown). Computes min_y (x - y)^2 + f[y] with the lower envelope of parabolas of
+    Felzenszwalb & Huttenlocher, vectorized over lines and sequential over positions.
+    """
+    n, lines = f.shape
+    device = f.device
+    h = f + torch.arange(n, device=device, dtype=f.dtype)[:, None] ** 2    # f[y] + y^2
+    finite = torch.isfinite(f)
+
+    # envelope stacks. row 'n' is a dummy target for lines which skip the update
+    v = torch.zeros((n + 1, lines), dtype=torch.long, device=device)   # vertex of each parabola
+    z = torch.full((n + 1, lines), -math.inf, dtype=f.dtype, device=device)    # left boundary of each parabola
+    k = torch.full((1, lines), -1, dtype=torch.long, device=device)    # top of the stacks
+    dummy = torch.full_like(k, n)
+
+    for q in range(n):
+        hq = h[q:q + 1]
+        active = finite[q:q + 1]
+
+        # pop the parabolas hidden by the one of 'q'
+        while True:
+            kc = k.clamp(min=0)
+            vk = v.gather(0, kc)
+            s = (hq - h.gather(0, vk)) / (2 * (q - vk)).clamp(min=1)
+            pop = active & (k >= 0) & (s <= z.gather(0, kc))
+            if not pop.any():
+                break
+            k = k - pop.long()
+
+        k = k + active.long()
+        idx = torch.where(active, k, dummy)
+        v.scatter_(0, idx, torch.full_like(idx, q))
+        z.scatter_(0, idx, torch.where(k > 0, s, torch.full_like(s, -math.inf)))
+
+    # every position takes the last parabola whose left boundary is not after it
+    j = torch.arange(n + 1, device=device)[:, None]
+    start = torch.where(j <= k, z.clamp(min=0, max=n).ceil().long(), dummy)
+    label = torch.full((n + 1, lines), -1, dtype=torch.long, device=device)
+    label.scatter_reduce_(0, start, j.expand(n + 1, lines), 'amax')
+    label = label[:n].t().cummax(-1)[0].t().clamp(min=0)
+
+    vj = v.gather(0, label)
+    x = torch.arange(n, device=device, dtype=f.dtype)[:, None]
+    d = (x - vj) ** 2 + f.gather(0, vj)
+
+    return torch.where(k >= 0, d, torch.full_like(d, math.inf))
+
+
+@torch.no_grad()
+def distance_transform_edt(mask):
+    """
+    Exact euclidean distance transform of a batch of binary masks, computed on the device of 'mask'. CPU tensors go
+    through scipy, which is faster there than the sequential envelope of the torch version.
+    Same as 'scipy.ndimage.distance_transform_edt' on every mask[b, c]: non-zero elements get the distance to the
+    nearest zero element, zeros get 0. A mask without any zero element gets 0 everywhere.
+
+    :param mask: (b, c, x, y) or (b, c, x, y, z) tensor, non-zero for foreground
+    :returns: float tensor with the same shape
+    """
+    assert mask.dim() == 4 or mask.dim() == 5, "Only 2D and 3D supported"
+
+    if mask.device.type == 'cpu':
+        masks = (mask != 0).numpy().reshape(-1, *mask.shape[2:])
+        dt = [ndimage.distance_transform_edt(m) if not m.all() else np.zeros(m.shape) for m in masks]
+        return torch.from_numpy(np.stack(dt).reshape(mask.shape)).float()
+
+    zero = mask == 0
+    spatial_dims = list(range(2, mask.dim()))
+
+    # the longest axis takes the linear time pass, the others the sequential envelope
+    first_dim = max(spatial_dims, key=lambda d: mask.shape[d])
+    f = _edt_axis_binary(zero, first_dim)
+
+    for dim in spatial_dims:
+        if dim == first_dim:
+            continue
+        f = f.movedim(dim, 0)
+        shape = f.shape
+        f = _edt_axis(f.reshape(shape[0], -1)).reshape(shape).movedim(0, dim)
+
+    f = torch.where(torch.isfinite(f), f, torch.zeros_like(f))
+
+    return f.sqrt().float()
+
+
+def resize_target(target, size):
+    """
+    Class indices at 'size' with nearest neighbour sampling, e.g. the target of low resolution logits for the loss.
+
+    :param target: (b, h, w) or (b, 1, h, w) labels, returned unchanged if already at 'size'
+    :returns: the labels at 'size', in the layout and dtype of 'target'
+    """
+    size = tuple(size)
+    if tuple(target.shape[-2:]) == size:
+        return target
+
+    resized = F.interpolate(target.view(target.shape[0], 1, *target.shape[-2:]).float(), size=size, mode='nearest')
+
+    return resized.view(*target.shape[:-2], *size).to(target.dtype)
+
+
+def upsampled_argmax(output, size):
+    """Class map (b, h, w) of the logits (b, c, h', w') at 'size', upsampling low resolution logits only for the argmax"""
+    with torch.no_grad():
+        if tuple(output.shape[2:]) != tuple(size):
+            output = F.interpolate(output, size=tuple(size), mode='bilinear', align_corners=False)
+
+        return torch.argmax(output, dim=1)
+
+
+def binary_confusion(pred, target, threshold=0.5):
+    """
+    Per-sample confusion counts of binary predictions.
+
+    :param pred: (b, ...) probabilities, tensor or numpy array
+    :param target: (b, ...) binary labels
+    :returns: tp, tn, fp, fn as (b) int64 tensors
+    """
+    pred = torch.as_tensor(pred)
+    target = torch.as_tensor(target).to(pred.device)
+    dims = tuple(range(1, pred.dim()))
+
+    pred = pred > threshold
+    target = target > 0.5
+
+    tp = (pred & target).sum(dims)
+    fp = pred.sum(dims) - tp
+    fn = target.sum(dims) - tp
+    tn = math.prod(pred.shape[1:]) - tp - fp - fn
+
+    return tp, tn, fp, fn
+
+
+def confusion_metrics(tp, tn, fp, fn, epsilon=2.22045e-16):
+    """F1, accuracy, specificity, sensitivity, precision, IoU and MCC from confusion counts of any shape"""
+    tp, tn, fp, fn = [torch.as_tensor(v).double() for v in (tp, tn, fp, fn)]
+
+    sensitivity = tp / (tp + fn + epsilon)  # Recall
+    precision = tp / (tp + fp + epsilon)
+
+    return {'f1': (2 * sensitivity * precision) / (sensitivity + precision + epsilon),
+            'acc': (tp + tn) / (tp + tn + fp + fn + epsilon),
+            'spe': tn / (tn + fp + epsilon),
+            'sen': sensitivity,
+            'pre': precision,
+            'iou': tp / (tp + fp + fn + epsilon),
+            'mcc': (tp * tn - fp * fn) / torch.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn) + epsilon)}  # Matthews correlation coefficient
+
+
+def probability_histogram(prob, positive, n_bins, valid=None):
+    """
+    Counts of probabilities in 'n_bins' equal bins over [0, 1], split by ground truth.
+
+    :param prob: (b, c, ...) probabilities
+    :param positive: (b, c, ...) bool, ground truth of each probability
+    :param valid: (b, 1, ...) bool of the counted elements, or None for all
+    :returns: (2, c, n_bins) int64 tensor, [0] negatives and [1] positives
+    """
+    n_classes = prob.shape[1]
+    bins = (prob.detach() * n_bins).long().clamp(0, n_bins - 1)
+    bins = bins + torch.arange(n_classes, device=prob.device).view(1, -1, *[1] * (prob.dim() - 2)) * n_bins
+    bins = bins + positive.long() * (n_classes * n_bins)
+
+    if valid is not None:
+        bins = bins[valid.expand_as(bins)]
+
+    return torch.bincount(bins.flatten(), minlength=2 * n_classes * n_bins).view(2, n_classes, n_bins)
+
+
+def histogram_roc(hist):
+    """
+    ROC curves of the (2, c, n_bins) histogram of 'probability_histogram', one point per bin edge.
+
+    :returns: fpr, tpr (c, n_bins + 1) from the highest threshold down, and the thresholds (n_bins + 1)
+    """
+    n_bins = hist.shape[-1]
+    hist = hist.double()
+
+    # counts at or above each bin edge, from the top
+    zero = torch.zeros_like(hist[..., :1])
+    above = torch.cat([zero, hist.flip(-1).cumsum(-1)], -1)
+    fpr = above[0] / above[0, :, -1:].clamp(min=1)
+    tpr = above[1] / above[1, :, -1:].clamp(min=1)
+    thresholds = torch.linspace(1, 0, n_bins + 1, dtype=torch.float64, device=hist.device)
+
+    return fpr, tpr, thresholds
+
+
+def histogram_auc(hist):
+    """Area under the ROC curves of the (2, c, n_bins) histogram, (c). Exact up to ties within a bin"""
+    fpr, tpr, _ = histogram_roc(hist)
+
+    return torch.trapezoid(tpr, fpr, dim=-1)
+
+
+class StreamBinaryMetrics(_StreamMetrics):
+    """
+    Stream Metrics for binary segmentation.
+
+    Threshold metrics are computed per image from batched confusion counts and averaged over images.
+    AUC is computed over all pixels from a fixed-bin histogram of probabilities, so memory stays constant.
+    """
+
+    def __init__(self, threshold=0.5, b_auc=False, n_bins=1000):
+        self.threshold = threshold
+        self.b_auc = b_auc
+        self.n_bins = n_bins
+        self.reset()
+
+    def update(self, label_trues, label_preds):
+        """
+        :param label_trues: (b, ...) binary labels, tensor or numpy array
+        :param label_preds: (b, ...) probabilities
+        """
+        label_preds = torch.as_tensor(label_preds)
+        label_trues = torch.as_tensor(label_trues).to(label_preds.device)
+
+        for key, value in confusion_metrics(*binary_confusion(label_preds, label_trues, self.threshold)).items():
+            self.metric_sum[key] = self.metric_sum.get(key, 0) + value.sum()
+        self.count += len(label_preds)
+
+        if self.b_auc:
+            hist = probability_histogram(label_preds.unsqueeze(1), (label_trues > 0.5).unsqueeze(1), self.n_bins)
+            self.hist = hist if self.hist is None else self.hist + hist.to(self.hist.device)
+
+    @staticmethod
+    def to_str(results):
+        string = "\n"
+        for k, v in results.items():
+            string += "%s: %f\n" % (k, v)
+
+        return string
+
+    def get_results(self):
+        output = {key: (value / max(self.count, 1)).item() for key, value in self.metric_sum.items()}
+
+        if self.b_auc:
+            output['auc'] = histogram_auc(self.hist)[0].item() if self.hist is not None else float('nan')
+
+        return output
+
+    def reset(self):
+        self.metric_sum = dict()
+        self.count = 0
+        self.hist = None
+
+
 def metrics_np(np_res, np_gnd, b_auc=False):
-    f1m = []
-    accm = []
-    aucm = []
-    specificitym = []
-    precisionm = []
-    sensitivitym = []
-    ioum = []
-    mccm = []
-
-    epsilon = 2.22045e-16
-
-    for i in range(np_res.shape[0]):
-        label = np_gnd[i, :, :]
-        pred = np_res[i, :, :]
-        label = label.flatten()
-        pred = pred.flatten()
-        # assert label.max() == 1 and (pred).max() <= 1
-        # assert label.min() == 0 and (pred).min() >= 0
-
-        y_pred = np.zeros_like(pred)
-        y_pred[pred > 0.5] = 1
-
-        try:
-            tn, fp, fn, tp = confusion_matrix(y_true=label, y_pred=y_pred).ravel()  # for binary
-        except ValueError as e:
-            tn, fp, fn, tp = 0, 0, 0, 0
-        accuracy = (tp + tn) / (tp + tn + fp + fn + epsilon)
-        specificity = tn / (tn + fp + epsilon)  #
-        sensitivity = tp / (tp + fn + epsilon)  # Recall
-        precision = tp / (tp + fp + epsilon)
-        f1_score = (2 * sensitivity * precision) / (sensitivity + precision + epsilon)
-        iou = tp + (tp + fp + fn + epsilon)
-
-        tp_tmp, tn_tmp, fp_tmp, fn_tmp = tp / 1000, tn / 1000, fp / 1000, fn / 1000     # to prevent overflowing
-        mcc = (tp_tmp * tn_tmp - fp_tmp * fn_tmp) / math.sqrt((tp_tmp + fp_tmp) * (tp_tmp + fn_tmp) * (tn_tmp + fp_tmp) * (tn_tmp + fn_tmp) + epsilon)  # Matthews correlation coefficient
-
-        f1m.append(f1_score)
-        accm.append(accuracy)
-        specificitym.append(specificity)
-        precisionm.append(precision)
-        sensitivitym.append(sensitivity)
-        ioum.append(iou)
-        mccm.append(mcc)
-        if b_auc:
-            fpr, tpr, thresholds = roc_curve(sorted(y_pred), sorted(label))
-            AUC = auc(fpr, tpr)
-            aucm.append(AUC)
-
-    output = dict()
-    output['f1'] = np.array(f1m).mean()
-    output['acc'] = np.array(accm).mean()
-    output['spe'] = np.array(specificitym).mean()
-    output['sen'] = np.array(sensitivitym).mean()
-    output['iou'] = np.array(ioum).mean()
-    output['pre'] = np.array(precisionm).mean()
-    output['mcc'] = np.array(mccm).mean()
-
-    if b_auc:
-        output['auc'] = np.array(aucm).mean()
-
-    return output
+    """
+    F1, accuracy, specificity, sensitivity, IoU, precision and MCC averaged over the images of a batch,
+    and the AUC over all of its pixels when 'b_auc'.
 
+    :param np_res: (b, h, w) predicted probabilities
+    :param np_gnd: (b, h, w) binary labels
+    """
+    metric = StreamBinaryMetrics(threshold=0.5, b_auc=b_auc)
+    metric.update(np_gnd, np_res)
+
+    return metric.get_results()
+
+
+def main():
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    img = torch.rand((16, 3, 480, 640), device=device)
+
+    # round trip accuracy and throughput of the color conversions, batch 16 at 640x480
+    for name, forward, backward in [('HSV', ImageProcessing.rgb_to_hsv, ImageProcessing.hsv_to_rgb),
+                                    ('LAB', ImageProcessing.rgb_to_lab, ImageProcessing.lab_to_rgb)]:
+        converted = forward(img)
+        error = (backward(converted) - img).abs().max().item()
+
+        backward(forward(img))   # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        tt = time.perf_counter()
+        for _ in range(5):
+            backward(forward(img))
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elapsed = (time.perf_counter() - tt) / 5
+
+        print(f'RGB -> {name} -> RGB ({device.type}): max abs error {error:.2e}, '
+              f'{img.shape[0] / elapsed:.1f} images/sec for both conversions')
+
+    # vectorized curves against the per-knot loop, one curve of 16 knots per RGB channel
+    def adjust_rgb_loop(img, R):
+        curves = torch.exp(R).view(3, -1)
+        out = img.clone()
+        for channel in range(3):
+            C = curves[channel]
+            slope = C[1:] - C[:-1]
+            scale = float(C[0])
+            for i in range(0, slope.shape[0] - 1):
+                scale += float(slope[i]) * torch.clamp(img[channel] * (C.shape[0] - 1) - i, 0, 1)
+            out[channel] = img[channel] * scale
+        return torch.clamp(out, 0, 1)
+
+    params = torch.randn((16, 48), device=device) * 0.1
+
+    for name, function in [('loop per image', lambda: [adjust_rgb_loop(img[i], params[i]) for i in range(len(img))]),
+                           ('vectorized batch', lambda: ImageProcessing.adjust_rgb(img, params))]:
+        function()  # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        tt = time.perf_counter()
+        function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        print(f'adjust_rgb {name} ({device.type}): {(time.perf_counter() - tt) * 1000:.1f} ms')
+
+    error = max((adjust_rgb_loop(img[i], params[i]) - ImageProcessing.adjust_rgb(img, params)[0][i]).abs().max().item() for i in range(2))
+    print(f'adjust_rgb max abs error: {error:.2e}')
+
+    # binary metrics against sklearn, on the same batch of probabilities
+    from sklearn.metrics import f1_score, precision_score, recall_score, roc_auc_score, matthews_corrcoef
+
+    rng = np.random.default_rng(0)
+    gnd = (rng.random((4, 64, 48)) < 0.3).astype(np.float32)
+    res = np.clip(gnd * 0.35 + rng.random(gnd.shape) * 0.65, 0, 1).astype(np.float32)
+    results = metrics_np(res, gnd, b_auc=True)
+    expected = {'f1': np.mean([f1_score(g.ravel(), r.ravel() > 0.5) for g, r in zip(gnd, res)]),
+                'pre': np.mean([precision_score(g.ravel(), r.ravel() > 0.5) for g, r in zip(gnd, res)]),
+                'sen': np.mean([recall_score(g.ravel(), r.ravel() > 0.5) for g, r in zip(gnd, res)]),
+                'spe': np.mean([recall_score(g.ravel(), r.ravel() > 0.5, pos_label=0) for g, r in zip(gnd, res)]),
+                'mcc': np.mean([matthews_corrcoef(g.ravel(), r.ravel() > 0.5) for g, r in zip(gnd, res)]),
+                'auc': roc_auc_score(gnd.ravel(), res.ravel())}
+    error = max(abs(results[k] - v) for k, v in expected.items() if k != 'auc')
+    print(f'metrics_np against sklearn: max abs error {error:.2e} (f1, pre, sen, spe, mcc), '
+          f'auc {results["auc"]:.4f} vs {expected["auc"]:.4f} (binned to 1/1000)')
+
+    # foreach EMA against timm ModelEmaV2, per step
+    from timm.utils import ModelEmaV2
+    import torchvision
+
+    model = torchvision.models.resnet50().to(device)
+    for name, ema in [('timm ModelEmaV2', ModelEmaV2(model, decay=0.999)),
+                      ('ModelEma', ModelEma(model, decay=0.999)),
+                      ('ModelEma update_every 4', ModelEma(model, decay=0.999, update_every=4)),
+                      ('ModelEma cpu', ModelEma(model, decay=0.999, device='cpu'))]:
+        ema.update(model)   # warmup
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        tt = time.perf_counter()
+        for _ in range(20):
+            ema.update(model)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        print(f'{name} ({device.type}): {(time.perf_counter() - tt) / 20 * 1000:.2f} ms per step')
+
+    # BatchNorm folding: parity and CPU latency per model
+    from models import model_implements
+    from models.backbones.Fast_SCNN import FastSCNN
+    from models.backbones.MobileNetV3 import mobilenetv3_large
+
+    x = torch.rand(2, 3, 224, 224)
+    for name, model, inputs in [('Unet', model_implements.Unet(n_channels=3, n_classes=2), (x,)),
+                                ('ResNet18_multihead', model_implements.ResNet18_multihead(), (x,)),
+                                ('DeepLabV3_Res50', model_implements.DeepLabV3_Res50(), (x, [0, 3])),
+                                ('FastSCNN', FastSCNN(num_classes=2), (x,)),
+                                ('MobileNetV3', mobilenetv3_large(), (x,)),
+                                ('conv -> ReLU -> BN -> conv -> ReLU, nothing to fold',
+                                 torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.BatchNorm2d(8),
+                                                     torch.nn.Conv2d(8, 8, 3, padding=1), torch.nn.ReLU()), (x,))]:
+        model.eval()
+        for module in model.modules():
+            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):   # non-trivial statistics
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2)
+
+        def timed():
+            with torch.no_grad():
+                output = model(*inputs)
+                tt = time.perf_counter()
+                for _ in range(5):
+                    model(*inputs)
+            return output, (time.perf_counter() - tt) / 5 * 1000
+
+        expected, latency = timed()
+        _, folded = fuse_for_inference(model, *inputs)
+        output, fused_latency = timed()
+
+        if isinstance(output, (tuple, list)):
+            output, expected = output[0], expected[0]
+        error = ((output - expected).abs().max() / expected.abs().max()).item()
+        print(f'{name}: {folded} BatchNorms folded, max relative error {error:.2e}, '
+              f'{latency:.1f} -> {fused_latency:.1f} ms (cpu, batch 2 at 224x224), '
+              f'second pass folds {fuse_for_inference(model, *inputs)[1]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ from models import lr_scheduler
 from models import model_implements
 from models import losses as loss_hub
 from models import metrics
+from models import utils
 
 from datetime import datetime
 
@@ -63,13 +64,20 @@ class Trainer_cls:
 
         self.__validate_interval = 1 if (self.loader_train.__len__() // self.args.train_fold) == 0 else self.loader_train.__len__() // self.args.train_fold
 
+        self.stall_monitor = utils.DataStallMonitor(self.args.stall_threshold if hasattr(self.args, 'stall_threshold') else 0.3)
+        self.profiler = self._init_profiler(['data', 'h2d', 'forward', 'loss', 'backward', 'optimizer', 'metric'])
+
         # self.amp_scaler = torch.cuda.amp.GradScaler()
 
     def _train(self, epoch):
         self.model.train()
         batch_losses = []
         print('Start Train')
+        self.profiler.start()
+        self.stall_monitor.wait()
         for batch_idx, (x_in, target) in enumerate(self.loader_train):
+            self.profiler.lap('data')
+            self.stall_monitor.data_ready()
             # if (x_in[0].shape[0] / torch.cuda.device_count()) <= torch.cuda.device_count():   # if has 1 batch per GPU
             #     break   # avoid BN issue
             x_in, _ = x_in
@@ -77,23 +85,30 @@ class Trainer_cls:
 
             x_in = x_in.to(self.device)
             target = target.long().to(self.device)  # (shape: (batch_size, img_h, img_w))
+            self.profiler.lap('h2d')
 
             output = self.model(x_in)
+            self.profiler.lap('forward')
             loss = self.criterion(output, target)
 
             if not torch.isfinite(loss):
                 raise Exception('Loss is NAN. End training.')
+            self.profiler.lap('loss')
 
             self.optimizer.zero_grad()
             loss.backward()
+            self.profiler.lap('backward')
             self.optimizer.step()
             if self.scheduler is not None:
                 self.scheduler.step()
+            self.profiler.lap('optimizer')
 
             batch_losses.append(loss.item())
 
             output_argmax = torch.argmax(output, dim=1).cpu()
             self.metric_train.update(target.cpu().detach().numpy(), output_argmax.numpy())
+            self.profiler.lap('metric')
+            self.stall_monitor.step_end()
 
             if hasattr(self.args, 'train_fold'):
                 if batch_idx != 0 and (batch_idx % self.__validate_interval) == 0:
@@ -105,8 +120,16 @@ class Trainer_cls:
                                                                     self.args.criterion,
                                                                     loss_mean,
                                                                     self.optimizer.param_groups[0]['lr']))
+                if self.stall_monitor.is_stalled():
+                    print('{} epoch / Data Wait Ratio {} : waiting on data loader'.format(epoch,
+                                                                                  self.stall_monitor.get_results()['Data Wait Ratio']))
+
+            if self.profiler.enabled and self.profiler.global_step > 0 and self.profiler.global_step % self.args.profile_interval == 0:
+                self._log_profile(epoch)
 
             torch.cuda.empty_cache()
+            self.profiler.step()
+            self.stall_monitor.wait()
 
         loss_mean = np.mean(batch_losses)
         metrics = self.metric_train.get_results()
@@ -130,6 +153,7 @@ class Trainer_cls:
                        f'Train Mean Kappa Score': mean_kappa_score,
                        f'Train Mean Accuracy': mean_acc_score})
 
+        self._log_data_stall(epoch)
         self.metric_train.reset()
 
     def _validate(self, epoch):
@@ -175,11 +199,14 @@ class Trainer_cls:
         self.metric_val.reset()
 
     def start_train(self):
-        for epoch in range(1, self.args.epoch + 1):
-            self._train(epoch)
-            self._validate(epoch)
+        try:
+            for epoch in range(1, self.args.epoch + 1):
+                self._train(epoch)
+                self._validate(epoch)
 
-            print('### {} / {} epoch ended###'.format(epoch, self.args.epoch))
+                print('### {} / {} epoch ended###'.format(epoch, self.args.epoch))
+        finally:
+            self.profiler.close()
 
     def save_model(self, model_name, epoch, metric=None, best_flag=False, metric_name='metric'):
         file_path = self.saved_model_directory + '/'
@@ -198,6 +225,27 @@ class Trainer_cls:
 
         print(file_format + '\t model saved!!')
 
+    def _log_data_stall(self, epoch):
+        results = self.stall_monitor.get_results()
+        print(f'{epoch} epoch / Train Data Wait Ratio : {results["Data Wait Ratio"]}, '
+              f'Data Wait per Step : {results["Data Wait per Step"]}')
+
+        if self.stall_monitor.is_stalled():
+            print(f'{epoch} epoch / Data loader is starving the device. '
+                  f'Consider to tune "worker" and "prefetch_factor" (bash bash_tune_dataloader.sh)')
+
+        if self.args.wandb:
+            wandb.log({'Train Data Wait Ratio': results['Data Wait Ratio']})
+
+        self.stall_monitor.reset()
+
+    def _log_profile(self, epoch):
+        results = self.profiler.get_results()
+        print(f'{epoch} epoch / Step profile over last {self.profiler.count} steps\n' + self.profiler.to_str(results))
+
+        if self.args.wandb:
+            wandb.log(self.profiler.to_wandb(results))
+
     def __init_data_loader(self,
                            x_path,
                            batch_size,
@@ -208,6 +256,7 @@ class Trainer_cls:
                                                            batch_size=batch_size,
                                                            num_workers=self.args.worker,
                                                            pin_memory=self.args.pin_memory,
+                                                           prefetch_factor=self.args.prefetch_factor if hasattr(self.args, 'prefetch_factor') else 2,
                                                            mode=mode,
                                                            args=self.args)
 
@@ -225,6 +274,14 @@ class Trainer_cls:
     def _init_criterion(self, criterion_name):
         if criterion_name == 'CE':
             criterion = loss_hub.CrossEntropy().to(self.device)
+        elif criterion_name == 'OHEM':
+            criterion = loss_hub.OHEMCrossEntropy(top_k=self.args.ohem_top_k if hasattr(self.args, 'ohem_top_k') else 0.25,
+                                                  threshold=self.args.ohem_threshold if hasattr(self.args, 'ohem_threshold') else None,
+                                                  class_weight=self.args.class_weight if hasattr(self.args, 'class_weight') else None).to(self.device)
+        elif criterion_name == 'Compound':
+            criterion = loss_hub.CompoundLoss(self.args.compound_weights if hasattr(self.args, 'compound_weights') else None,
+                                              activation=self.args.compound_activation if hasattr(self.args, 'compound_activation') else 'softmax',
+                                              class_weight=self.args.class_weight if hasattr(self.args, 'class_weight') else None).to(self.device)
         elif criterion_name == 'HausdorffDT':
             criterion = loss_hub.HausdorffDTLoss().to(self.device)
         elif criterion_name == 'KLDivergence':
@@ -258,6 +315,18 @@ class Trainer_cls:
 
         return criterion
 
+    def _init_profiler(self, stages):
+        enabled = self.args.profile if hasattr(self.args, 'profile') else False
+        if enabled and not hasattr(self.args, 'profile_interval'):
+            self.args.profile_interval = 100
+
+        return utils.StepProfiler(stages,
+                                  self.device,
+                                  enabled=enabled,
+                                  sync=self.args.profile_sync if hasattr(self.args, 'profile_sync') else False,
+                                  trace_steps=self.args.profile_trace_steps if hasattr(self.args, 'profile_trace_steps') else None,
+                                  trace_dir=self.saved_model_directory)
+
     def _init_optimizer(self, model, lr):
         optimizer = None
 
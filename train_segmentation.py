@@ -1,6 +1,8 @@
 import torch
 import time
 import os
+import copy
+import math
 import wandb
 import numpy as np
 import sys
@@ -10,9 +12,10 @@ from models import lr_scheduler
 from models import model_implements
 from models import losses as loss_hub
 from models import metrics
+from models import utils
 
 from datetime import datetime
-from timm.utils import ModelEmaV2, get_state_dict
+from timm.utils import get_state_dict
 
 
 class Trainer_seg:
@@ -35,6 +38,8 @@ class Trainer_seg:
                                                   batch_size=1,
                                                   mode='validation')
 
+        self.loader_val_batches = self.__init_val_cache(self.loader_val)
+
         self.model = self.__init_model(self.args.model_name)
         self.optimizer = self._init_optimizer(self.args.optimizer, self.model, self.args.lr)
         self.scheduler = self._set_scheduler(self.optimizer, self.args.scheduler, self.loader_train, self.args.batch_size)
@@ -51,7 +56,11 @@ class Trainer_seg:
 
         # Important to create EMA model after cuda(), DP wrapper, and AMP but before SyncBN and DDP wrapper
         if self.args.ema_decay != 0:
-            self.model_ema = ModelEmaV2(self.model, decay=self.args.ema_decay, device=self.device)
+            self.model_ema = utils.ModelEma(self.model,
+                                            decay=self.args.ema_decay,
+                                            update_every=self.args.ema_update_every if hasattr(self.args, 'ema_update_every') else 1,
+                                            warmup=self.args.ema_warmup if hasattr(self.args, 'ema_warmup') else False,
+                                            device='cpu' if hasattr(self.args, 'ema_cpu') and self.args.ema_cpu else self.device)
 
         self.criterion = self._init_criterion(self.args.criterion)
 
@@ -64,17 +73,28 @@ class Trainer_seg:
 
         self.metric_train = metrics.StreamSegMetrics_segmentation(self.args.num_class)
         self.metric_val = metrics.StreamSegMetrics_segmentation(self.args.num_class)
+        self.metric_val_hd = metrics.StreamHausdorffMetrics(self.args.num_class,
+                                                            backend=self.args.hd_backend if hasattr(self.args, 'hd_backend') else 'thread',
+                                                            num_workers=self.args.hd_worker if hasattr(self.args, 'hd_worker') else None) \
+            if hasattr(self.args, 'hd_metric') and self.args.hd_metric else None
         self.metric_best = {'cIoU': 0, 'mIoU': 0}
         self.model_post_path_dict = {}
         self.last_saved_epoch = 0
 
         self.__validate_interval = 1 if (self.loader_train.__len__() // self.args.train_fold) == 0 else self.loader_train.__len__() // self.args.train_fold
 
+        self.stall_monitor = utils.DataStallMonitor(self.args.stall_threshold if hasattr(self.args, 'stall_threshold') else 0.3)
+        self.profiler = self._init_profiler(['data', 'h2d', 'forward', 'metric', 'loss', 'backward', 'optimizer', 'ema'])
+
     def _train(self, epoch):
         self.model.train()
         batch_losses = []
         print('Start Train')
+        self.profiler.start()
+        self.stall_monitor.wait()
         for batch_idx, (x_in, target) in enumerate(self.loader_train.Loader):
+            self.profiler.lap('data')
+            self.stall_monitor.data_ready()
             if (x_in[0].shape[0] / torch.cuda.device_count()) <= torch.cuda.device_count():   # if has 1 batch per GPU
                 break   # avoid BN issue
             x_in, _ = x_in
@@ -82,33 +102,41 @@ class Trainer_seg:
 
             x_in = x_in.to(self.device)
             target = target.long().to(self.device)  # (shape: (batch_size, img_h, img_w))
+            self.profiler.lap('h2d')
 
             output = self.model(x_in)
+            self.profiler.lap('forward')
 
             # compute metric
-            output_argmax = torch.argmax(output, dim=1).cpu()
+            output_argmax = utils.upsampled_argmax(output, target.shape[-2:]).cpu()
             self.metric_train.update(target.cpu().detach().numpy(), output_argmax.numpy())
+            self.profiler.lap('metric')
 
             # compute loss
-            loss = self.criterion(output, target)
+            loss = self.criterion(output, utils.resize_target(target, output.shape[2:]))
 
             if not torch.isfinite(loss):
                 raise Exception('Loss is NAN. End training.')
+            self.profiler.lap('loss')
 
             self.optimizer.zero_grad()
             loss.backward()
+            self.profiler.lap('backward')
             self.optimizer.step()
             if self.scheduler is not None:
                 self.scheduler.step()
+            self.profiler.lap('optimizer')
             if self.args.ema_decay != 0:
                 self.model_ema.update(self.model)
+                self.profiler.lap('ema')
 
             batch_losses.append(loss.item())
+            self.stall_monitor.step_end()
 
             if hasattr(self.args, 'train_fold'):
                 if batch_idx != 0 and (batch_idx % self.__validate_interval) == 0 and not (batch_idx != len(self.loader_train) - 1):
                     if self.args.ema_decay != 0:
-                        self._validate(self.model_ema.module, epoch)
+                        self._validate(self._ema_model(), epoch)
                     else:
                         self._validate(self.model, epoch)
 
@@ -118,8 +146,16 @@ class Trainer_seg:
                                                                     self.args.criterion,
                                                                     loss_mean,
                                                                     self.optimizer.param_groups[0]['lr']))
+                if self.stall_monitor.is_stalled():
+                    print('{} epoch / Data Wait Ratio {} : waiting on data loader'.format(epoch,
+                                                                                  self.stall_monitor.get_results()['Data Wait Ratio']))
+
+            if self.profiler.enabled and self.profiler.global_step > 0 and self.profiler.global_step % self.args.profile_interval == 0:
+                self._log_profile(epoch)
 
             torch.cuda.empty_cache()
+            self.profiler.step()
+            self.stall_monitor.wait()
 
         loss_mean = np.mean(batch_losses)
         metrics = self.metric_train.get_results()
@@ -141,12 +177,13 @@ class Trainer_seg:
             for i in range(self.args.num_class):
                 wandb.log({f'Train Class {i} IoU': cIoU[i]})
 
+        self._log_data_stall(epoch)
         self.metric_train.reset()
 
     def _validate(self, model, epoch):
         model.eval()
 
-        for batch_idx, (x_in, target) in enumerate(self.loader_val.Loader):
+        for batch_idx, (x_in, target) in enumerate(self.loader_val_batches):
             with torch.no_grad():
                 x_in, _ = x_in
                 target, _ = target
@@ -157,8 +194,10 @@ class Trainer_seg:
                 output = model(x_in)
 
                 # compute metric
-                output_argmax = torch.argmax(output, dim=1).cpu()
-                self.metric_val.update(target.cpu().detach().numpy(), output_argmax.numpy())
+                output_argmax = utils.upsampled_argmax(output, target.shape[-2:])
+                self.metric_val.update(target.cpu().detach().numpy(), output_argmax.cpu().numpy())
+                if self.metric_val_hd is not None:
+                    self.metric_val_hd.update(target, output_argmax)
 
                 # Log Image on WandB
                 # if (batch_idx == 0) and self.args.wandb and (epoch % self.args.save_interval == 0):
@@ -192,6 +231,19 @@ class Trainer_seg:
             for i in range(self.args.num_class):
                 wandb.log({f'Val Class {i} IoU': cIoU[i]})
 
+        if self.metric_val_hd is not None:
+            metrics_hd = self.metric_val_hd.get_results()
+            print(f'{epoch} epoch / Val Mean HD: {metrics_hd["Mean HD"]} / Val Mean HD95: {metrics_hd["Mean HD95"]}')
+            for i in metrics_hd['Class HD'].keys():
+                print(f'{epoch} epoch / Val Class {i} HD: {metrics_hd["Class HD"][i]} / Val Class {i} HD95: {metrics_hd["Class HD95"][i]}')
+
+            if self.args.wandb:
+                wandb.log({'Val Mean HD': metrics_hd['Mean HD'], 'Val Mean HD95': metrics_hd['Mean HD95']})
+                for i in metrics_hd['Class HD'].keys():
+                    wandb.log({f'Val Class {i} HD': metrics_hd['Class HD'][i], f'Val Class {i} HD95': metrics_hd['Class HD95'][i]})
+
+            self.metric_val_hd.reset()
+
         model_metrics = {'cIoU': cIoU[1], 'mIoU': mIoU}     # cIoU
 
         for key in model_metrics.keys():
@@ -208,14 +260,28 @@ class Trainer_seg:
             sys.exit()  # safe exit
 
     def start_train(self):
-        for epoch in range(1, self.args.epoch + 1):
-            self._train(epoch)
-            if self.args.ema_decay != 0:
-                self._validate(self.model_ema.module, epoch)
-            else:
-                self._validate(self.model, epoch)
+        try:
+            for epoch in range(1, self.args.epoch + 1):
+                self._train(epoch)
+                if self.args.ema_decay != 0:
+                    self._validate(self._ema_model(), epoch)
+                else:
+                    self._validate(self.model, epoch)
+
+                self._log_image_cache(epoch)
+
+                print('### {} / {} epoch ended###'.format(epoch, self.args.epoch))
+        finally:
+            self.profiler.close()   # also on the early stop exit
+            if self.metric_val_hd is not None:
+                self.metric_val_hd.close()
 
-            print('### {} / {} epoch ended###'.format(epoch, self.args.epoch))
+    def _ema_model(self):
+        model = self.model_ema.module
+        if next(model.parameters()).device != self.device:
+            model = copy.deepcopy(model).to(self.device)    # EMA kept on the CPU, validate a device copy
+
+        return model
 
     def save_model(self, model, model_name, epoch, metric=None, best_flag=False, metric_name='metric'):
         file_path = self.saved_model_directory + '/'
@@ -238,6 +304,43 @@ class Trainer_seg:
         print(file_format + '\t model saved!!')
         self.last_saved_epoch = epoch
 
+    def _log_image_cache(self, epoch):
+        for split, loader in [('Train', self.loader_train), ('Val', self.loader_val)]:
+            image_cache = loader.image_loader.image_cache
+            if image_cache is None:
+                continue
+
+            results = image_cache.get_results()
+            print(f'{epoch} epoch / {split} Image Cache Hit Rate : {results["Cache Hit Rate"]}, '
+                  f'Bytes Saved : {results["Cache Bytes Saved"]}, Bytes Used : {results["Cache Bytes Used"]}')
+
+            if self.args.wandb:
+                wandb.log({f'{split} Image Cache Hit Rate': results['Cache Hit Rate'],
+                           f'{split} Image Cache Bytes Saved': results['Cache Bytes Saved']})
+
+            image_cache.reset()
+
+    def _log_data_stall(self, epoch):
+        results = self.stall_monitor.get_results()
+        print(f'{epoch} epoch / Train Data Wait Ratio : {results["Data Wait Ratio"]}, '
+              f'Data Wait per Step : {results["Data Wait per Step"]}')
+
+        if self.stall_monitor.is_stalled():
+            print(f'{epoch} epoch / Data loader is starving the device. '
+                  f'Consider to tune "worker" and "prefetch_factor" (bash bash_tune_dataloader.sh)')
+
+        if self.args.wandb:
+            wandb.log({'Train Data Wait Ratio': results['Data Wait Ratio']})
+
+        self.stall_monitor.reset()
+
+    def _log_profile(self, epoch):
+        results = self.profiler.get_results()
+        print(f'{epoch} epoch / Step profile over last {self.profiler.count} steps\n' + self.profiler.to_str(results))
+
+        if self.args.wandb:
+            wandb.log(self.profiler.to_wandb(results))
+
     def __init_data_loader(self,
                            x_path,
                            y_path,
@@ -250,6 +353,7 @@ class Trainer_seg:
                                                           batch_size=batch_size,
                                                           num_workers=self.args.worker,
                                                           pin_memory=self.args.pin_memory,
+                                                          prefetch_factor=self.args.prefetch_factor if hasattr(self.args, 'prefetch_factor') else 2,
                                                           mode=mode,
                                                           args=self.args)
         else:
@@ -257,12 +361,29 @@ class Trainer_seg:
 
         return loader
 
+    def __init_val_cache(self, loader):
+        # validation loader is deterministic, so the preprocessed batches can be replayed after the first pass
+        if not (hasattr(self.args, 'val_cache') and self.args.val_cache):
+            return loader.Loader
+
+        return dataloader_hub.CachedBatchLoader(loader.Loader,
+                                                self.device,
+                                                device_budget_bytes=self.args.val_cache_device_mb * 2 ** 20 if hasattr(self.args, 'val_cache_device_mb') else 0,
+                                                ram_budget_bytes=self.args.val_cache_ram_mb * 2 ** 20 if hasattr(self.args, 'val_cache_ram_mb') else 0,
+                                                mmap_dir=self.args.val_cache_dir if hasattr(self.args, 'val_cache_dir') else None)
+
     def __init_model(self, model_name):
         if model_name == 'Unet':
             model = model_implements.Unet(n_channels=self.args.input_channel, n_classes=self.args.num_class).to(self.device)
         elif model_name == 'Swin':
             model = model_implements.Swin(num_classes=self.args.num_class,
-                                          in_channel=self.args.input_channel).to(self.device)
+                                          in_channel=self.args.input_channel,
+                                          memory_efficient=self.args.uper_memory_efficient if hasattr(self.args, 'uper_memory_efficient') else False,
+                                          full_resolution=not (self.args.uper_low_res_logits if hasattr(self.args, 'uper_low_res_logits') else False)).to(self.device)
+        elif model_name == 'HRNet':
+            model = model_implements.HRNet(num_classes=self.args.num_class,
+                                           output_mode=self.args.hrnet_output_mode if hasattr(self.args, 'hrnet_output_mode') else 'concat',
+                                           fused_channels=self.args.hrnet_fused_channels if hasattr(self.args, 'hrnet_fused_channels') else 256).to(self.device)
         else:
             raise Exception('No model named', model_name)
 
@@ -271,11 +392,31 @@ class Trainer_seg:
     def _init_criterion(self, criterion_name):
         if criterion_name == 'CE':
             criterion = loss_hub.CrossEntropy().to(self.device)
+        elif criterion_name == 'OHEM':
+            criterion = loss_hub.OHEMCrossEntropy(top_k=self.args.ohem_top_k if hasattr(self.args, 'ohem_top_k') else 0.25,
+                                                  threshold=self.args.ohem_threshold if hasattr(self.args, 'ohem_threshold') else None,
+                                                  class_weight=self.args.class_weight if hasattr(self.args, 'class_weight') else None).to(self.device)
+        elif criterion_name == 'Compound':
+            criterion = loss_hub.CompoundLoss(self.args.compound_weights if hasattr(self.args, 'compound_weights') else None,
+                                              activation=self.args.compound_activation if hasattr(self.args, 'compound_activation') else 'softmax',
+                                              class_weight=self.args.class_weight if hasattr(self.args, 'class_weight') else None).to(self.device)
         else:
             raise Exception('No criterion named', criterion_name)
 
         return criterion
 
+    def _init_profiler(self, stages):
+        enabled = self.args.profile if hasattr(self.args, 'profile') else False
+        if enabled and not hasattr(self.args, 'profile_interval'):
+            self.args.profile_interval = 100
+
+        return utils.StepProfiler(stages,
+                                  self.device,
+                                  enabled=enabled,
+                                  sync=self.args.profile_sync if hasattr(self.args, 'profile_sync') else False,
+                                  trace_steps=self.args.profile_trace_steps if hasattr(self.args, 'profile_trace_steps') else None,
+                                  trace_dir=self.saved_model_directory)
+
     def _init_optimizer(self, optimizer_name, model, lr):
         optimizer = None
 
@@ -0,0 +1,148 @@
+import torch
+import time
+import os
+import re
+import itertools
+import resource
+
+from models import dataloader as dataloader_hub
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class DataLoaderTuner:
+    """
+    Measures the training data loader throughput over worker counts, prefetch factors and pin_memory settings.
+
+    Uses the training dataset and augmentation flags of the given config, so the numbers match the real input pipeline.
+    The fastest setting (the one with the smallest RSS among those within 'tune_tolerance' of the top throughput) is
+    written next to the original config as '<config>_tuned.yml'.
+    """
+
+    def __init__(self, args):
+        self.start_time = time.time()
+        self.args = args
+
+        use_cuda = self.args.cuda and torch.cuda.is_available()
+        self.device = torch.device('cuda' if use_cuda else 'cpu')
+
+        self.worker_list = self.args.tune_worker_list if hasattr(self.args, 'tune_worker_list') else [0, 2, 4, 8, 16]
+        self.prefetch_list = self.args.tune_prefetch_list if hasattr(self.args, 'tune_prefetch_list') else [2, 4, 8]
+        self.pin_memory_list = self.args.tune_pin_memory_list if hasattr(self.args, 'tune_pin_memory_list') else [True, False]
+        self.num_batches = self.args.tune_num_batches if hasattr(self.args, 'tune_num_batches') else 30
+        self.warmup_batches = self.args.tune_warmup_batches if hasattr(self.args, 'tune_warmup_batches') else 5
+        self.tolerance = self.args.tune_tolerance if hasattr(self.args, 'tune_tolerance') else 0.05
+
+    def start_tuning(self):
+        results = []
+
+        for num_workers, prefetch_factor, pin_memory in itertools.product(self.worker_list, self.prefetch_list, self.pin_memory_list):
+            if num_workers == 0 and prefetch_factor != self.prefetch_list[0]:
+                continue    # prefetch is not used by the main process loader
+
+            loader = self.__init_data_loader(num_workers, prefetch_factor, pin_memory)
+            samples_per_sec, rss = self._measure(loader, pin_memory)
+            self._shutdown(loader)
+
+            results.append({'worker': num_workers,
+                            'prefetch_factor': prefetch_factor,
+                            'pin_memory': pin_memory,
+                            'samples/sec': samples_per_sec,
+                            'RSS (MB)': rss / 2 ** 20})
+
+            print(f'worker {num_workers:3d} / prefetch_factor {prefetch_factor:2d} / pin_memory {str(pin_memory):5s} '
+                  f'-> {samples_per_sec:10.2f} samples/sec, RSS {rss / 2 ** 20:10.1f} MB')
+
+        best = self._select_best(results)
+        print(f'Best setting -> worker: {best["worker"]}, prefetch_factor: {best["prefetch_factor"]}, '
+              f'pin_memory: {best["pin_memory"]} ({best["samples/sec"]:.2f} samples/sec)')
+
+        file_path = self.save_config(best)
+        print(file_path + '\t tuned config saved!!')
+        print(f'Tuning time: {time.time() - self.start_time}')
+
+        return results
+
+    def _measure(self, loader, pin_memory):
+        iterator = loader.Loader.iterator   # repeats forever, independent of dataset length
+
+        for _ in range(self.warmup_batches):
+            next(iterator)
+
+        num_samples = 0
+        tt = time.perf_counter()
+        for _ in range(self.num_batches):
+            (x_in, _), _ = next(iterator)
+            x_in = x_in.to(self.device, non_blocking=pin_memory)    # include host-to-device copy for pin_memory
+            num_samples += x_in.shape[0]
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - tt
+
+        return num_samples / elapsed, self._rss()
+
+    @staticmethod
+    def _rss():
+        """Resident memory of the main process and its workers. Shared pages are counted once per process."""
+        if psutil is not None:
+            process = psutil.Process(os.getpid())
+            return process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+
+        # fallback to peak RSS, reported in KB on linux
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+    @staticmethod
+    def _shutdown(loader):
+        iterator = loader.Loader.iterator
+        if hasattr(iterator, '_shutdown_workers'):
+            iterator._shutdown_workers()
+        del loader
+
+    def _select_best(self, results):
+        top = max(item['samples/sec'] for item in results)
+        candidates = [item for item in results if item['samples/sec'] >= top * (1 - self.tolerance)]
+
+        return min(candidates, key=lambda item: (item['RSS (MB)'], item['worker']))
+
+    def save_config(self, best):
+        with open(self.args.config_path, 'r') as f_r:
+            conf = f_r.read()
+
+        conf = re.sub(r'(\bworker:\s*)\d+', r'\g<1>{}'.format(best['worker']), conf, count=1)
+        conf = re.sub(r'(\bpin_memory:\s*)(true|false)', r'\g<1>{}'.format(str(best['pin_memory']).lower()), conf, count=1)
+        if re.search(r'\bprefetch_factor:', conf):
+            conf = re.sub(r'(\bprefetch_factor:\s*)\d+', r'\g<1>{}'.format(best['prefetch_factor']), conf, count=1)
+        else:
+            conf = re.sub(r'(\n(\s*)worker:[^\n]*)', r'\1\n\g<2>prefetch_factor: {},'.format(best['prefetch_factor']), conf, count=1)
+
+        file_path = os.path.splitext(self.args.config_path)[0] + '_tuned.yml'
+        with open(file_path, 'w') as f_w:
+            f_w.write(conf)
+
+        return file_path
+
+    def __init_data_loader(self, num_workers, prefetch_factor, pin_memory):
+        if self.args.dataloader == 'Image2Image':
+            loader = dataloader_hub.Image2ImageDataLoader(x_path=self.args.train_x_path,
+                                                          y_path=self.args.train_y_path,
+                                                          batch_size=self.args.batch_size,
+                                                          num_workers=num_workers,
+                                                          pin_memory=pin_memory,
+                                                          prefetch_factor=prefetch_factor,
+                                                          mode='train',
+                                                          args=self.args)
+        elif self.args.dataloader == 'Image2Vector':
+            loader = dataloader_hub.Image2VectorDataLoader(csv_path=self.args.train_csv_path,
+                                                           batch_size=self.args.batch_size,
+                                                           num_workers=num_workers,
+                                                           pin_memory=pin_memory,
+                                                           prefetch_factor=prefetch_factor,
+                                                           mode='train',
+                                                           args=self.args)
+        else:
+            raise Exception('No dataloader named', self.args.dataloader)
+
+        return loader